@@ -29,8 +29,13 @@ setup(
     license='GPLv3+',
     packages=['syncere'],
     install_requires=['forwarg', 'cmenu'],
+    # The selection filters are vectorized if NumPy is installed
+    extras_require={'numpy': ['numpy']},
     entry_points={
-        'console_scripts': ['syncere = syncere:Syncere']
+        'console_scripts': [
+            'syncere = syncere:Syncere',
+            'syncere-rsync-simulator = syncere.simulator:main',
+        ]
     },
     classifiers=[
         'Development Status :: 4 - Beta',
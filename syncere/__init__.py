@@ -20,9 +20,37 @@ import sys as _m_sys
 import os as _m_os
 import subprocess as _m_subprocess
 import re as _m_re
+import shlex as _m_shlex
 import fnmatch as _m_fnmatch
+import operator as _m_operator
+import functools as _m_functools
+import time as _m_time
+import concurrent.futures as _m_futures
 
 from .cliargs import _m_forwarg, CLIArgs
+from .locations import Location, parse_locations
+from .multiplex import SharedConnection
+from .batch import PreviewBatch
+from .details import DetailsFetcher
+from .completion import PathIndex, StoredPathIndex
+from .rollups import Rollups, change_bytes
+from .watch import TreeWatcher
+from .server import SessionServer
+from .metrics import SessionMetrics
+from .expressions import Expression
+from .history import DecisionHistory
+from .ancestors import HiddenChanges
+from .journal import TransferJournal, LOG_FORMAT
+from .governor import ResourceGovernor
+from .ichange import encode_ichange, compile_ichange_pattern
+from .prefetch import PreviewPrefetcher
+from .store import ChangeStore
+from .columns import ChangeColumns
+from .moves import MoveDetector
+from .duplicates import DuplicateFinder, MODES as DUPLICATE_MODES
+from .export import (FORMATS as EXPORT_FORMATS, BUFFER_SIZE as EXPORT_BUFFER,
+                     guess_format, write_changes, read_decisions)
+from . import parsing
 from . import exceptions
 
 try:
@@ -43,10 +71,33 @@ class Syncere:
     VERSION_DATE = '2016-05-07'
     DEFAULT_STARTUP_COMMANDS = ['config alias set details "list --details"',
                                 'preview quit', 'list']
+    DEFAULT_SERVE_COMMANDS = ['preview']
     DEFAULT_CONFIG = {
+        'fan-out-workers': '0',
+        'history-depth': '1000',
         'max-inline-filters': '12',
+        'prefetch-delay': '',
+        'preview-parse-workers': '0',
+        'preview-profile': 'full',
+        'preview-cgroup': '',
+        'preview-cpu-max': '',
+        'preview-cpus': '',
         'preview-info-flags': 'backup4,copy4,del4,flist4,misc4,mount4,name1,'
                               'remove4,symsafe4',
+        'preview-io-max': '',
+        'preview-ionice': '',
+        'preview-nice': '',
+        'resume-backoff': '30',
+        'resume-overlap': '64',
+        'resume-retries': '3',
+        'transfer-cgroup': '',
+        'transfer-cpu-max': '',
+        'transfer-cpus': '',
+        'transfer-duplicates': '',
+        'transfer-io-max': '',
+        'transfer-ionice': '',
+        'transfer-nice': '',
+        'watch-debounce': '0.5',
     }
 
     def __init__(self, cliargs=None, commands=[], test=False):
@@ -54,7 +105,22 @@ class Syncere:
         self.configuration = self.DEFAULT_CONFIG.copy()
         self.messages = Messages(self)
         self.preview_needed = True
-        self.pending_changes = []
+        if self.cliargs.namespace.change_store is None:
+            self.pending_changes = []
+            self.path_index = PathIndex()
+        else:
+            self.pending_changes = ChangeStore(
+                        self.cliargs.namespace.change_store, StoredChange)
+            self.path_index = StoredPathIndex(self.pending_changes)
+        self.connection = None
+        self.batch = None
+        self.details_fetcher = DetailsFetcher(self)
+        self.rollups = Rollups(self.pending_changes)
+        self.columns = ChangeColumns(self.pending_changes)
+        self.metrics = SessionMetrics()
+        self.history = DecisionHistory()
+        self.governor = ResourceGovernor(self.configuration)
+        self.prefetcher = PreviewPrefetcher()
         self._start_interface(commands, test)
 
     def _parse_arguments(self, cliargs):
@@ -67,23 +133,455 @@ class Syncere:
                     raise exceptions.ExperimentalOptionWarning(argdef.dest)
         if len(self.cliargs.namespace.locations) < 2:
             raise exceptions.MissingDestinationError()
+        self.sources, self.destination = parse_locations(
+                                            self.cliargs.namespace.locations)
+        # The argument may also be a command line, e.g. the simulator's
+        self.rsync = _m_shlex.split(self.cliargs.namespace.rsync_executable)
+        # The destination given as a positional argument is always the first
+        self.destinations = [self.destination,
+                             *(Location(string) for string
+                               in self.cliargs.namespace.also_to)]
+
+    def _open_connection(self):
+        hosts = [location.host for location in (*self.sources,
+                                                *self.destinations)
+                 if location.remote]
+        if not self.cliargs.namespace.ssh_multiplex or not hosts:
+            return
+
+        self.connection = SharedConnection(self.cliargs.namespace.rsh, hosts)
+        self.connection.open()
+        self.metrics.connection_setup = {
+                        host: setup_time for host, setup_time
+                        in self.connection.setup_times.items()
+                        if setup_time is not None}
+
+        for host, setup_time in self.connection.setup_times.items():
+            if setup_time is None:
+                self.messages.error(self.messages.connection_failed, host)
+            elif self.cliargs.namespace.verbose:
+                self.messages.info(self.messages.connection_established,
+                                   host, '({:.3f}s)'.format(setup_time))
+
+    def _close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
     def _start_interface(self, commands, test):
         # TODO #30 #31 #33
-        self.mainmenu = MainMenu(self, test).menu
+        self.main = MainMenu(self, test)
+        self.mainmenu = self.main.menu
+        serve = self.cliargs.namespace.serve
 
         # When testing, we don't want the original DEFAULT_STARTUP_COMMANDS to
         # be modified directly by the tests, so clone it
-        commands = commands or self.cliargs.namespace.commands or \
-            self.DEFAULT_STARTUP_COMMANDS[:]
-        # This can raise _m_cmenu.InsufficientTestCommands: if testing, the
-        # last command should be one that quits syncere
-        self.mainmenu.loop(intro="Type 'help' to list available commands",
-                           cmdlines=commands, test=test)
+        commands = commands or self.cliargs.namespace.commands or (
+            self.DEFAULT_SERVE_COMMANDS if serve is not None
+            else self.DEFAULT_STARTUP_COMMANDS)[:]
+        self._open_connection()
+        try:
+            if serve is not None:
+                self._serve(serve, commands)
+            else:
+                # The decision commands coalesce their consecutive runs by
+                # looking ahead at the pending command lines, see
+                # MainMenu._decide
+                # This can raise _m_cmenu.InsufficientTestCommands: if
+                # testing, the last command should be one that quits syncere
+                self.mainmenu.loop(
+                                intro="Type 'help' to list available commands",
+                                cmdlines=commands, test=test)
+        finally:
+            self._close_connection()
+            self.discard_batch()
+            self._write_metrics()
+
+    def _serve(self, path, commands):
+        # The responses are read by other programs
+        self.messages.disable_colors()
+        try:
+            self.main.run_script(commands)
+        except self.mainmenu.BreakLoops:
+            return
+
+        server = SessionServer(self, path, self.main.select_changes,
+                               self.mainmenu)
+        self.messages.info(self.messages.serve_started, path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def _write_metrics(self):
+        path = self.cliargs.namespace.metrics_file
+        if path is None:
+            return
+        if self.pending_changes:
+            # Otherwise keep the numbers recorded before the last transfer
+            self.metrics.record_changes(self.rollups.groups('op'))
+        try:
+            self.metrics.write(path, self.cliargs.namespace.metrics_format)
+        except OSError as exc:
+            self.messages.error(self.messages.metrics_not_written, exc)
+
+    def popen(self, phase, args, quiet=False, **kwargs):
+        """
+        Start an internal rsync command of the given phase, 'preview' or
+        'transfer', with the resource limits configured for it; the limits
+        are not reported if quiet, e.g. in a background thread.
+        """
+        call, report = self.governor.popen(phase, args, quiet=quiet,
+                                           **kwargs)
+        if report is not None:
+            self.messages.info(self.messages.limits_applied, phase + ':',
+                               report or 'none')
+        return call
+
+    def filter_rsync_args(self, groups, exclude=()):
+        """
+        Return the command-line arguments of the given groups, to be passed to
+        an internal rsync command, leaving out the arguments whose dest is in
+        exclude.
+        """
+        exclude = set(exclude)
+        prefix = []
+
+        if self.connection is not None:
+            # Replace the original --rsh option with one that reuses the shared
+            # connection
+            exclude.add('rsh')
+            prefix.append(self.connection.rsh_option())
+
+        if not exclude:
+            return self.cliargs.filter_whitelist(groups=groups)
+
+        return [*prefix, *self.cliargs.filter_blacklist(
+                        dests=exclude,
+                        groups=set(self.cliargs.parser.title_to_group) -
+                        set(groups))]
+
+    def remote_shell(self):
+        """
+        Return the remote shell command, as a list of words, for the commands
+        that syncere itself runs on a remote destination.
+        """
+        if self.connection is not None:
+            return self.connection.command()
+        return _m_shlex.split(self.cliargs.namespace.rsh or
+                              _m_os.environ.get('RSYNC_RSH') or
+                              SharedConnection.DEFAULT_RSH)
+
+    def source_index(self, path):
+        """
+        Return the index of the source that a path of the changes comes from,
+        i.e. the first local source where it exists, since rsync keeps the
+        first of the files with the same name, or 0.
+        """
+        if len(self.sources) > 1:
+            for index, source in enumerate(self.sources):
+                if source.local and _m_os.path.lexists(
+                                    _m_os.path.join(source.root, path)):
+                    return index
+        return 0
+
+    def batch_possible(self):
+        """
+        Tell whether the preview command can record a batch file for the
+        transfer command.
+        """
+        namespace = self.cliargs.namespace
+        return (namespace.batch_transfer and
+                # --only-write-batch would make rsync modify the destination
+                # if --dry-run was removed from the transfer command, and
+                # rsync does not allow more than one batch option
+                not namespace.dry_run and
+                not namespace.write_batch and
+                not namespace.only_write_batch and
+                not namespace.read_batch and
+                len(self.destinations) == 1 and
+                all(location.local for location in (*self.sources,
+                                                    self.destination)))
+
+    def discard_batch(self):
+        if self.batch is not None:
+            self.batch.discard()
+            self.batch = None
+
+    def new_changes(self):
+        """
+        Return an empty sequence where a preview can collect its changes,
+        kept in the same storage as the pending changes.
+        """
+        if isinstance(self.pending_changes, ChangeStore):
+            return self.pending_changes.staging()
+        return []
+
+    def load_preview(self, changes, profile='full'):
+        """
+        Replace the pending changes with the results of a preview.
+        """
+        self.pending_changes.clear()
+        self.pending_changes.extend(changes)
+
+        self.path_index.rebuild(self.pending_changes)
+        self.rollups.rebuild()
+        self.columns.invalidate()
+        self.details_fetcher.reset(profile)
+        self.history.clear()
+
+        self.preview_needed = False
+
+    def merge_preview(self, changes, covers, profile='full'):
+        """
+        Update the pending changes whose paths satisfy covers with the results
+        of a partial preview, keeping the decisions of the changes that have
+        not been altered; the changes are then renumbered.
+
+        Return the numbers of added, altered and removed changes.
+        """
+        if isinstance(self.pending_changes, ChangeStore):
+            # The changes are joined in the database, not in memory
+            counts = self.pending_changes.merge(
+                            changes, parsing.PROFILES[profile].fields, covers)
+        else:
+            counts = self._merge_list(changes, covers, profile)
+
+        self.path_index.rebuild(self.pending_changes)
+        self.rollups.rebuild()
+        self.columns.invalidate()
+        # The older changes may have been previewed with a different profile
+        self.details_fetcher.complete = self.details_fetcher.complete and \
+            parsing.PROFILES[profile].complete
+        # The batch file does not record the new changes
+        self.discard_batch()
+        # The numbers of the changes have been reassigned
+        self.history.clear()
+
+        return counts
+
+    def _merge_list(self, changes, covers, profile):
+        signature = self._signature(profile)
+        byname = self.index_by_path(changes)
+        merged = []
+        altered = 0
+        removed = 0
+
+        for old in self.pending_changes:
+            # rsync may also report some paths that were not asked for, e.g.
+            # the deletions in a listed directory
+            if old.sfilename not in byname and not covers(old.sfilename):
+                merged.append(old)
+                continue
+            new = self._pop_counterpart(byname, old)
+            if new is None:
+                removed += 1
+            elif signature(new) == signature(old):
+                merged.append(old)
+            else:
+                altered += 1
+                new.mark = 'altered'
+                merged.append(new)
+        added = [new for variants in byname.values() for new in variants]
+        for new in added:
+            new.mark = 'new'
+        merged.extend(added)
+
+        for id_, change in enumerate(merged, start=1):
+            change.id_ = id_
+        # The aggregates refer to this very list
+        self.pending_changes[:] = merged
+        return (len(added), altered, removed)
+
+    @staticmethod
+    def _signature(profile):
+        # What must be equal for a change to be kept with its decision by
+        # both a partial and a complete refresh of the preview: also the
+        # destinations that it affects
+        return _m_operator.attrgetter(*parsing.PROFILES[profile].fields,
+                                      'destinations')
+
+    @staticmethod
+    def index_by_path(changes):
+        # With several destinations, a path may have a change for each group
+        # of destinations that it affects in the same way
+        byname = {}
+        for change in changes:
+            byname.setdefault(change.sfilename, []).append(change)
+        return byname
+
+    @staticmethod
+    def _pop_counterpart(byname, change):
+        """
+        Remove and return the change of the same path from a dictionary built
+        by index_by_path, preferably the one for the same destinations, or
+        None if there is none.
+        """
+        variants = byname.get(change.sfilename)
+        if not variants:
+            return None
+        for index, variant in enumerate(variants):
+            if variant.destinations == change.destinations:
+                break
+        else:
+            index = 0
+        variant = variants.pop(index)
+        if not variants:
+            del byname[change.sfilename]
+        return variant
+
+    def refresh_preview(self, changes, profile='full'):
+        """
+        Replace the pending changes with the results of a new preview, keeping
+        the decisions of the changes that have not been altered.
+
+        The new changes are joined to the old ones by path, comparing the
+        fields of the profile, so the refresh takes linear time, and only
+        needs an index of the old changes. The unchanged changes keep their
+        objects, with their decisions and any details retrieved after the
+        previous preview, and keep their ids unless changes were added or
+        removed before them; the added and altered changes are marked.
+
+        Return the numbers of kept, added, altered and vanished changes.
+        """
+        if isinstance(self.pending_changes, ChangeStore):
+            # The changes are joined in the database, not in memory
+            counts = self.pending_changes.refresh(
+                                    changes, parsing.PROFILES[profile].fields)
+        else:
+            counts = self._refresh_list(changes, profile)
+
+        self.path_index.rebuild(self.pending_changes)
+        self.rollups.rebuild()
+        self.columns.invalidate()
+        self.details_fetcher.reset(profile)
+        # The numbers of the changes may have been reassigned
+        self.history.clear()
+
+        self.preview_needed = False
+        return counts
+
+    def _refresh_list(self, changes, profile):
+        signature = self._signature(profile)
+        byname = self.index_by_path(self.pending_changes)
+        refreshed = []
+        kept = 0
+        added = 0
+        altered = 0
+
+        for id_, new in enumerate(changes, start=1):
+            old = self._pop_counterpart(byname, new)
+            if old is None:
+                added += 1
+                new.mark = 'new'
+            elif signature(new) == signature(old):
+                kept += 1
+                old.mark = None
+                new = old
+            else:
+                altered += 1
+                new.mark = 'altered'
+            new.id_ = id_
+            refreshed.append(new)
+
+        # The aggregates refer to this very list
+        self.pending_changes[:] = refreshed
+        return (kept, added, altered, sum(len(variants)
+                                          for variants in byname.values()))
+
+    def decide(self, changes, decision):
+        """
+        Include (True), exclude (False) or reset (None) the changes.
+
+        All the decisions should be made through this method, so that the
+        aggregates of the pending changes are kept up to date.
+        """
+        if self.columns.enabled:
+            # Compare and assign the decisions of the whole selection at once,
+            # then only visit the changes whose decision is different
+            changes = [self.pending_changes[index] for index
+                       in self.columns.assign([change.id_ - 1
+                                               for change in changes],
+                                              decision)]
+        self.decide_each(((change, decision) for change in changes),
+                         Change.DECISION_COMMANDS[decision])
+
+    def decide_each(self, pairs, label):
+        """
+        Make a different decision on each change, from (change, decision)
+        pairs, as a single undoable step.
+        """
+        deltas = []
+        for change, decision in pairs:
+            old = change.included
+            Change.DECISION_METHODS[decision](change)
+            if old is not decision:
+                self.rollups.update(change, old)
+                self.columns.update(change)
+                # The numbers of the changes are their 1-based positions
+                deltas.append((change.id_ - 1, old, decision))
+        self.history.record('{} ({} changes)'.format(label, len(deltas)),
+                            deltas, int(self.configuration['history-depth']))
+
+    def _apply_deltas(self, runs, forward):
+        # runs are (start, stop, old, new) tuples
+        for start, stop, old, new in runs:
+            decision = new if forward else old
+            method = Change.DECISION_METHODS[decision]
+            for index in range(start, stop):
+                change = self.pending_changes[index]
+                previous = change.included
+                method(change)
+                if previous is not decision:
+                    self.rollups.update(change, previous)
+                    self.columns.update(change)
+
+    def undo(self):
+        """
+        Revert the last decision; return its description, or None if there
+        is nothing to undo.
+        """
+        entry = self.history.undo()
+        if entry is None:
+            return None
+        self._apply_deltas(entry.runs, forward=False)
+        return entry.label
+
+    def redo(self):
+        entry = self.history.redo()
+        if entry is None:
+            return None
+        self._apply_deltas(entry.runs, forward=True)
+        return entry.label
+
+    def restore_checkpoint(self, name):
+        """
+        Restore the decisions saved in a checkpoint, as a new undoable
+        decision; raise KeyError if the checkpoint does not exist.
+        """
+        deltas = self.history.checkpoint_deltas(name, self.pending_changes)
+        for index, old, new in deltas:
+            change = self.pending_changes[index]
+            Change.DECISION_METHODS[new](change)
+            self.rollups.update(change, old)
+            self.columns.update(change)
+        self.history.record('checkpoint {} ({} changes)'.format(
+                                                        name, len(deltas)),
+                            deltas, int(self.configuration['history-depth']))
+        return len(deltas)
 
     def clear_preview(self):
+        # A prefetched preview would not reflect the transfer
+        self.prefetcher.cancel()
         self.pending_changes.clear()
+        self.history.clear()
+        self.path_index.clear()
+        self.rollups.clear()
+        self.columns.invalidate()
         self.preview_needed = True
+        self.discard_batch()
 
 
 class Messages:
@@ -114,19 +612,68 @@ class Messages:
         False: '{}  '.format(ICON_CHANGE_EXCLUDED),
     }
 
+    ancestors_fixed = 'Ancestor directories included:'
+    ancestors_none = 'No included changes are hidden by excluded directories'
     bad_command_syntax = 'Bad command syntax'
+    batch_changed = ('The locations have changed since the preview, '
+                     'transferring without the batch file')
+    batch_excluded = ('The batch file cannot skip excluded changes, '
+                      'transferring without it')
+    checkpoint_restored = 'Decisions restored:'
+    checkpoint_unknown = 'Unknown checkpoint:'
+    changes_exported = 'Changes exported:'
+    connection_established = 'Shared connection established:'
+    connection_failed = 'Could not set up the shared connection:'
+    decisions_bad_record = 'Bad record in the decisions file:'
+    decisions_imported = 'Decisions imported, paths not found:'
+    duplicates_bad_mode = 'Unknown transfer-duplicates mode:'
+    duplicates_created = 'Duplicates created on the destination:'
+    duplicates_failed = 'Duplicates not created on the destination:'
+    duplicates_found = 'Duplicates not transferred, bytes saved:'
+    fan_out_nothing = 'Nothing to transfer to'
+    fan_out_result = 'rsync return code for'
+    file_cannot_be_read = 'cannot be read:'
     file_cannot_be_written = 'cannot be written:'
+    history_redone = 'Redone:'
+    history_undone = 'Undone:'
+    limits_applied = 'Resource limits applied to rsync'
+    metrics_not_written = 'Could not write the metrics file:'
+    moves_applied = 'Files moved on the destination:'
+    moves_dry_run = 'The files are not moved with --dry-run'
+    moves_found = 'Moves found, bytes not to be transferred:'
+    moves_none = 'No moves found'
+    moves_unsupported = ('Moves require local sources if there are several, '
+                         'and a local or remote shell destination')
     nothing_to_do = 'Nothing to do'
+    nothing_to_redo = 'Nothing to redo'
+    nothing_to_undo = 'Nothing to undo'
+    preview_bad_profile = 'Unknown preview profile:'
     preview_needed = 'The preview command must be executed first'
+    preview_prefetched = 'Using the preview prefetched seconds ago:'
+    preview_refreshed = 'Pending changes kept, added, altered, vanished:'
     rsync_error = 'rsync error:'
     selection_bad_args = 'Unrecognized selection'
+    selection_bad_expression = 'Bad filter expression:'
+    serve_started = 'Serving the session on'
     selection_no_changes = 'There are no pending changes'
     selection_null = 'No changes selected'
     transfer_ambiguous_mode = 'Transfer modes are mutually exclusive'
     transfer_no_changes = 'There are no pending changes'
+    transfer_resumable = ("Changes not transferred, retry them with "
+                          "'transfer --resume':")
+    transfer_resume_locations = 'The interrupted transfer had other locations:'
+    transfer_resume_none = 'There is no interrupted transfer to resume'
+    transfer_resume_retry = 'Retrying the remaining changes in seconds:'
     transfer_selection_null = 'All changes have been excluded'
     transfer_selection_undecided = 'There are still undecided changes'
+    transfer_hidden_changes = ('Included changes inside excluded directories, '
+                               'see the ancestors command:')
     unrecognized_arguments = 'Unrecognized arguments:'
+    watch_fan_out = 'The sources cannot be watched with several destinations'
+    watch_remote = 'Only local sources can be watched'
+    watch_started = 'Watching the sources, press Ctrl+c to stop'
+    watch_unavailable = 'The sources cannot be watched:'
+    watch_updated = 'Pending changes added, altered, removed:'
     wrong_syntax = 'Wrong syntax'
 
     def __init__(self, rootapp):
@@ -184,6 +731,8 @@ class Change:
                  length, tstamp, lfilename, sfilename, link, checksum):
         self.id_ = id_
         self.ichange = ichange
+        # The integer code of the itemized change, see ichange.py
+        self.icode = encode_ichange(ichange)
         self.operation = operation
         self.permissions = permissions
         self.uid = uid
@@ -194,6 +743,11 @@ class Change:
         self.sfilename = sfilename
         self.link = link
         self.checksum = checksum
+        # The indices of the destinations affected by the change
+        self.destinations = (0, )
+        # 'new' or 'altered' if the last refresh of the preview added or
+        # modified the change
+        self.mark = None
 
         self.reset()
 
@@ -201,8 +755,24 @@ class Change:
         return (self.ichange, )
 
     def get_details(self):
-        return (self.ichange, self.permissions, self.uid, self.gid,
-                self.length, self.tstamp)
+        # The details are None if they were not requested by a lean preview
+        # profile, and could not be retrieved later
+        return (self.ichange, *(value if value is not None else '?'
+                                 for value in (self.permissions, self.uid,
+                                               self.gid, self.length,
+                                               self.tstamp)))
+
+    def set_details(self, permissions, uid, gid, length, tstamp,
+                    lfilename=None, checksum=None):
+        self.permissions = permissions
+        self.uid = uid
+        self.gid = gid
+        self.length = length
+        self.tstamp = tstamp
+        if lfilename is not None:
+            self.lfilename = lfilename
+        if checksum is not None:
+            self.checksum = checksum
 
     def include(self):
         self.included = True
@@ -213,13 +783,63 @@ class Change:
     def reset(self):
         self.included = None
 
+    DECISION_METHODS = {True: include, False: exclude, None: reset}
+    DECISION_COMMANDS = {True: 'include', False: 'exclude', None: 'reset'}
+
+
+class StoredChange(Change):
+    """
+    A pending change read from a ChangeStore, which writes its decision and
+    details back to the database.
+    """
+    # None until the change is inserted in a store
+    store = None
+
+    @property
+    def included(self):
+        return self._included
+
+    @included.setter
+    def included(self, decision):
+        self._included = decision
+        if self.store is not None:
+            self.store.dirty_decisions[self.id_] = decision
+            self.store.flush_soon()
+
+    def set_details(self, *args, **kwargs):
+        super().set_details(*args, **kwargs)
+        if self.store is not None:
+            self.store.dirty_details[self.id_] = self
+            self.store.flush_soon()
+
 
 class _ChangeFilter:
     BadFilter = type('BadFilter', (Exception, ), {})
+    ARG_TO_DETAIL = {
+        'permissions': 'permissions',
+        'owner_id': 'uid',
+        'group_id': 'gid',
+        'size': 'length',
+        'timestamp': 'tstamp',
+    }
+    # The filters that a ChangeStore evaluates with its indexes, comparing
+    # a whole column; -i/--itemized-change is also evaluated by the query
+    ARG_TO_COLUMN = {
+        **ARG_TO_DETAIL,
+        'operation': 'operation',
+        'exact_path': 'sfilename',
+        'mark': 'mark',
+    }
+    # The filters that the ChangeColumns evaluate as vectorized masks,
+    # together with the ids and -i/--itemized-change
+    COLUMNAR_ARGS = ('operation', 'permissions', 'owner_id', 'group_id',
+                     'size', 'timestamp', 'mark')
 
     def __init__(self, rootapp):
         self.rootapp = rootapp
         self.pending_changes = rootapp.pending_changes
+        # Expression string -> compiled Expression
+        self.expressions = {}
 
     def add_filter_parser_arguments(self, parser):
         group = parser.add_argument_group('selection filters')
@@ -237,6 +857,9 @@ class _ChangeFilter:
         group.add_argument('-X', '--regex-path-icase', action='append')
         group.add_argument('-w', '--glob-path', action='append')
         group.add_argument('-W', '--glob-path-icase', action='append')
+        group.add_argument('-D', '--destination', action='append')
+        group.add_argument('-m', '--mark', action='append')
+        group.add_argument('-e', '--expression', action='append')
 
         self.arg_to_filter = {
             'itemized_change': self._select_changes_by_itemized_change,
@@ -252,6 +875,8 @@ class _ChangeFilter:
             'regex_path_icase': self._select_changes_by_regex_path_icase,
             'glob_path': self._select_changes_by_glob_path,
             'glob_path_icase': self._select_changes_by_glob_path_icase,
+            'destination': self._select_changes_by_destination,
+            'mark': self._select_changes_by_mark,
         }
 
     def select(self, sargs):
@@ -265,30 +890,315 @@ class _ChangeFilter:
             return self.pending_changes
 
         try:
-            # Process id ranges first, thus initializing the changes list
-            # All the other filters will instead subtract from it
-            changes = self._select_changes_by_id(sargs.namespace.ids)
-
-            for change in changes[:]:
-                for arg, filter_ in self.arg_to_filter.items():
-                    tests = vars(sargs.namespace)[arg]
-                    if tests:
-                        for test in tests:
-                            if filter_(change, test) is True:
-                                break
-                        else:
-                            changes.remove(change)
-                            break
+            changes, predicate = self._candidates(sargs)
+            if predicate is not None:
+                changes = list(filter(predicate, changes))
         except self.BadFilter:
             self.rootapp.messages.error(
                                     self.rootapp.messages.selection_bad_args)
             return []
+        except exceptions.BadExpressionError as exc:
+            self.rootapp.messages.error(
+                            self.rootapp.messages.selection_bad_expression,
+                            *exc.args)
+            return []
 
         if not changes:
             self.rootapp.messages.error(self.rootapp.messages.selection_null)
 
         return changes
 
+    def _candidates(self, sargs):
+        """
+        Return the changes selected by the ids, and a function that tells
+        whether one of them satisfies the other filters, or None.
+
+        If NumPy is available, the changes also satisfy the COLUMNAR_ARGS
+        filters and -i/--itemized-change, evaluated as masks of the
+        ChangeColumns, and the function only tests the remaining ones. With a
+        ChangeStore, the changes are instead a ChangeQuery, which also
+        applies the filters in ARG_TO_COLUMN and -i/--itemized-change.
+        """
+        ranges = self._id_ranges(sargs.namespace.ids)
+        if not isinstance(self.pending_changes, ChangeStore):
+            # Process id ranges first, thus initializing the changes list
+            # All the other filters will instead subtract from it
+            changes = self._select_changes_by_id(ranges)
+            columns = self.rootapp.columns
+            # The masks select the changes in order of id, which is the order
+            # of the ids only if their ranges are sorted
+            if not columns.enabled or (ranges is not None and
+                                       ranges != sorted(ranges)):
+                return (changes, self._compile_filters(sargs, changes))
+
+            # This also retrieves the details needed by the masks
+            predicate = self._compile_filters(
+                                sargs, changes,
+                                skip=(*self.COLUMNAR_ARGS, 'itemized_change'))
+            masks = []
+            if ranges is not None:
+                masks.append(columns.ids_mask(ranges))
+            for arg in self.COLUMNAR_ARGS:
+                tests = vars(sargs.namespace)[arg]
+                if tests:
+                    if arg == 'mark':
+                        self._check_marks(tests)
+                    masks.append(columns.field_mask(self.ARG_TO_COLUMN[arg],
+                                                    tests))
+            tests = sargs.namespace.itemized_change
+            if tests:
+                masks.append(columns.icode_mask(self._ichange_patterns(tests)))
+            if masks:
+                changes = [self.pending_changes[index] for index
+                           in _m_functools.reduce(_m_operator.and_,
+                                                  masks).nonzero()[0]]
+            return (changes, predicate)
+
+        conditions = []
+        params = []
+        order = 'id'
+        order_params = []
+        if ranges is not None:
+            conditions.append(' OR '.join(('id BETWEEN ? AND ?', ) *
+                                          len(ranges)))
+            for start, stop in ranges:
+                params.extend((start + 1, stop))
+            if len(ranges) > 1:
+                # Keep the order of the ids, like _select_changes_by_id
+                order = 'CASE {} END, id'.format(' '.join(
+                    ('WHEN id BETWEEN ? AND ? THEN {}'.format(index)
+                     for index in range(len(ranges)))))
+                order_params = params[:]
+        # The details are retrieved for all the changes selected by the ids,
+        # before the other conditions are tested on them
+        predicate = self._compile_filters(
+                                sargs, self.pending_changes.where(conditions,
+                                                                  params),
+                                skip=(*self.ARG_TO_COLUMN, 'itemized_change'))
+
+        for arg, column in self.ARG_TO_COLUMN.items():
+            tests = vars(sargs.namespace)[arg]
+            if tests:
+                if arg == 'mark':
+                    self._check_marks(tests)
+                conditions.append('{} IN ({})'.format(
+                                        column, ', '.join('?' * len(tests))))
+                params.extend(tests)
+        tests = sargs.namespace.itemized_change
+        if tests:
+            conditions.append(' OR '.join(('icode & ? = ?', ) * len(tests)))
+            for pattern in self._ichange_patterns(tests):
+                params.extend(pattern)
+        return (self.pending_changes.where(conditions, params, order,
+                                           order_params), predicate)
+
+    def _check_marks(self, tests):
+        if not set(tests) <= {'new', 'altered'}:
+            raise self.BadFilter()
+
+    def _ichange_patterns(self, tests):
+        try:
+            return [compile_ichange_pattern(test) for test in tests]
+        except ValueError:
+            raise self.BadFilter()
+
+    def _compile_filters(self, sargs, changes, skip=()):
+        """
+        Return a function that tells whether a change satisfies all the
+        filters other than the ids and the ones in skip, or None if there are
+        no such filters.
+
+        The details needed by the filters are first retrieved for the given
+        changes, which is necessary with a lean preview profile, unless
+        changes is None.
+        """
+        filters = []
+        for arg in self.arg_to_filter:
+            tests = vars(sargs.namespace)[arg]
+            if tests and arg not in skip:
+                filters.append([self._compile_test(arg, test)
+                                for test in tests])
+        expressions = [self._compile(string) for string
+                       in sargs.namespace.expression or ()]
+
+        if changes is not None:
+            fields = self._detail_fields(sargs)
+            if fields:
+                self.rootapp.details_fetcher.fetch(changes, fields)
+
+        if not filters and not expressions:
+            return None
+
+        def predicate(change):
+            # Each filter is satisfied if any of its tests is
+            for tests in filters:
+                for test in tests:
+                    if test(change):
+                        break
+                else:
+                    return False
+            # Several expressions must all be satisfied, like the other
+            # filters
+            for expression in expressions:
+                if not expression.predicate(change):
+                    return False
+            return True
+
+        return predicate
+
+    def _detail_fields(self, sargs):
+        """
+        Return the set of the details needed by the filters.
+        """
+        fields = set(field for arg, field in self.ARG_TO_DETAIL.items()
+                     if vars(sargs.namespace)[arg])
+        for string in sargs.namespace.expression or ():
+            fields.update(self._compile(string).details)
+        return fields
+
+    def _compile_test(self, arg, test):
+        """
+        Return a function that tells whether a change satisfies a test of a
+        filter; the path patterns are compiled only once, and bad ones are
+        reported before any change is tested.
+        """
+        try:
+            if arg == 'glob_path':
+                regex = _m_re.compile(_m_fnmatch.translate(test))
+                return lambda change: regex.match(change.sfilename) is not None
+            if arg == 'glob_path_icase':
+                regex = _m_re.compile(_m_fnmatch.translate(test.lower()))
+                return lambda change: regex.match(
+                                        change.sfilename.lower()) is not None
+            if arg == 'regex_path':
+                regex = _m_re.compile(test)
+                return lambda change: regex.search(
+                                                change.sfilename) is not None
+            if arg == 'regex_path_icase':
+                regex = _m_re.compile(test, _m_re.I)
+                return lambda change: regex.search(
+                                                change.sfilename) is not None
+        except _m_re.error:
+            raise self.BadFilter()
+        if arg == 'itemized_change':
+            try:
+                mask, value = compile_ichange_pattern(test)
+            except ValueError:
+                raise self.BadFilter()
+            return lambda change: change.icode & mask == value
+        # Also the bad destinations and marks are reported before any change
+        # is tested
+        if arg == 'destination':
+            try:
+                index = self._get_0_based_id(test)
+            except ValueError:
+                raise self.BadFilter()
+            return lambda change: index in change.destinations
+        if arg == 'mark':
+            self._check_marks((test, ))
+        filter_ = self.arg_to_filter[arg]
+        return lambda change: filter_(change, test) is True
+
+    def select_decisions(self, rules):
+        """
+        Apply a table of (sargs, decision) rules in a single pass over the
+        pending changes, with the same result as applying them one after the
+        other: return the (change, decision) pairs of the changes selected by
+        at least one rule, with the decision of the last one.
+        """
+        if self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return []
+
+        if not self.pending_changes:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.selection_no_changes)
+            return []
+
+        # The rules are compiled first, collecting the details needed by all
+        # of them, so that they are retrieved at once
+        table = []
+        # Each rule's error message, if any, printed in the order of the rules
+        errors = [None] * len(rules)
+        fields = set()
+        # The indices of the changes that need the details, or None for all
+        needed = set()
+        for index, (sargs, decision) in enumerate(rules):
+            try:
+                ranges = self._id_ranges(sargs.namespace.ids)
+                predicate = self._compile_filters(sargs, None)
+                rfields = self._detail_fields(sargs)
+            except self.BadFilter:
+                errors[index] = (self.rootapp.messages.selection_bad_args, )
+                continue
+            except exceptions.BadExpressionError as exc:
+                errors[index] = (
+                            self.rootapp.messages.selection_bad_expression,
+                            *exc.args)
+                continue
+            if ranges is None:
+                ids = None
+            else:
+                ids = set()
+                for start, stop in ranges:
+                    ids.update(range(start + 1, stop + 1))
+            if rfields:
+                fields.update(rfields)
+                if ids is None or needed is None:
+                    needed = None
+                else:
+                    needed.update(ids)
+            table.append((index, ids, predicate, decision))
+
+        if fields:
+            self.rootapp.details_fetcher.fetch(
+                    self.pending_changes if needed is None else
+                    [self.pending_changes[id_ - 1] for id_ in sorted(needed)],
+                    fields)
+
+        # Scanning the rules backwards, the first match is the last one; the
+        # rules that have not selected anything yet are also tested, until
+        # they do, only to report the ones that select nothing
+        table.reverse()
+        unmatched = set(index for index, *rule in table)
+        pairs = []
+        for change in self.pending_changes:
+            decided = False
+            for index, ids, predicate, decision in table:
+                if decided and index not in unmatched:
+                    continue
+                if (ids is None or change.id_ in ids) and (
+                        predicate is None or predicate(change)):
+                    unmatched.discard(index)
+                    if not decided:
+                        pairs.append((change, decision))
+                        decided = True
+                    if not unmatched:
+                        break
+
+        for index in unmatched:
+            errors[index] = (self.rootapp.messages.selection_null, )
+        for error in errors:
+            if error is not None:
+                self.rootapp.messages.error(*error)
+        return pairs
+
+    def is_selective(self, sargs):
+        """
+        Tell whether any filters are given, other than the ids.
+        """
+        return any(vars(sargs.namespace)[arg]
+                   for arg in (*self.arg_to_filter, 'expression'))
+
+    def _compile(self, string):
+        # The same expressions are often repeated, e.g. with 'list' and then
+        # 'include'
+        try:
+            return self.expressions[string]
+        except KeyError:
+            expression = self.expressions[string] = Expression(string)
+            return expression
+
     @staticmethod
     def _get_0_based_id(selid):
         # This line itself can raise ValueError
@@ -297,15 +1207,19 @@ class _ChangeFilter:
             raise ValueError()
         return id0
 
-    def _select_changes_by_id(self, ids):
+    def _id_ranges(self, ids):
+        """
+        Return the (start, stop) ranges of 0-based indices selected by the
+        ids, or None if all the changes are selected.
+        """
         if not ids:
-            return self.pending_changes[:]
+            return None
 
-        changes = []
+        ranges = []
 
         for rawsel in ids:
             if rawsel == '*':
-                return self.pending_changes[:]
+                return None
 
             lsel = rawsel.split(',')
 
@@ -315,12 +1229,11 @@ class _ChangeFilter:
                 if len(rsel) == 1:
                     try:
                         id0 = self._get_0_based_id(isel)
-                        change = self.pending_changes[id0]
-                    except (ValueError, IndexError):
+                    except ValueError:
                         raise self.BadFilter()
-                    else:
-                        if change not in changes:
-                            changes.append(change)
+                    if id0 >= len(self.pending_changes):
+                        raise self.BadFilter()
+                    ranges.append((id0, id0 + 1))
 
                 elif len(rsel) == 2:
                     try:
@@ -328,17 +1241,36 @@ class _ChangeFilter:
                     except ValueError:
                         raise self.BadFilter()
                     else:
-                        for change in self.pending_changes[ids:ide + 1]:
-                            if change not in changes:
-                                changes.append(change)
+                        # Like slices, the ranges may exceed the changes
+                        ranges.append((ids, min(ide + 1,
+                                                len(self.pending_changes))))
 
                 else:
                     raise self.BadFilter()
 
+        return ranges
+
+    def _select_changes_by_id(self, ranges):
+        if ranges is None:
+            return self.pending_changes[:]
+
+        changes = []
+        selected = set()
+
+        for start, stop in ranges:
+            for index in range(start, stop):
+                if index not in selected:
+                    selected.add(index)
+                    changes.append(self.pending_changes[index])
+
         return changes
 
     def _select_changes_by_itemized_change(self, change, test):
-        return test == change.ichange
+        try:
+            mask, value = compile_ichange_pattern(test)
+        except ValueError:
+            raise self.BadFilter()
+        return change.icode & mask == value
 
     def _select_changes_by_operation(self, change, test):
         return test == change.operation
@@ -382,11 +1314,65 @@ class _ChangeFilter:
     def _select_changes_by_glob_path_icase(self, change, test):
         return _m_fnmatch.fnmatch(change.sfilename.lower(), test.lower())
 
+    def _select_changes_by_destination(self, change, test):
+        try:
+            return self._get_0_based_id(test) in change.destinations
+        except ValueError:
+            raise self.BadFilter()
+
+    def _select_changes_by_mark(self, change, test):
+        if test not in ('new', 'altered'):
+            raise self.BadFilter()
+        return test == change.mark
+
+
+class FilterAction(_m_cmenu.Action):
+    """
+    A command that accepts the selection filters, completing the paths of the
+    pending changes after the path filter options.
+    """
+    PATH_OPTIONS = ('-f', '--exact-path', '-w', '--glob-path')
+    MAX_MATCHES = 200
+
+    def __init__(self, parentmenu, name, execute, rootapp, helpshort=None,
+                 helpfull=None):
+        super().__init__(parentmenu, name, execute, helpshort=helpshort,
+                         helpfull=helpfull)
+        self.rootapp = rootapp
+
+    def complete(self, sp_args, line, rl_prefix, rl_begidx, rl_endidx):
+        if not sp_args or not line.endswith(sp_args[-1]):
+            # A new word is being started
+            word = ''
+            previous = sp_args[-1] if sp_args else None
+        else:
+            word = sp_args[-1]
+            previous = sp_args[-2] if len(sp_args) > 1 else None
+
+        if previous not in self.PATH_OPTIONS:
+            for option in self.PATH_OPTIONS[1::2]:
+                if word.startswith(option + '='):
+                    word = word[len(option) + 1:]
+                    break
+            else:
+                return []
+
+        # Don't try to complete glob patterns that already contain wildcards
+        if any(char in word for char in '*?['):
+            return []
+
+        matches = self.rootapp.path_index.complete(word, self.MAX_MATCHES)
+        # Readline's word delimiters also include '/' and '-', so only return
+        # the part of the matches that follows the readline prefix
+        sub = len(word) - len(rl_prefix)
+        return [match[sub:] for match in matches]
+
 
 class TransferCommand:
     DEFAULT_EXCLUDE_FROM_FILE = './exclude-from'
     DEFAULT_INCLUDE_FROM_FILE = './include-from'
     DEFAULT_FILES_FROM_FILE = './files-from'
+    DEFAULT_JOURNAL_FILE = './transfer-journal'
 
     def __init__(self, rootapp, menu):
         self.rootapp = rootapp
@@ -418,9 +1404,11 @@ class TransferCommand:
         self.parser.add_argument('-C', '--checksum-from', nargs='?',
                                  const=True)
         self.parser.add_argument('-k', '--keep-list', action='store_true')
+        self.parser.add_argument('--no-batch', action='store_true')
         self.parser.add_argument('-v', '--view-only', action='store_true')
         self.parser.add_argument('-n', '--dry-run', action='store_true')
         self.parser.add_argument('-q', '--quit', action='store_true')
+        self.parser.add_argument('-r', '--resume', action='store_true')
 
     def execute(self, *args):
         """
@@ -461,6 +1449,45 @@ class TransferCommand:
         with a list of the files interactively included, and an --files-from
         option will be prepended to the original command's options to read the
         created file.
+
+
+        If syncere was started with --batch-transfer, and all the changes are
+        included, the batch file recorded by the preview command is applied
+        with --read-batch instead, unless --no-batch is given, or any of the
+        paths listed by the preview has changed in the meantime in the
+        sources or the destination; only those paths are examined, not the
+        whole trees. The batch file records all the listed changes, so it is
+        not used as soon as any change is excluded, and the changes are then
+        transferred as usual.
+
+
+        Resume an interrupted transfer.
+
+        While rsync transfers the changes, the completed ones are recorded in
+        a journal file; if rsync fails, also if syncere itself is terminated,
+        'transfer --resume' retries only the remaining changes in files-from
+        mode with --partial, without the need of a new preview. If rsync
+        fails again, it is retried up to 'resume-retries' times, waiting
+        'resume-backoff' seconds the first time, and doubling the delay each
+        time. Since rsync may report a file before it has been completely
+        written, the last 'resume-overlap' changes reported by a failed
+        attempt are retried too. The journal is not kept when rsync is given
+        --log-file, in batch mode and with several destinations.
+
+
+        Transfer the duplicate new files only once.
+
+        If the 'transfer-duplicates' configuration option is 'copy' or
+        'link', the included new files that have the same size, permissions,
+        owner, group, modification time and content are transferred only
+        once: after rsync succeeds, the other files are created on the
+        destination from the transferred one, with a copy (a reflink where
+        the file system supports it) or a hard link respectively. The
+        contents are compared with the checksums of the preview, or by
+        reading the files of a local source. This requires one source and a
+        local or remote shell destination; the number of the files that are
+        not transferred and the bytes saved are reported also with
+        --view-only and --dry-run.
         """
         try:
             pargs = self.parser.parse_args(args)
@@ -468,6 +1495,9 @@ class TransferCommand:
             self.rootapp.messages.error(self.rootapp.messages.wrong_syntax)
             return False
 
+        if pargs.namespace.resume:
+            return self._resume(pargs)
+
         if self.rootapp.preview_needed:
             self.rootapp.messages.error(self.rootapp.messages.preview_needed)
             return False
@@ -477,18 +1507,22 @@ class TransferCommand:
                                     self.rootapp.messages.transfer_no_changes)
             return False
 
-        included_changes = []
-        excluded_changes = []
-        for change in self.rootapp.pending_changes:
-            if change.included is True:
-                included_changes.append(change)
-            # There's also the None case, i.e. undecided
-            elif change.included is False:
-                excluded_changes.append(change)
-
-        # TODO #31: This should also warn if some files are included, but their
-        #       parent directories are not, resulting in the files actually
-        #       being excluded
+        if isinstance(self.rootapp.pending_changes, ChangeStore):
+            # The lists of the transfer modes are written streaming the rows
+            included_changes = self.rootapp.pending_changes.where(
+                                                        ('included = 1', ))
+            excluded_changes = self.rootapp.pending_changes.where(
+                                                        ('included = 0', ))
+        else:
+            included_changes = []
+            excluded_changes = []
+            for change in self.rootapp.pending_changes:
+                if change.included is True:
+                    included_changes.append(change)
+                # There's also the None case, i.e. undecided
+                elif change.included is False:
+                    excluded_changes.append(change)
+
         if len(self.rootapp.pending_changes) - len(included_changes) - \
                 len(excluded_changes) > 0:
             self.rootapp.messages.error(
@@ -499,6 +1533,23 @@ class TransferCommand:
                                 self.rootapp.messages.transfer_selection_null)
             return False
 
+        finder, duplicates = self._find_duplicates(included_changes)
+        if finder is False:
+            return False
+        if duplicates:
+            # rsync only transfers the originals, the copies are excluded
+            copies = set(copy.id_ for group in duplicates
+                         for copy in group.copies)
+            excluded_changes = [*excluded_changes,
+                                *(change for change in included_changes
+                                  if change.id_ in copies)]
+            included_changes = [change for change in included_changes
+                                if change.id_ not in copies]
+            self.rootapp.messages.info(
+                            self.rootapp.messages.duplicates_found,
+                            len(copies), sum(group.size * len(group.copies)
+                                             for group in duplicates))
+
         modecheck = set(['exclude', 'exclude_from', 'include', 'include_from',
                          'files_from', 'checksum', 'checksum_from']) & \
             set(key for key, value in vars(pargs.namespace).items()
@@ -530,25 +1581,62 @@ class TransferCommand:
                                 self.rootapp.messages.transfer_ambiguous_mode)
             return False
 
-        if mode in ('checksum', 'checksum_from'):
-            transferargs = self.rootapp.cliargs.filter_whitelist(groups=(
-                                'shared', 'transfer-only',
-                                'experimental', 'safe'))
+        # rsync does not descend into excluded directories, so their included
+        # descendants would be silently skipped; the files-from mode lists
+        # each path explicitly, implying the directories
+        if mode != 'files_from':
+            hidden = HiddenChanges(self.rootapp.pending_changes)
+            if hidden:
+                self.rootapp.messages.error(
+                            self.rootapp.messages.transfer_hidden_changes,
+                            len(hidden.changes))
+                return False
+
+        if len(self.rootapp.destinations) > 1:
+            return self._fan_out(mode, included_changes, excluded_changes,
+                                 pargs)
+
+        batch = None
+        if self.rootapp.batch is not None and not pargs.namespace.no_batch \
+                and mode != 'files_from':
+            # Receiver-side filter rules cannot be relied upon to skip the
+            # files recorded in the batch, so it is only used when everything
+            # is included
+            if excluded_changes:
+                self.rootapp.messages.info(
+                                        self.rootapp.messages.batch_excluded)
+            elif not self.rootapp.batch.is_valid(
+                                    change.sfilename for change
+                                    in self.rootapp.pending_changes):
+                self.rootapp.messages.info(
+                                        self.rootapp.messages.batch_changed)
+            else:
+                batch = self.rootapp.batch
+
+        if batch is not None:
+            # The batch file already contains the file list and the data, so
+            # rsync only needs the destination
+            targs = [*self.rootapp.rsync, *batch.transfer_args(),
+                     *self.rootapp.filter_rsync_args(
+                            groups=('shared', 'transfer-only', 'checksum',
+                                    'experimental', 'safe'),
+                            exclude=('locations', )),
+                     self.rootapp.destination.string]
+            file = None
         else:
-            transferargs = self.rootapp.cliargs.filter_whitelist(groups=(
-                                'shared', 'transfer-only', 'checksum',
-                                'experimental', 'safe'))
+            if mode in ('checksum', 'checksum_from'):
+                transferargs = self.rootapp.filter_rsync_args(groups=(
+                                    'shared', 'transfer-only',
+                                    'experimental', 'safe'))
+            else:
+                transferargs = self.rootapp.filter_rsync_args(groups=(
+                                    'shared', 'transfer-only', 'checksum',
+                                    'experimental', 'safe'))
 
-        # TODO #17
-        targs, file = {
-            'exclude': self._exclude,
-            'exclude_from': self._exclude_from,
-            'include': self._include,
-            'include_from': self._include_from,
-            'files_from': self._files_from,
-            'checksum': self._checksum,
-            'checksum_from': self._checksum_from,
-        }[mode](included_changes, excluded_changes, pargs, transferargs)
+            # TODO #17
+            targs, file = self._build(mode)(included_changes,
+                                            excluded_changes, pargs,
+                                            transferargs)
 
         if pargs.namespace.dry_run:
             targs.append('--dry-run')
@@ -558,26 +1646,301 @@ class TransferCommand:
             if file and not pargs.namespace.keep_list:
                 _m_os.remove(file)
         else:
+            sendings = [change for change in included_changes
+                        if change.operation != 'del.']
+            if self.rootapp.cliargs.namespace.metrics_file is not None:
+                self.rootapp.details_fetcher.fetch(sendings, ('length', ))
+            self.rootapp.metrics.record_changes(
+                                        self.rootapp.rollups.groups('op'))
+
+            journal = None
+            if batch is None and not pargs.namespace.dry_run and \
+                    self.rootapp.cliargs.namespace.log_file is None:
+                journal = TransferJournal(self.DEFAULT_JOURNAL_FILE)
+                journal.start(self.rootapp.cliargs.namespace.locations,
+                              included_changes)
+                targs.extend(('--log-file=' + journal.begin_attempt(),
+                              '--log-file-format=' + LOG_FORMAT))
+
             # Pressing Ctrl+c should normally terminate both rsync and syncere
             # TODO #18
-            call = _m_subprocess.Popen(targs)
+            start = _m_time.monotonic()
+            call = self.rootapp.popen('transfer', targs)
             call.wait()
+            self.rootapp.metrics.record_transfer(
+                            _m_time.monotonic() - start,
+                            sum(change_bytes(change) for change in sendings),
+                            call.returncode)
+
+            if duplicates and call.returncode == 0 and \
+                    not pargs.namespace.dry_run:
+                failed = finder.materialize(duplicates)
+                if failed:
+                    self.rootapp.messages.error(
+                                    self.rootapp.messages.duplicates_failed,
+                                    *(change.sfilename for change in failed))
+                else:
+                    self.rootapp.messages.info(
+                                    self.rootapp.messages.duplicates_created,
+                                    len(copies))
 
             if file and not pargs.namespace.keep_list:
                 _m_os.remove(file)
 
             self.rootapp.clear_preview()
 
+            if journal is not None:
+                journal.end_attempt(call.returncode)
+                if call.returncode == 0:
+                    journal.discard()
+
             if call.returncode != 0:
                 self.rootapp.messages.error(
                             self.rootapp.messages.rsync_error, call.returncode)
+                if journal is not None:
+                    self.rootapp.messages.info(
+                        self.rootapp.messages.transfer_resumable,
+                        len(journal.remaining(int(
+                            self.rootapp.configuration['resume-overlap']))))
                 if pargs.namespace.quit:
                     _m_sys.exit(call.returncode)
             elif pargs.namespace.quit:
                 self.menu.break_loops(True)
 
+    def _resume(self, pargs):
+        journal = TransferJournal(self.DEFAULT_JOURNAL_FILE)
+        try:
+            journal.load()
+        except FileNotFoundError:
+            self.rootapp.messages.error(
+                                self.rootapp.messages.transfer_resume_none)
+            return False
+        except (OSError, ValueError) as exc:
+            self.rootapp.messages.error(
+                                journal.path,
+                                self.rootapp.messages.file_cannot_be_read,
+                                getattr(exc, 'strerror', None) or exc)
+            return False
+        if journal.locations != self.rootapp.cliargs.namespace.locations:
+            self.rootapp.messages.error(
+                            self.rootapp.messages.transfer_resume_locations,
+                            *journal.locations)
+            return False
+
+        transferargs = self.rootapp.filter_rsync_args(
+                            groups=('shared', 'transfer-only', 'checksum',
+                                    'experimental', 'safe'),
+                            exclude=('files_from', ))
+        namespace = self.rootapp.cliargs.namespace
+        if not namespace.partial and namespace.partial_dir is None:
+            # Keep the partially transferred files, so that rsync can
+            # continue them
+            transferargs.append('--partial')
+        overlap = int(self.rootapp.configuration['resume-overlap'])
+        retries = int(self.rootapp.configuration['resume-retries'])
+        delay = float(self.rootapp.configuration['resume-backoff'])
+        file = self.DEFAULT_FILES_FROM_FILE
+
+        for retry in range(retries + 1):
+            remaining = journal.remaining(overlap)
+            if not remaining:
+                break
+            if retry > 0:
+                self.rootapp.messages.info(
+                                self.rootapp.messages.transfer_resume_retry,
+                                delay)
+                _m_time.sleep(delay)
+                delay *= 2
+
+            try:
+                filefrom = open(file, 'w')
+            except OSError as exc:
+                self.rootapp.messages.error(
+                                file,
+                                self.rootapp.messages.file_cannot_be_written,
+                                exc.strerror)
+                return False
+            with filefrom:
+                for sfilename, operation in remaining:
+                    filefrom.write(sfilename + '\n')
+
+            # Do not recurse into the listed directories, whose other content
+            # was either excluded or already transferred, also if -r or -a
+            # are given; the deletions are listed too, and made with
+            # --delete-missing-args
+            targs = [*self.rootapp.rsync, '--files-from', file,
+                     *transferargs, '--no-recursive', '--dirs']
+            if any(operation == 'del.' for sfilename, operation in remaining):
+                targs.insert(len(self.rootapp.rsync), '--delete-missing-args')
+            if pargs.namespace.dry_run:
+                # Nothing is transferred, so the journal is left untouched,
+                # and the transfer can still be resumed
+                targs.append('--dry-run')
+            else:
+                targs.extend(('--log-file=' + journal.log_path(
+                                                len(journal.attempts) + 1),
+                              '--log-file-format=' + LOG_FORMAT))
+            if pargs.namespace.view_only:
+                print(' '.join(targs))
+                if not pargs.namespace.keep_list:
+                    _m_os.remove(file)
+                return
+            if pargs.namespace.dry_run:
+                # Pressing Ctrl+c should normally terminate both rsync and
+                # syncere
+                call = self.rootapp.popen('transfer', targs)
+                call.wait()
+                if not pargs.namespace.keep_list:
+                    _m_os.remove(file)
+                if call.returncode != 0:
+                    self.rootapp.messages.error(
+                                        self.rootapp.messages.rsync_error,
+                                        call.returncode)
+                    if pargs.namespace.quit:
+                        _m_sys.exit(call.returncode)
+                    return False
+                return
+
+            journal.begin_attempt()
+            # Pressing Ctrl+c should normally terminate both rsync and syncere
+            call = self.rootapp.popen('transfer', targs)
+            call.wait()
+            journal.end_attempt(call.returncode)
+            if not pargs.namespace.keep_list:
+                _m_os.remove(file)
+
+        remaining = journal.remaining(overlap)
+        if remaining:
+            self.rootapp.messages.error(self.rootapp.messages.rsync_error,
+                                        call.returncode)
+            self.rootapp.messages.info(
+                                    self.rootapp.messages.transfer_resumable,
+                                    len(remaining))
+            if pargs.namespace.quit:
+                _m_sys.exit(call.returncode)
+            return False
+
+        journal.discard()
+        if pargs.namespace.quit:
+            self.menu.break_loops(True)
+
+    def _find_duplicates(self, included_changes):
+        """
+        Return the DuplicateFinder and the duplicates among the included
+        changes, or (False, None) if the configured mode is not valid.
+        """
+        mode = self.rootapp.configuration['transfer-duplicates']
+        if not mode:
+            return (None, [])
+        if mode not in DUPLICATE_MODES:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.duplicates_bad_mode,
+                                    mode)
+            return (False, None)
+        destination = self.rootapp.destination
+        if len(self.rootapp.sources) > 1 or \
+                len(self.rootapp.destinations) > 1 or destination.daemon:
+            return (None, [])
+
+        candidates = [change for change in included_changes
+                      if change.ichange.startswith('>f+')]
+        # The files are grouped by their attributes
+        self.rootapp.details_fetcher.fetch(candidates)
+        finder = DuplicateFinder(self.rootapp.sources[0], destination,
+                                 self.rootapp.remote_shell(), mode)
+        return (finder, finder.find(candidates))
+
+    def _build(self, mode):
+        return {
+            'exclude': self._exclude,
+            'exclude_from': self._exclude_from,
+            'include': self._include,
+            'include_from': self._include_from,
+            'files_from': self._files_from,
+            'checksum': self._checksum,
+            'checksum_from': self._checksum_from,
+        }[mode]
+
+    def _fan_out(self, mode, included_changes, excluded_changes, pargs):
+        """
+        Transfer the decided changes to all the destinations concurrently,
+        each with its own rsync command.
+        """
+        if mode in ('checksum', 'checksum_from'):
+            groups = ('shared', 'transfer-only', 'experimental', 'safe')
+        else:
+            groups = ('shared', 'transfer-only', 'checksum', 'experimental',
+                      'safe')
+        transferargs = self.rootapp.filter_rsync_args(groups=groups,
+                                                      exclude=('locations', ))
+        sources = [source.string for source in self.rootapp.sources]
+
+        jobs = []
+        for index, destination in enumerate(self.rootapp.destinations):
+            included = [change for change in included_changes
+                        if index in change.destinations]
+            if not included:
+                self.rootapp.messages.info(
+                                    self.rootapp.messages.fan_out_nothing,
+                                    destination.string)
+                continue
+            excluded = [change for change in excluded_changes
+                        if index in change.destinations]
+            # The lists of the destinations must not overwrite each other
+            targs, file = self._build(mode)(included, excluded, pargs,
+                                            [*transferargs, *sources,
+                                             destination.string],
+                                            suffix='.{}'.format(index + 1))
+            if pargs.namespace.dry_run:
+                targs.append('--dry-run')
+            jobs.append((destination, targs, file))
+
+        if pargs.namespace.view_only:
+            for destination, targs, file in jobs:
+                print(' '.join(targs))
+                if file and not pargs.namespace.keep_list:
+                    _m_os.remove(file)
+            return
+
+        sendings = [change for change in included_changes
+                    if change.operation != 'del.']
+        if self.rootapp.cliargs.namespace.metrics_file is not None:
+            self.rootapp.details_fetcher.fetch(sendings, ('length', ))
+        self.rootapp.metrics.record_changes(self.rootapp.rollups.groups('op'))
+
+        workers = int(self.rootapp.configuration['fan-out-workers'])
+        start = _m_time.monotonic()
+        # Pressing Ctrl+c should normally terminate both rsync and syncere
+        with _m_futures.ThreadPoolExecutor(
+                            max_workers=workers or len(jobs) or 1) as pool:
+            returncodes = list(pool.map(
+                        lambda job: self.rootapp.popen('transfer',
+                                                       job[1]).wait(), jobs))
+        failed = [returncode for returncode in returncodes if returncode != 0]
+        self.rootapp.metrics.record_transfer(
+                    _m_time.monotonic() - start,
+                    sum(change_bytes(change) * len(change.destinations)
+                        for change in sendings),
+                    failed[0] if failed else 0)
+
+        for (destination, targs, file), returncode in zip(jobs, returncodes):
+            if file and not pargs.namespace.keep_list:
+                _m_os.remove(file)
+            self.rootapp.messages.info(self.rootapp.messages.fan_out_result,
+                                       destination.string, returncode)
+
+        self.rootapp.clear_preview()
+
+        if failed:
+            self.rootapp.messages.error(self.rootapp.messages.rsync_error,
+                                        *failed)
+            if pargs.namespace.quit:
+                _m_sys.exit(failed[0])
+        elif pargs.namespace.quit:
+            self.menu.break_loops(True)
+
     def _exclude(self, included_changes, excluded_changes, pargs,
-                 transferargs):
+                 transferargs, suffix=''):
         # TODO #24
 
         # Note that Popen already does all the necessary escaping on the
@@ -589,10 +1952,10 @@ class TransferCommand:
         # Prepend, not append, excludes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', *excludes, *transferargs], None)
+        return ([*self.rootapp.rsync, *excludes, *transferargs], None)
 
     def _exclude_from(self, included_changes, excluded_changes, pargs,
-                      transferargs):
+                      transferargs, suffix=''):
         # Don't define a default file name in the const argument of the
         # --exclude-from option, e.g. const='./exclude-from', and then read it
         # here from there, because this method can also be executed when the
@@ -600,7 +1963,7 @@ class TransferCommand:
         # options, and max-inline-filters is exceeded, which would leave the
         # value of the option as None
         # TODO #23
-        file = self.DEFAULT_EXCLUDE_FROM_FILE
+        file = self.DEFAULT_EXCLUDE_FROM_FILE + suffix
 
         try:
             # Use 'w' instead of 'a' to make sure the file is empty
@@ -618,11 +1981,11 @@ class TransferCommand:
         # Prepend, not append, excludes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', '--exclude-from', file, *transferargs],
+        return ([*self.rootapp.rsync, '--exclude-from', file, *transferargs],
                 file)
 
     def _include(self, included_changes, excluded_changes, pargs,
-                 transferargs):
+                 transferargs, suffix=''):
         # TODO #24
 
         # Note that Popen already does all the necessary escaping on the
@@ -634,10 +1997,11 @@ class TransferCommand:
         # Prepend, not append, includes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', *includes, '--exclude', '*', *transferargs], None)
+        return ([*self.rootapp.rsync, *includes, '--exclude', '*',
+                 *transferargs], None)
 
     def _include_from(self, included_changes, excluded_changes, pargs,
-                      transferargs):
+                      transferargs, suffix=''):
         # Don't define a default file name in the const argument of the
         # --exclude-from option, e.g. const='./exclude-from', and then read it
         # here from there, because this method can also be executed when the
@@ -645,7 +2009,7 @@ class TransferCommand:
         # options, and max-inline-filters is exceeded, which would leave the
         # value of the option as None
         # TODO #23
-        file = self.DEFAULT_INCLUDE_FROM_FILE
+        file = self.DEFAULT_INCLUDE_FROM_FILE + suffix
 
         try:
             # Use 'w' instead of 'a' to make sure the file is empty
@@ -663,11 +2027,11 @@ class TransferCommand:
         # Prepend, not append, includes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', '--include-from', file, '--exclude', '*',
+        return ([*self.rootapp.rsync, '--include-from', file, '--exclude', '*',
                  *transferargs], file)
 
     def _files_from(self, included_changes, excluded_changes, pargs,
-                    transferargs):
+                    transferargs, suffix=''):
         # Don't define a default file name in the const argument of the
         # --exclude-from option, e.g. const='./exclude-from', and then read it
         # here from there, because this method can also be executed when the
@@ -675,7 +2039,7 @@ class TransferCommand:
         # options, and max-inline-filters is exceeded, which would leave the
         # value of the option as None
         # TODO #23
-        file = self.DEFAULT_FILES_FROM_FILE
+        file = self.DEFAULT_FILES_FROM_FILE + suffix
 
         try:
             # Use 'w' instead of 'a' to make sure the file is empty
@@ -690,10 +2054,11 @@ class TransferCommand:
                 for change in included_changes:
                     filefrom.write(change.sfilename + '\n')
 
-        return (['rsync', '--files-from', file, *transferargs], file)
+        return ([*self.rootapp.rsync, '--files-from', file, *transferargs],
+                file)
 
     def _checksum(self, included_changes, excluded_changes, pargs,
-                  transferargs):
+                  transferargs, suffix=''):
         # TODO #24
 
         # Note that Popen already does all the necessary escaping on the
@@ -705,11 +2070,11 @@ class TransferCommand:
         # Prepend, not append, includes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', *includes, '--exclude', '*', *transferargs,
-                 '--ignore-times'], None)
+        return ([*self.rootapp.rsync, *includes, '--exclude', '*',
+                 *transferargs, '--ignore-times'], None)
 
     def _checksum_from(self, included_changes, excluded_changes, pargs,
-                       transferargs):
+                       transferargs, suffix=''):
         # Don't define a default file name in the const argument of the
         # --exclude-from option, e.g. const='./exclude-from', and then read it
         # here from there, because this method can also be executed when the
@@ -717,7 +2082,7 @@ class TransferCommand:
         # options, and max-inline-filters is exceeded, which would leave the
         # value of the option as None
         # TODO #23
-        file = self.DEFAULT_INCLUDE_FROM_FILE
+        file = self.DEFAULT_INCLUDE_FROM_FILE + suffix
 
         try:
             # Use 'w' instead of 'a' to make sure the file is empty
@@ -735,11 +2100,25 @@ class TransferCommand:
         # Prepend, not append, includes, since the original rsync command
         # may have other include/exclude/filter rules, and rsync stops at
         # the first match that it finds
-        return (['rsync', '--include-from', file, '--exclude', '*',
+        return ([*self.rootapp.rsync, '--include-from', file, '--exclude', '*',
                  *transferargs, '--ignore-times'], file)
 
 
 class MainMenu:
+    DESTINATION_MARKS = '123456789'
+    # The options that make rsync delete files
+    DELETE_DESTS = ('delete', 'delete_before', 'delete_during',
+                    'delete_delay', 'delete_after', 'delete_excluded',
+                    'delete_missing_args', 'remove_source_files')
+    # Sort key, reverse, details needed
+    SORT_KEYS = {
+        'size': (change_bytes, True, ('length', )),
+        'time': (lambda change: change.tstamp or '', True, ('tstamp', )),
+        'path': (lambda change: change.sfilename, False, ()),
+        'op': (lambda change: (change.operation, change.sfilename), False,
+               ()),
+    }
+
     def __init__(self, rootapp, test):
         """
         Type 'help <command>' for more information.
@@ -761,21 +2140,35 @@ class MainMenu:
 
         _m_cmenu.Action(self.menu, 'preview', self.preview,
                         accepted_flags=['quit'])
-        _m_cmenu.RunScript(self.menu, 'import', helpfull=self.import_)
-        _m_cmenu.Action(self.menu, 'list', self.list_)
+        _m_cmenu.Action(self.menu, 'import', self.import_)
+        _m_cmenu.Action(self.menu, 'import-decisions', self.import_decisions)
+        FilterAction(self.menu, 'export', self.export, rootapp)
+        FilterAction(self.menu, 'list', self.list_, rootapp)
         ConfigMenu(self.menu, 'config', self.menu, rootapp)
-        _m_cmenu.Action(self.menu, 'include', self.include)
+        FilterAction(self.menu, 'include', self.include, rootapp)
         # Don't use an Alias because this shouldn't be editable
-        _m_cmenu.Action(self.menu, Messages.ICON_CHANGE_INCLUDED, self.include,
-                        helpshort='Built-in alias for <include>')
-        _m_cmenu.Action(self.menu, 'exclude', self.exclude)
+        FilterAction(self.menu, Messages.ICON_CHANGE_INCLUDED, self.include,
+                     rootapp, helpshort='Built-in alias for <include>')
+        FilterAction(self.menu, 'exclude', self.exclude, rootapp)
         # Don't use an Alias because this shouldn't be editable
-        _m_cmenu.Action(self.menu, Messages.ICON_CHANGE_EXCLUDED, self.exclude,
-                        helpshort='Built-in alias for <exclude>')
-        _m_cmenu.Action(self.menu, 'reset', self.reset)
+        FilterAction(self.menu, Messages.ICON_CHANGE_EXCLUDED, self.exclude,
+                     rootapp, helpshort='Built-in alias for <exclude>')
+        FilterAction(self.menu, 'reset', self.reset, rootapp)
         # Don't use an Alias because this shouldn't be editable
-        _m_cmenu.Action(self.menu, Messages.ICON_CHANGE_UNDECIDED, self.reset,
-                        helpshort='Built-in alias for <reset>')
+        FilterAction(self.menu, Messages.ICON_CHANGE_UNDECIDED, self.reset,
+                     rootapp, helpshort='Built-in alias for <reset>')
+        # The commands that are coalesced by run_script, also when invoked
+        # through their built-in aliases or an unambiguous prefix
+        self.decision_methods = {self.include: True, self.exclude: False,
+                                 self.reset: None}
+        # The rules of the decision commands not applied yet
+        self.pending_rules = []
+        _m_cmenu.Action(self.menu, 'ancestors', self.ancestors)
+        _m_cmenu.Action(self.menu, 'moves', self.moves)
+        _m_cmenu.Action(self.menu, 'undo', self.undo)
+        _m_cmenu.Action(self.menu, 'redo', self.redo)
+        _m_cmenu.Action(self.menu, 'checkpoint', self.checkpoint)
+        _m_cmenu.Action(self.menu, 'watch', self.watch)
         _m_cmenu.Action(self.menu, 'transfer', self.transfer.execute)
         if test:
             _m_cmenu.ResumeTest(self.menu, 'resume-test',
@@ -786,11 +2179,33 @@ class MainMenu:
         self.list_parser = _m_forwarg.ArgumentParser()
         group = self.list_parser.add_argument_group('list-specific')
         group.add_argument('-d', '--details', action='store_true')
+        group.add_argument('--sort')
+        group.add_argument('--group-by')
         self.change_filter.add_filter_parser_arguments(self.list_parser)
 
         self.include_parser = _m_forwarg.ArgumentParser()
         self.change_filter.add_filter_parser_arguments(self.include_parser)
 
+        self.export_parser = _m_forwarg.ArgumentParser()
+        group = self.export_parser.add_argument_group('export-specific')
+        group.add_argument('--format')
+        self.change_filter.add_filter_parser_arguments(self.export_parser)
+
+        self.import_decisions_parser = _m_forwarg.ArgumentParser()
+        self.import_decisions_parser.add_argument('file')
+        self.import_decisions_parser.add_argument('--format')
+
+        self.checkpoint_parser = _m_forwarg.ArgumentParser()
+        self.checkpoint_parser.add_argument('name', nargs='?')
+        self.checkpoint_parser.add_argument('-r', '--restore',
+                                            action='store_true')
+        self.checkpoint_parser.add_argument('-d', '--delete',
+                                            action='store_true')
+
+        self.watch_parser = _m_forwarg.ArgumentParser()
+        self.watch_parser.add_argument('--once', action='store_true')
+        self.watch_parser.add_argument('--debounce')
+
     def preview(self, *args):
         """
         Launch the preview rsync command.
@@ -798,6 +2213,17 @@ class MainMenu:
         Create or refresh the list of pending changes.
         If a 'quit' argument is given, syncere will quit if no changes are
         found.
+
+        A refresh keeps the decisions of the changes that have not been
+        altered since the previous preview; the new and altered changes can
+        be selected with '-m new' and '-m altered'.
+
+        If the 'prefetch-delay' configuration option is set, the next preview
+        is run in the background that many seconds after each preview, and
+        then again every that many seconds if it is not 0; the preview command
+        then swaps in the latest result instead of running rsync, waiting for
+        the background preview if it is still running. The prefetched
+        previews do not record a batch file.
         """
         quit = False
         if len(args) == 1 and args[0] == 'quit':
@@ -809,93 +2235,489 @@ class MainMenu:
 
         # If experimental is disabled and some of its options have been
         # specified, the program has already exited in _check_arguments
-        previewargs = self.rootapp.cliargs.filter_whitelist(groups=(
+        previewargs = self.rootapp.filter_rsync_args(groups=(
                                 'shared', 'checksum', 'experimental', 'safe'))
 
-        # Pressing Ctrl+c should normally terminate both rsync and syncere
-        call = _m_subprocess.Popen(['rsync', *previewargs,
-                                    '--dry-run',
-                                    '--info={}'.format(
-                                                    self.rootapp.configuration[
-                                                        'preview-info-flags']),
-                                    '--out-format='
-                                    '{syncere}%i '  # itemized changes
-                                    '%o '  # operation
-                                    '%B '  # permissions
-                                    '%U '  # uid
-                                    '%G '  # gid
-                                    '%l '  # length (bytes)
-                                    '{//}%M'  # last mod timestamp
-                                    '{//}%f'  # filename (long)
-                                    '{//}%n'  # filename (short)
-                                    '{//}%L'  # link string
-                                    '{//}%C'  # md5
-                                    '{/syncere}'],
-                                   stdout=_m_subprocess.PIPE,
-                                   universal_newlines=True)
-
-        # Popen.communicate already waits for the process to terminate, there's
-        # no need to call wait
-        # According to the docs, Popen.communicate reads from stdout and
-        # buffers the data in memory, so there shouldn't be problems with long
-        # rsync outputs
-        # TODO #12 #22
-        self.stdout = call.communicate()[0]
-
-        if call.returncode != 0:
-            _m_sys.exit(call.returncode)
-
-        self.rootapp.pending_changes.clear()
-
-        for ln, line in enumerate(self.stdout.splitlines()):
-            if line[:9] == '{syncere}':
-                match = _m_re.match('\{syncere}(.{11}) '
-                                    '(send|recv|del\.) '
-                                    # TODO #42: test if %B shows ACLs like
-                                    #           ls -l
-                                    '(.+?) '
-                                    '([0-9]+) '
-                                    '([0-9]+|DEFAULT) '
-                                    '([0-9]+) '
-                                    '\{//\}(.+?)'
-                                    '\{//\}(.+?)'
-                                    '\{//\}(.+?)'
-                                    '\{//\}(.*?)'
-                                    '\{//\}([0-9a-fA-F]{32}| {32})'
-                                    '\{/syncere\}',
-                                    line)
-
-                if match:
-                    self.rootapp.pending_changes.append(Change(
-                                        len(self.rootapp.pending_changes) + 1,
-                                        *match.groups()))
-                else:
-                    raise exceptions.UnrecognizedItemizedChangeError(line)
-            else:
-                # TODO #28: Allow suppressing these lines
+        profile = self.rootapp.configuration['preview-profile']
+        if profile not in parsing.PROFILES:
+            self.rootapp.messages.error(
+                                self.rootapp.messages.preview_bad_profile,
+                                profile)
+            return False
+
+        self.rootapp.discard_batch()
+        # The prefetched preview must have been run with the same arguments
+        key = (profile, tuple(previewargs))
+        prefetched = self.rootapp.prefetcher.take(key)
+        if prefetched is not None:
+            for line in prefetched.others:
                 print(line)
+            self.rootapp.messages.info(
+                                self.rootapp.messages.preview_prefetched,
+                                round(_m_time.monotonic() -
+                                      prefetched.finished, 1))
+            changes = prefetched.changes
+        else:
+            if self.rootapp.batch_possible():
+                # --only-write-batch does not modify the destination either,
+                # but it also records the data for the transfer command
+                self.rootapp.batch = PreviewBatch((*self.rootapp.sources,
+                                                   self.rootapp.destination))
+                dryargs = self.rootapp.batch.preview_args()
+            else:
+                dryargs = ['--dry-run']
+            changes, returncode = self._scan(previewargs, dryargs, profile)
+            if returncode != 0:
+                _m_sys.exit(returncode)
+            if self.rootapp.batch is not None:
+                self.rootapp.batch.record(change.sfilename
+                                          for change in changes)
+
+        if self.rootapp.preview_needed or not self.rootapp.pending_changes:
+            self.rootapp.load_preview(changes, profile)
+        else:
+            self.rootapp.messages.info(
+                                    self.rootapp.messages.preview_refreshed,
+                                    *self.rootapp.refresh_preview(changes,
+                                                                  profile))
 
-        self.rootapp.preview_needed = False
+        delay = self.rootapp.configuration['prefetch-delay']
+        if delay:
+            self.rootapp.prefetcher.start(
+                            lambda: self._prefetch(previewargs, profile),
+                            float(delay), key)
 
         if not self.rootapp.pending_changes:
             self.rootapp.messages.info(self.rootapp.messages.nothing_to_do)
             if quit:
                 self.menu.break_loops(True)
 
+    def _scan(self, previewargs, dryargs, profile, others=None, quiet=False):
+        if len(self.rootapp.destinations) > 1:
+            return self._fan_out_preview(dryargs, profile, others, quiet)
+        # Also in the prefetcher's thread: a staging store has its own table,
+        # and shares the lock of the pending changes' database connection
+        return self._run_preview([*previewargs, *dryargs], profile,
+                                 others=others,
+                                 changes=self.rootapp.new_changes(),
+                                 quiet=quiet)
+
+    def _prefetch(self, previewargs, profile):
+        # Executed in the prefetcher's thread, so nothing is printed
+        others = []
+        changes, returncode = self._scan(previewargs, ['--dry-run'], profile,
+                                         others, quiet=True)
+        return (changes, returncode, others)
+
+    def _run_preview(self, args, profile, files=None, others=None,
+                     changes=None, quiet=False):
+        """
+        Run an internal rsync command that reports the pending changes with
+        the --out-format of the given preview profile.
+
+        If files is not None, it is written to rsync's standard input, for
+        example for --files-from=-. If others is not None, the lines of the
+        output that are not changes are appended to it instead of being
+        printed. If changes is not None, the changes are appended to it, e.g.
+        a ChangeStore, instead of a new list. If quiet, the resource limits
+        are not reported.
+
+        Return a tuple with the list of changes and rsync's return code.
+        """
+        # Pressing Ctrl+c should normally terminate both rsync and syncere
+        start = _m_time.monotonic()
+        call = self.rootapp.popen('preview', [
+                                *self.rootapp.rsync, *args,
+                                '--info={}'.format(self.rootapp.configuration[
+                                                        'preview-info-flags']),
+                                '--out-format=' +
+                                parsing.PROFILES[profile].out_format],
+                                  stdin=None if files is None
+                                  else _m_subprocess.PIPE,
+                                  stdout=_m_subprocess.PIPE,
+                                  universal_newlines=True, quiet=quiet)
+
+        workers = int(self.rootapp.configuration['preview-parse-workers'])
+        if workers > 0 and files is None:
+            # Parse the output while rsync is still producing it; reading the
+            # pipe continuously also avoids the deadlock problems
+            parser = parsing.ParallelParser(workers, profile)
+            changes = self._merge_preview(parser.parse(call.stdout), profile,
+                                          others, changes)
+            call.wait()
+        else:
+            # Popen.communicate already waits for the process to terminate,
+            # there's no need to call wait
+            # According to the docs, Popen.communicate reads from stdout and
+            # buffers the data in memory, so there shouldn't be problems with
+            # long rsync outputs
+            # TODO #12 #22
+            stdout = call.communicate(files)[0]
+            changes = self._merge_preview(
+                        (parsing.parse_chunk(stdout, profile), ), profile,
+                        others, changes)
+
+        self.rootapp.metrics.record_preview(_m_time.monotonic() - start,
+                                            call.returncode)
+        return (changes, call.returncode)
+
+    def _fan_out_preview(self, dryargs, profile, others=None, quiet=False):
+        """
+        Preview the transfer to each destination concurrently, and merge the
+        changes by path, recording the destinations that each one affects.
+        """
+        previewargs = self.rootapp.filter_rsync_args(
+                            groups=('shared', 'checksum', 'experimental',
+                                    'safe'),
+                            exclude=('locations', ))
+        sources = [source.string for source in self.rootapp.sources]
+        destinations = self.rootapp.destinations
+        workers = int(self.rootapp.configuration['fan-out-workers'])
+
+        with _m_futures.ThreadPoolExecutor(
+                        max_workers=workers or len(destinations)) as pool:
+            results = list(pool.map(
+                lambda destination: self._run_preview(
+                                    [*previewargs, *dryargs, *sources,
+                                     destination.string], profile,
+                                    others=others, quiet=quiet),
+                destinations))
+
+        for changes, returncode in results:
+            if returncode != 0:
+                return (None, returncode)
+
+        # The changes of a path are merged only for the destinations that
+        # they affect in the same way: otherwise each keeps its own itemized
+        # change and details, which the filters and the transfers of its
+        # destinations use, and can have its own decision
+        signature = _m_operator.attrgetter(*parsing.PROFILES[profile].fields)
+        byname = {}
+        for index, (changes, returncode) in enumerate(results):
+            for change in changes:
+                variants = byname.setdefault(change.sfilename, [])
+                for variant in variants:
+                    if signature(variant) == signature(change):
+                        variant.destinations += (index, )
+                        break
+                else:
+                    change.destinations = (index, )
+                    variants.append(change)
+
+        changes = [change for variants in byname.values()
+                   for change in variants]
+        for id_, change in enumerate(changes, start=1):
+            change.id_ = id_
+        return (changes, 0)
+
+    def watch(self, *args):
+        """
+        Keep the pending changes up to date while the sources are modified.
+
+        Syntax: watch [--once] [--debounce SECONDS]
+
+        The local sources are watched with inotify; the modifications are
+        collected until none happen for the debounce time (the
+        'watch-debounce' configuration option by default), and then only the
+        modified paths are previewed again. The decisions of the changes that
+        are still the same are kept, the other changes are reset, and the
+        numbers of the changes are reassigned.
+        A full preview is executed instead if some events were lost, the
+        inotify watch limit was reached, or some files were removed while
+        rsync is deleting extraneous files from the destination.
+        Press Ctrl+c to stop watching, or pass --once to stop after the first
+        update.
+        """
+        try:
+            wargs = self.watch_parser.parse_args(args)
+            debounce = float(wargs.namespace.debounce or
+                             self.rootapp.configuration['watch-debounce'])
+        except (_m_forwarg.ForwargError, ValueError):
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+
+        if self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return False
+
+        if not all(source.local for source in self.rootapp.sources):
+            self.rootapp.messages.error(self.rootapp.messages.watch_remote)
+            return False
+
+        if len(self.rootapp.destinations) > 1:
+            self.rootapp.messages.error(self.rootapp.messages.watch_fan_out)
+            return False
+
+        profile = self.rootapp.configuration['preview-profile']
+        if profile not in parsing.PROFILES:
+            self.rootapp.messages.error(
+                                self.rootapp.messages.preview_bad_profile,
+                                profile)
+            return False
+
+        watcher = TreeWatcher(self.rootapp.sources)
+        try:
+            watcher.open()
+        except OSError as exc:
+            self.rootapp.messages.error(
+                            self.rootapp.messages.watch_unavailable, exc)
+            return False
+
+        self.rootapp.messages.info(self.rootapp.messages.watch_started)
+        try:
+            while True:
+                dirty = watcher.wait(debounce)
+                if not dirty:
+                    continue
+                if self._update_preview(dirty, profile) is False or \
+                        wargs.namespace.once:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def _update_preview(self, dirty, profile):
+        namespace = vars(self.rootapp.cliargs.namespace)
+        deleting = any(namespace[dest] for dest in self.DELETE_DESTS)
+
+        if dirty.overflow or (dirty.removals and deleting):
+            # --files-from cannot report the deletions caused by the removed
+            # files, and lost events may hide any change
+            changes, returncode = self._run_preview(
+                            [*self.rootapp.filter_rsync_args(groups=(
+                                'shared', 'checksum', 'experimental', 'safe')),
+                             '--dry-run'],
+                            profile)
+
+            def covers(path):
+                return True
+        else:
+            changes, returncode = self._preview_paths(dirty.paths, profile)
+            covers = dirty.covers
+
+        if returncode != 0:
+            self.rootapp.messages.error(self.rootapp.messages.rsync_error,
+                                        returncode)
+            return False
+
+        self.rootapp.messages.info(self.rootapp.messages.watch_updated,
+                                   *self.rootapp.merge_preview(
+                                                changes, covers, profile))
+
+    def _preview_paths(self, paths, profile):
+        """
+        Preview only the given (source index, path) pairs, returning the
+        changes and the rsync return code.
+        """
+        # They are read once for each source
+        paths = list(paths)
+        previewargs = self.rootapp.filter_rsync_args(
+                        groups=('shared', 'checksum', 'experimental', 'safe'),
+                        exclude=('locations', 'files_from', 'write_batch',
+                                 'only_write_batch', 'read_batch'))
+        changes = []
+        returncode = 0
+        for index, source in enumerate(self.rootapp.sources):
+            spaths = sorted(path for sindex, path in paths if sindex == index)
+            if not spaths:
+                continue
+            root = source.root
+            if not root.endswith('/'):
+                root += '/'
+            # --files-from does not recurse into the listed directories unless
+            # -r is explicitly given, so make sure that it is disabled
+            schanges, returncode = self._run_preview(
+                            [*previewargs, '--dry-run', '--no-recursive',
+                             '--dirs', '--ignore-missing-args',
+                             '--files-from=-', root,
+                             self.rootapp.destination.string],
+                            profile, files='\n'.join(spaths) + '\n')
+            if returncode != 0:
+                break
+            changes.extend(schanges)
+        return (changes, returncode)
+
+    @staticmethod
+    def _merge_preview(results, profile, others=None, changes=None):
+        if changes is None:
+            changes = []
+        for fields, lines in results:
+            if others is not None:
+                others.extend(lines)
+                lines = ()
+            for line in lines:
+                # TODO #28: Allow suppressing these lines
+                print(line)
+            for record in parsing.iter_records(fields, profile):
+                changes.append(Change(len(changes) + 1, *record))
+        return changes
+
     def import_(self, *args):
         """
         Run a series of commands from a script.
+
+        Syntax: import FILE
+
+        Each run of consecutive include, exclude and reset commands is applied
+        in a single pass over the pending changes, as one undoable step.
         """
-        pass
+        if len(args) != 1:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+        try:
+            script = open(args[0], 'r')
+        except OSError as exc:
+            self.rootapp.messages.error(
+                                args[0],
+                                self.rootapp.messages.file_cannot_be_read,
+                                exc.strerror)
+            return False
+        with script:
+            self.run_script(script)
+
+    def import_decisions(self, *args):
+        """
+        Apply the decisions recorded in a file written by the export command.
+
+        Syntax: import-decisions [--format jsonl|csv|nul|tsv] FILE
+
+        The format defaults to the extension of FILE. The changes are matched
+        by path, so the file may also come from an earlier preview; the paths
+        that are not pending changes are counted and ignored. All the
+        decisions are applied as one undoable step.
+        """
+        try:
+            iargs = self.import_decisions_parser.parse_args(args)
+        except _m_forwarg.ForwargError:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+        path = iargs.namespace.file
+        format_ = iargs.namespace.format or guess_format(path)
+        if format_ not in EXPORT_FORMATS:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+        if self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return False
+
+        byname = self.rootapp.index_by_path(self.rootapp.pending_changes)
+        # Change -> decision, so that the last record of a path wins
+        decisions = {}
+        unknown = 0
+        try:
+            with open(path, 'r', newline='') as stream:
+                for sfilename, decision in read_decisions(stream, format_):
+                    variants = byname.get(sfilename)
+                    if variants is None:
+                        unknown += 1
+                    else:
+                        # A record applies to all the destinations
+                        for change in variants:
+                            decisions[change] = decision
+        except OSError as exc:
+            self.rootapp.messages.error(
+                                path,
+                                self.rootapp.messages.file_cannot_be_read,
+                                exc.strerror)
+            return False
+        except ValueError as exc:
+            # Nothing is applied from a corrupted file
+            self.rootapp.messages.error(
+                                self.rootapp.messages.decisions_bad_record,
+                                *exc.args)
+            return False
+
+        self.rootapp.decide_each(decisions.items(), 'import-decisions')
+        self.rootapp.messages.info(self.rootapp.messages.decisions_imported,
+                                   len(decisions), unknown)
+
+    def run_script(self, cmdlines):
+        """
+        Run a series of command lines, coalescing each run of consecutive
+        include, exclude and reset commands into a table of rules that is
+        applied in a single pass.
+        """
+        rules = []
+        try:
+            for cmdline in cmdlines:
+                cmdline = cmdline.strip()
+                if not cmdline:
+                    continue
+                try:
+                    name, *args = _m_shlex.split(cmdline)
+                except ValueError:
+                    # Let the menu report the error
+                    method = None
+                else:
+                    method = self._find_method(name)
+                if method in self.decision_methods:
+                    try:
+                        rules.append((self.include_parser.parse_args(args),
+                                      self.decision_methods[method]))
+                    except _m_forwarg.ForwargError:
+                        self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+                    continue
+                self._apply_rules(rules)
+                self.menu.run_line(cmdline)
+        finally:
+            # Also if a command breaks the loops, e.g. 'quit', the rules that
+            # precede it must be applied
+            self._apply_rules(rules)
+
+    def _find_method(self, name):
+        # Resolve the command like the menu does
+        commands = self.menu.name_to_command
+        try:
+            command = commands[name]
+        except KeyError:
+            matches = [command for cname, command in commands.items()
+                       if cname.startswith(name)]
+            if len(matches) != 1:
+                return None
+            command = matches[0]
+        return getattr(command, 'execute', None)
+
+    def _apply_rules(self, rules):
+        if len(rules) == 1:
+            sargs, decision = rules[0]
+            self.rootapp.decide(self.change_filter.select(sargs), decision)
+        elif rules:
+            self.rootapp.decide_each(
+                            self.change_filter.select_decisions(rules),
+                            '{} rules'.format(len(rules)))
+        rules.clear()
+
+    def _destination_marks(self, change):
+        """
+        Return the column that shows the destinations affected by the change,
+        which is only needed with several destinations.
+        """
+        ndestinations = len(self.rootapp.destinations)
+        if ndestinations == 1:
+            return ()
+        # Digits for the first 9 destinations, '+' for the others
+        return (''.join((self.DESTINATION_MARKS[index] if index <
+                         len(self.DESTINATION_MARKS) else '+')
+                        if index in change.destinations else '-'
+                        for index in range(ndestinations)), )
 
     def _list_summary(self, changes):
-        width = len(str(changes[-1].id_))
+        # The changes may have been sorted
+        width = len(str(max(change.id_ for change in changes)))
         # TODO #10
         for change in changes:
             print('[{0}] {1} {2} {3}'.format(
                 str(change.id_).rjust(width),
                 self.rootapp.messages.status_to_icon[change.included],
-                ' '.join(change.get_summary()),
+                ' '.join((*change.get_summary(),
+                          *self._destination_marks(change),
+                          *((change.mark, ) if change.mark else ()))),
                 ''.join((change.sfilename, change.link))))
 
     def _list_details(self, changes):
@@ -919,15 +2741,80 @@ class MainMenu:
                 maxw_gid = len(row[5])
             if len(row[6]) > maxw_size:
                 maxw_size = len(row[6])
-        for row in rows:
+        for row, change in zip(rows, changes):
             print(' '.join(('[{}]'.format(row[0].rjust(maxw_id)),
                   row[1], row[2], row[3], row[4].rjust(maxw_uid),
                   row[5].rjust(maxw_gid), row[6].rjust(maxw_size),
-                  row[7], row[8])))
+                  row[7], *self._destination_marks(change), row[8])))
+
+    def _list_groups(self, groups, sort):
+        if sort == 'path':
+            keys = sorted(groups)
+        else:
+            # Like du, show the heaviest groups first
+            keys = sorted(groups, key=lambda key: (-groups[key].bytes,
+                                                   -groups[key].count, key))
+
+        rows = []
+        for key in keys:
+            aggregate = groups[key]
+            row = [str(aggregate.count), str(aggregate.bytes)]
+            for decision in (True, False, None):
+                row.append(str(aggregate.decision_count[decision]))
+                row.append(str(aggregate.decision_bytes[decision]))
+            rows.append((row, key))
+
+        widths = [max(len(row[index]) for row, key in rows)
+                  for index in range(len(rows[0][0]))]
+        # TODO #10
+        for row, key in rows:
+            cells = [cell.rjust(width) for cell, width in zip(row, widths)]
+            print(' '.join((
+                cells[0], cells[1],
+                *(' '.join((self.rootapp.messages.status_to_icon[decision],
+                            cells[index], cells[index + 1]))
+                  for decision, index in ((True, 2), (False, 4), (None, 6))),
+                str(key))))
+
+    @staticmethod
+    def _parse_group_by(string):
+        dimension, sep, depth = string.partition(':')
+        if dimension not in Rollups.VIEWS:
+            raise ValueError()
+        if sep:
+            if dimension != 'dir':
+                raise ValueError()
+            # This line itself can raise ValueError
+            depth = int(depth)
+            if depth < 1:
+                raise ValueError()
+        else:
+            depth = None
+        return (dimension, depth)
 
     def list_(self, *args):
         """
         List a selection of pending changes.
+
+        Syntax: list [--details] [--sort size|time|path|op]
+                     [--group-by dir[:depth]|op|uid|flag] [filters]
+
+        --sort shows the largest and the most recent changes first when
+        sorting by size or time.
+        --group-by shows, for each parent directory (optionally truncated to
+        its first 'depth' components), operation or owner, the number of
+        changes and their total bytes, followed by the same numbers for the
+        included, excluded and undecided changes; the groups are sorted by
+        bytes, unless '--sort path' is also given. The 'flag' groups are the
+        changed attributes of the itemized changes, e.g. 's' or 't', and
+        'new' for the new items, so a change can be counted in several of
+        them.
+
+        -i/--itemized-change also accepts wildcards: '?' matches any
+        character, and a final '*' the rest of the itemized change, e.g.
+        '>f.st*'; in the attributes, any letter means changed and '.'
+        unchanged, e.g. '??..t' selects the items whose only difference is
+        the time.
         """
         try:
             sargs = self.list_parser.parse_args(args)
@@ -935,43 +2822,169 @@ class MainMenu:
             self.rootapp.messages.error(
                                     self.rootapp.messages.bad_command_syntax)
             return False
+
+        sort = sargs.namespace.sort
+        if sort is not None and sort not in self.SORT_KEYS:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+
+        if sargs.namespace.group_by is not None:
+            try:
+                dimension, depth = self._parse_group_by(
+                                                    sargs.namespace.group_by)
+            except ValueError:
+                self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+                return False
+            fields = ('length', 'uid') if dimension == 'uid' else ('length', )
+
+            if not sargs.namespace.ids and \
+                    not self.change_filter.is_selective(sargs):
+                # Use the precomputed aggregates
+                if self.rootapp.preview_needed:
+                    self.rootapp.messages.error(
+                                        self.rootapp.messages.preview_needed)
+                elif not self.rootapp.pending_changes:
+                    self.rootapp.messages.error(
+                                self.rootapp.messages.selection_no_changes)
+                else:
+                    self.rootapp.details_fetcher.fetch(
+                                        self.rootapp.pending_changes, fields)
+                    self._list_groups(self.rootapp.rollups.groups(dimension,
+                                                                  depth),
+                                      sort)
+            else:
+                changes = self.change_filter.select(sargs)
+                if changes:
+                    self.rootapp.details_fetcher.fetch(changes, fields)
+                    self._list_groups(Rollups.aggregate(changes, dimension,
+                                                        depth), sort)
+            return
+
         changes = self.change_filter.select(sargs)
         if changes:
+            if sort is not None:
+                key, reverse, fields = self.SORT_KEYS[sort]
+                self.rootapp.details_fetcher.fetch(changes, fields)
+                changes = sorted(changes, key=key, reverse=reverse)
             if sargs.namespace.details:
+                self.rootapp.details_fetcher.fetch(changes)
                 self._list_details(changes)
             else:
                 self._list_summary(changes)
 
-    def include(self, *args):
+    def export(self, *args):
         """
-        Include (confirm) the changes in the synchronization.
+        Write all the fields of a selection of pending changes, including
+        their decisions, in a machine-readable format.
+
+        Syntax: export [--format jsonl|csv|nul|tsv] [filters] [> FILE]
+
+        The records are written to the standard output, or to FILE, whose
+        extension also sets the default format, otherwise jsonl. jsonl writes
+        a JSON object per line; csv and tsv write a header line, quoting the
+        values only where necessary; nul terminates each field with a NUL
+        character. The import-decisions command reads the files back.
         """
-        # TODO #31: This should also ask to include all the ancestor
-        #       directories, if they aren't included already
+        path = None
+        if len(args) > 1 and args[-2] == '>':
+            path = args[-1]
+            args = args[:-2]
+        elif args and args[-1].startswith('>') and len(args[-1]) > 1:
+            path = args[-1][1:]
+            args = args[:-1]
+
         try:
-            sargs = self.include_parser.parse_args(args)
+            sargs = self.export_parser.parse_args(args)
         except _m_forwarg.ForwargError:
             self.rootapp.messages.error(
                                     self.rootapp.messages.bad_command_syntax)
             return False
-        for change in self.change_filter.select(sargs):
-            change.include()
+        format_ = sargs.namespace.format or (guess_format(path)
+                                             if path is not None else 'jsonl')
+        if format_ not in EXPORT_FORMATS:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
 
-    def exclude(self, *args):
+        changes = self.change_filter.select(sargs)
+        if not changes:
+            return False
+        self.rootapp.details_fetcher.fetch(changes)
+
+        if path is None:
+            write_changes(changes, format_, _m_sys.stdout)
+            return
+        try:
+            with open(path, 'w', buffering=EXPORT_BUFFER,
+                      newline='') as stream:
+                count = write_changes(changes, format_, stream)
+        except OSError as exc:
+            self.rootapp.messages.error(
+                                path,
+                                self.rootapp.messages.file_cannot_be_written,
+                                exc.strerror)
+            return False
+        self.rootapp.messages.info(self.rootapp.messages.changes_exported,
+                                   count)
+
+    def select_changes(self, *args):
         """
-        Exclude (except) the changes from the synchronization.
+        Return the changes selected by the filter arguments, or None if the
+        syntax is wrong.
         """
-        # TODO #31: If this is a directory, this should also ask to exclude all
-        #       the descendant files and directories, if they are still
-        #       included
         try:
             sargs = self.include_parser.parse_args(args)
         except _m_forwarg.ForwargError:
             self.rootapp.messages.error(
                                     self.rootapp.messages.bad_command_syntax)
+            return None
+        return self.change_filter.select(sargs)
+
+    def _decide(self, args, decision):
+        try:
+            self.pending_rules.append((self.include_parser.parse_args(args),
+                                       decision))
+        except _m_forwarg.ForwargError:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            result = False
+        else:
+            result = None
+        # Like in a script, a run of consecutive decision commands among the
+        # lines still to be executed by the loop, i.e. the --command options
+        # and the test commands, is applied by its last command
+        if not self._next_is_decision():
+            self._apply_rules(self.pending_rules)
+        return result
+
+    def _next_is_decision(self):
+        cmdlines = getattr(self.menu, 'loop_cmdlines', None)
+        if not cmdlines or not isinstance(cmdlines[0], str):
+            return False
+        try:
+            name = _m_shlex.split(cmdlines[0])[0]
+        except (ValueError, IndexError):
             return False
-        for change in self.change_filter.select(sargs):
-            change.exclude()
+        return self._find_method(name) in self.decision_methods
+
+    def include(self, *args):
+        """
+        Include (confirm) the changes in the synchronization.
+        """
+        # TODO #31: This should also ask to include all the ancestor
+        #       directories, if they aren't included already
+        return self._decide(args, True)
+
+    def exclude(self, *args):
+        """
+        Exclude (except) the changes from the synchronization.
+        """
+        # TODO #31: If this is a directory, this should also ask to exclude all
+        #       the descendant files and directories, if they are still
+        #       included
+        return self._decide(args, False)
 
     def reset(self, *args):
         """
@@ -980,14 +2993,250 @@ class MainMenu:
         # TODO #31: If the path was included and was a directory, this should
         #       ask to reset all the descendants; if the path was excluded,
         #       this should ask to reset all the ancestor directories
+        return self._decide(args, None)
+
+    def ancestors(self, *args):
+        """
+        Find the included changes inside excluded directories.
+
+        Syntax: ancestors [--fix|--exclude]
+
+        rsync does not descend into excluded directories, so their included
+        descendants would be silently skipped; the transfer command refuses
+        to start in that case, except in files-from mode.
+
+        Without options, list the hidden changes with their closest excluded
+        ancestor. With --fix, include all the excluded ancestors of the hidden
+        changes; with --exclude, exclude the hidden changes instead.
+        """
+        if len(args) > 1 or (args and args[0] not in ('--fix', '--exclude')):
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+
+        if self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return False
+
+        hidden = HiddenChanges(self.rootapp.pending_changes)
+        if not hidden:
+            self.rootapp.messages.info(self.rootapp.messages.ancestors_none)
+        elif not args:
+            for change in hidden.changes:
+                print(change.id_, change.sfilename, '<',
+                      hidden.closest_ancestor(change))
+        elif args[0] == '--fix':
+            self.rootapp.decide(hidden.ancestors, True)
+            self.rootapp.messages.info(self.rootapp.messages.ancestors_fixed,
+                                       len(hidden.ancestors))
+        else:
+            self.rootapp.decide(hidden.changes, False)
+
+    def moves(self, *args):
+        """
+        Find the pending deletions that are moves or renames of new files.
+
+        Syntax: moves [--apply]
+
+        A deleted file and a new file are paired if they have the same size
+        and modification time, and no other deleted or new file has them; with
+        --checksum and a preview profile that requests the checksums, several
+        files with the same size and time are told apart by their checksums.
+        The deleted files are examined on the destination, locally or through
+        the remote shell.
+
+        Without options, list the pairs and the bytes that would not need to
+        be transferred. With --apply, rename the deleted files to the new
+        ones on the destination, and then preview only their paths again, so
+        that rsync does not transfer the data of the new files; this is
+        refused with --dry-run. Moves require local sources if there are
+        several, and a local or remote shell destination.
+        """
+        if len(args) > 1 or (args and args[0] != '--apply'):
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.bad_command_syntax)
+            return False
+
+        if self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return False
+
+        destination = self.rootapp.destination
+        sources = self.rootapp.sources
+        if (len(sources) > 1 and
+                not all(source.local for source in sources)) or \
+                len(self.rootapp.destinations) > 1 or destination.daemon:
+            self.rootapp.messages.error(
+                                    self.rootapp.messages.moves_unsupported)
+            return False
+
+        detector = MoveDetector(destination, self.rootapp.remote_shell())
+        moves = detector.find(self.rootapp.pending_changes)
+        if not moves:
+            self.rootapp.messages.info(self.rootapp.messages.moves_none)
+            return
+
+        if not args:
+            for move in moves:
+                print(move.deletion.id_, move.deletion.sfilename, '->',
+                      move.creation.id_, move.creation.sfilename)
+            self.rootapp.messages.info(self.rootapp.messages.moves_found,
+                                       len(moves),
+                                       sum(move.size for move in moves))
+            return
+
+        if self.rootapp.cliargs.namespace.dry_run:
+            self.rootapp.messages.error(self.rootapp.messages.moves_dry_run)
+            return False
+
+        profile = self.rootapp.configuration['preview-profile']
+        if profile not in parsing.PROFILES:
+            self.rootapp.messages.error(
+                                self.rootapp.messages.preview_bad_profile,
+                                profile)
+            return False
+
+        moved = detector.apply(moves)
+        self.rootapp.messages.info(self.rootapp.messages.moves_applied,
+                                   len(moved))
+        if not moved:
+            return
+
+        # The new files, and the directories created for them, are now on
+        # the destination, while the deleted files are gone
+        pending = set(change.sfilename
+                      for change in self.rootapp.pending_changes)
+        # The (source index, path) tuples to preview; a deleted path does not
+        # exist in any source
+        spaths = set()
+        for move in moved:
+            spaths.add((0, move.deletion.sfilename))
+            path = move.creation.sfilename
+            # The directories of the new file come from the same source
+            index = self.rootapp.source_index(path)
+            spaths.add((index, path))
+            cut = path.rfind('/')
+            while cut > -1:
+                if path[:cut + 1] in pending:
+                    spaths.add((index, path[:cut + 1]))
+                cut = path.rfind('/', 0, cut)
+        paths = set(path for index, path in spaths)
+
+        changes, returncode = self._preview_paths(spaths, profile)
+        if returncode != 0:
+            # The pending changes no longer reflect the destination
+            self.rootapp.preview_needed = True
+            self.rootapp.messages.error(self.rootapp.messages.rsync_error,
+                                        returncode)
+            return False
+
+        self.rootapp.messages.info(self.rootapp.messages.watch_updated,
+                                   *self.rootapp.merge_preview(
+                                        changes, paths.__contains__, profile))
+
+    def _parse_count(self, args):
+        if not args:
+            return 1
+        if len(args) == 1 and args[0].isdigit() and int(args[0]) > 0:
+            return int(args[0])
+        self.rootapp.messages.error(self.rootapp.messages.bad_command_syntax)
+        return None
+
+    def undo(self, *args):
+        """
+        Undo the last decisions.
+
+        Syntax: undo [N]
+
+        Revert the last N (by default 1) include, exclude or reset commands,
+        or checkpoint restorations. The history is lost when the pending
+        changes are previewed again; its length is limited by the
+        'history-depth' configuration option.
+        """
+        count = self._parse_count(args)
+        if count is None:
+            return False
+        for _ in range(count):
+            label = self.rootapp.undo()
+            if label is None:
+                self.rootapp.messages.error(
+                                        self.rootapp.messages.nothing_to_undo)
+                return False
+            self.rootapp.messages.info(self.rootapp.messages.history_undone,
+                                       label)
+
+    def redo(self, *args):
+        """
+        Redo the last undone decisions.
+
+        Syntax: redo [N]
+
+        Making a new decision discards the decisions that can be redone.
+        """
+        count = self._parse_count(args)
+        if count is None:
+            return False
+        for _ in range(count):
+            label = self.rootapp.redo()
+            if label is None:
+                self.rootapp.messages.error(
+                                        self.rootapp.messages.nothing_to_redo)
+                return False
+            self.rootapp.messages.info(self.rootapp.messages.history_redone,
+                                       label)
+
+    def checkpoint(self, *args):
+        """
+        Save or restore the decisions of all the pending changes.
+
+        Syntax: checkpoint [NAME]
+                checkpoint --restore NAME
+                checkpoint --delete NAME
+
+        Without arguments, list the saved checkpoints. Restoring a checkpoint
+        can be undone like any other decision. The checkpoints are lost when
+        the pending changes are previewed again.
+        """
         try:
-            sargs = self.include_parser.parse_args(args)
+            cargs = self.checkpoint_parser.parse_args(args)
         except _m_forwarg.ForwargError:
+            cargs = None
+        if cargs is None or (cargs.namespace.restore and
+                             cargs.namespace.delete) or \
+                ((cargs.namespace.restore or cargs.namespace.delete) and
+                 cargs.namespace.name is None):
             self.rootapp.messages.error(
                                     self.rootapp.messages.bad_command_syntax)
             return False
-        for change in self.change_filter.select(sargs):
-            change.reset()
+
+        name = cargs.namespace.name
+        checkpoints = self.rootapp.history.checkpoints
+        if name is None:
+            for name in checkpoints:
+                print(name)
+        elif cargs.namespace.delete:
+            try:
+                del checkpoints[name]
+            except KeyError:
+                self.rootapp.messages.error(
+                                self.rootapp.messages.checkpoint_unknown, name)
+                return False
+        elif cargs.namespace.restore:
+            try:
+                count = self.rootapp.restore_checkpoint(name)
+            except KeyError:
+                self.rootapp.messages.error(
+                                self.rootapp.messages.checkpoint_unknown, name)
+                return False
+            self.rootapp.messages.info(
+                                self.rootapp.messages.checkpoint_restored,
+                                count)
+        elif self.rootapp.preview_needed:
+            self.rootapp.messages.error(self.rootapp.messages.preview_needed)
+            return False
+        else:
+            self.rootapp.history.save_checkpoint(
+                                        name, self.rootapp.pending_changes)
 
     def resume_test(self):
         """
@@ -0,0 +1,123 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+from .store import ChangeStore
+
+
+def _parent(path):
+    # Directories have a trailing slash themselves; top-level paths have no
+    # parent
+    return path[:path.rstrip('/').rfind('/') + 1]
+
+
+class HiddenChanges:
+    """
+    The included changes that rsync would silently skip because one of their
+    ancestor directories is an excluded change, since rsync does not descend
+    into excluded directories.
+
+    changes is the list of the hidden changes, in their original order;
+    ancestors is the list of the excluded directory changes that hide them,
+    sorted by path, i.e. the ones that must be included to fix them.
+
+    Each distinct directory is resolved only once, so the whole check takes
+    time linear in the number of changes plus the number of distinct
+    directories, regardless of the depth of the tree. The changes of a
+    ChangeStore are instead found with a query of the paths inside each
+    excluded directory.
+    """
+    def __init__(self, pending_changes):
+        if isinstance(pending_changes, ChangeStore):
+            self._query(pending_changes)
+            return
+        excluded_dirs = {change.sfilename: change
+                         for change in pending_changes
+                         if change.included is False and
+                         change.sfilename.endswith('/')}
+        self.changes = []
+        ancestors = {}
+
+        if excluded_dirs:
+            # Directory -> whether it is excluded or inside an excluded one
+            hidden_dirs = {'': False}
+
+            def is_hidden(dirname):
+                # Walk up iteratively until a resolved directory is found,
+                # then resolve the whole chain on the way back
+                chain = []
+                while dirname not in hidden_dirs:
+                    chain.append(dirname)
+                    dirname = _parent(dirname)
+                hidden = hidden_dirs[dirname]
+                for dirname in reversed(chain):
+                    hidden = hidden or dirname in excluded_dirs
+                    hidden_dirs[dirname] = hidden
+                return hidden
+
+            for change in pending_changes:
+                if change.included is True and \
+                        is_hidden(_parent(change.sfilename)):
+                    self.changes.append(change)
+                    # Collect all the excluded ancestors, not only the
+                    # closest one; stop at the ones already collected, whose
+                    # own ancestors have been collected too
+                    dirname = _parent(change.sfilename)
+                    while hidden_dirs[dirname] and dirname not in ancestors:
+                        if dirname in excluded_dirs:
+                            ancestors[dirname] = excluded_dirs[dirname]
+                        else:
+                            # Mark the directory as visited
+                            ancestors[dirname] = None
+                        dirname = _parent(dirname)
+
+        self.ancestors = [ancestors[dirname] for dirname in sorted(ancestors)
+                          if ancestors[dirname] is not None]
+        self.ancestor_paths = set(ancestor.sfilename
+                                  for ancestor in self.ancestors)
+
+    def _query(self, store):
+        hidden = {}
+        self.ancestors = []
+        for directory in sorted(store.where(('included = 0',
+                                             "sfilename LIKE '%/'")),
+                                key=lambda change: change.sfilename):
+            found = False
+            # The paths that start with the directory's one
+            for change in store.where(('included = 1', 'sfilename > ?',
+                                       'sfilename < ?'),
+                                      (directory.sfilename,
+                                       directory.sfilename[:-1] + '0')):
+                hidden[change.id_] = change
+                found = True
+            if found:
+                self.ancestors.append(directory)
+        self.changes = [hidden[id_] for id_ in sorted(hidden)]
+        self.ancestor_paths = set(ancestor.sfilename
+                                  for ancestor in self.ancestors)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def closest_ancestor(self, change):
+        """
+        Return the path of the closest excluded ancestor of a hidden change.
+        """
+        dirname = _parent(change.sfilename)
+        while dirname and dirname not in self.ancestor_paths:
+            dirname = _parent(dirname)
+        return dirname
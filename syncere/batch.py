@@ -0,0 +1,104 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import hashlib as _m_hashlib
+import shutil as _m_shutil
+import tempfile as _m_tempfile
+
+
+def paths_fingerprint(roots, paths, since):
+    """
+    Return a digest of the types, sizes and modification times of the given
+    paths under each root, without reading their contents, or None if the
+    ctime of any of them is not earlier than the timestamp since, in
+    nanoseconds.
+    """
+    digest = _m_hashlib.sha1()
+    for root in roots:
+        for path in ('', *paths):
+            try:
+                stat = _m_os.lstat(_m_os.path.join(root, path))
+            except OSError:
+                # A missing path is also part of the fingerprint, e.g. the
+                # source of a deletion
+                digest.update(b'\1')
+                continue
+            if stat.st_ctime_ns >= since:
+                return None
+            digest.update('{}\0{}\0{}\0'.format(
+                                    stat.st_mode, stat.st_size,
+                                    stat.st_mtime_ns).encode())
+        digest.update(b'\2')
+    return digest.hexdigest()
+
+
+class PreviewBatch:
+    """
+    A batch file recorded by the preview command with --only-write-batch, so
+    that the transfer command can apply it with --read-batch instead of
+    scanning and comparing the trees again.
+
+    The batch is only valid as long as the paths listed by the preview have
+    not changed in any location: only those are examined, not the whole
+    trees, so e.g. a new file in a directory that the preview did not list is
+    not noticed, and is then not transferred.
+    """
+    FILE_NAME = 'preview.batch'
+
+    def __init__(self, locations):
+        # The file names output by rsync are relative to the root of the
+        # sources, but to the destination itself
+        self.roots = (*(location.root for location in locations[:-1]),
+                      locations[-1].path)
+        self.directory = _m_tempfile.mkdtemp(prefix='syncere-')
+        self.path = _m_os.path.join(self.directory, self.FILE_NAME)
+        # Taken *before* the preview command is started, so that also the
+        # paths that change while rsync is scanning the trees, whose ctimes
+        # are later, make the batch invalid; the file timestamps can lag
+        # behind time.time_ns(), so take the directory's own one
+        self.started = _m_os.stat(self.directory).st_mtime_ns
+        self.fingerprint = None
+
+    def record(self, paths):
+        """
+        Take the fingerprint of the paths listed by the preview, in the same
+        order in which is_valid() will be given them.
+        """
+        self.fingerprint = paths_fingerprint(self.roots, tuple(paths),
+                                             self.started)
+
+    def preview_args(self):
+        return ['--only-write-batch={}'.format(self.path)]
+
+    def transfer_args(self):
+        return ['--read-batch={}'.format(self.path)]
+
+    def is_valid(self, paths):
+        """
+        Check that the batch file exists and that none of the paths listed by
+        the preview have changed in the sources or the destination since the
+        preview was started.
+        """
+        return _m_os.path.isfile(self.path) and \
+            self.fingerprint is not None and \
+            paths_fingerprint(self.roots, tuple(paths),
+                              self.started) == self.fingerprint
+
+    def discard(self):
+        _m_shutil.rmtree(self.directory, ignore_errors=True)
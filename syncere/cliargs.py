@@ -72,16 +72,137 @@ Syncere-specific options:
                 execute more commands in the specified order. See syncere(1)
                 for information on the available commands. To load a series of
                 commands from a script, use --command="import /path/to/script".
-                Note that syncere by default executes the 'preview quit' and
-                'list' commands sequentially as soon as it is started, but only
-                if no --command options are given; if you specify a --command
-                option and still want those two commands executed at startup,
-                you will have to add them explicitly.
+                Like in imported scripts, each run of consecutive "include",
+                "exclude" and "reset" commands is applied in a single pass
+                over the pending changes, with the same result. Note that
+                syncere by default executes the 'preview quit' and 'list'
+                commands sequentially as soon as it is started, but only if no
+                --command options are given; if you specify a --command option
+                and still want those two commands executed at startup, you
+                will have to add them explicitly.
 
     --experimental
                 Enable the experimentally-supported rsync options, see the
                 relevant section below.
 
+    --ssh-multiplex
+                When some of the locations are accessed through a remote
+                shell, open a shared OpenSSH ControlMaster connection to each
+                remote host when syncere is started, and make all the internal
+                rsync commands reuse it, so that the handshake and the
+                authentication are performed only once per session. The
+                connections are closed when syncere quits. The remote shell
+                command is taken from the -e/--rsh option, and must accept
+                OpenSSH's -o, -N, -f and -O options. With -v/--verbose, the
+                time taken to set up each connection is printed.
+
+    --batch-transfer
+                When all the locations are local, make the "preview" command
+                record a batch file with --only-write-batch instead of using
+                --dry-run; if all the pending changes are then included, the
+                "transfer" command applies the batch file with --read-batch,
+                without scanning and comparing the trees again. If any of the
+                paths listed by the preview have changed in the sources or the
+                destination after the preview, or some changes are excluded,
+                the "transfer" command falls back to the normal behavior.
+                Note that recording the batch file requires the "preview"
+                command to read the data that will be transferred.
+
+    --metrics-file=FILE
+                When syncere quits, write the metrics of the session to FILE:
+                the duration of the last preview, the number of pending
+                changes by operation and decision, the bytes included in the
+                transfer, the duration, throughput and return code of the
+                transfer, and the setup time of the shared connections. The
+                file is replaced atomically, so it can be read at any time by
+                a monitoring system.
+
+    --metrics-format=FORMAT
+                The format of the --metrics-file: 'prometheus' (the default)
+                writes the text format read by the textfile collector of the
+                Prometheus node exporter, replacing the previous content;
+                'jsonl' appends a JSON object per session.
+
+    --also-to=DEST
+                Also synchronize the sources to DEST, in addition to the
+                destination given as the last positional argument. Repeat the
+                option to add more destinations. The "preview" command then
+                previews the transfer to each destination concurrently, and
+                merges the pending changes by path, unless rsync reports a
+                different change or different details for some destinations,
+                in which case the path has a separate pending change for each
+                group of destinations; with several destinations
+                the "list" command shows which ones each change affects, for
+                example "1-3" if it affects the first and third ones, and the
+                -D/--destination filter selects the changes that affect a
+                destination. The same decisions drive the "transfer" command,
+                which runs an rsync command for each destination concurrently
+                and reports its return code. The 'fan-out-workers'
+                configuration option limits the number of concurrent rsync
+                commands (0 means no limit).
+
+    --serve=SOCKET
+                Instead of starting the interactive interface, keep the
+                session in memory and let other programs query and decide on
+                its pending changes through the Unix-domain socket SOCKET.
+                The --command options (by default only "preview") are
+                executed first. Each request is a line with a JSON object
+                such as {"command": "include", "args": ["-o", "send"]},
+                where the command is one of "status", "list", "select",
+                "include", "exclude", "reset", "preview", "transfer" or
+                "shutdown", and the args are the same as in the interactive
+                commands. Each response is made of zero or more JSON lines,
+                for example one per listed change, followed by a line with
+                an "end" key that reports the outcome. The requests of
+                several clients are executed one at a time.
+
+    --rsync-executable=COMMAND
+                Execute COMMAND instead of "rsync" for all the internal rsync
+                commands; COMMAND is split like a shell command line, so it
+                can also include some arguments. syncere ships an rsync
+                simulator that does not read or write any file: it previews
+                a deterministic stream of synthetic changes and records the
+                arguments of the transfers, for example to measure the
+                overhead of syncere itself on millions of changes:
+                --rsync-executable="syncere-rsync-simulator --sim-changes=1e6
+                --sim-record=transfers.jsonl". The other options of the
+                simulator are --sim-rate, --sim-seed, --sim-files-per-dir,
+                --sim-max-size, --sim-delete-ratio, --sim-exit-code and
+                --sim-fail-after.
+
+    --change-store=FILE
+                Keep the pending changes in a SQLite database created in FILE,
+                which is deleted when syncere quits, instead of in memory,
+                for the trees whose changes would not fit in it. The preview
+                streams the changes into the database, which is indexed by
+                path, operation, size, timestamp and decision: the ids and
+                the -i, -o, -p, -u, -g, -s, -t, -f and -m filters are
+                evaluated with a query, and the list, export and transfer
+                commands read the selected changes with a cursor. The other
+                filters are tested on the rows returned by the query.
+
+Resource limits:
+    The internal rsync commands of the preview and of the transfer can be run
+    with limited resources, configured separately with the 'preview-*' and
+    'transfer-*' configuration options. The limits actually applied are
+    reported when they change.
+
+    *-nice      Increment the nice value.
+
+    *-ionice    Set the I/O scheduling class and level, e.g. 'idle' or
+                'best-effort:7'.
+
+    *-cpus      Set the CPU affinity, e.g. '0-3,6'.
+
+    *-cgroup    Move rsync into an existing cgroup v2 delegated to the user,
+                relative to /sys/fs/cgroup, whose '*-cpu-max' and '*-io-max'
+                limits are then set.
+
+    *-cpu-max   The CPU limit of the cgroup, e.g. '50%' or '50000 100000'.
+
+    *-io-max    The I/O limits of the cgroup, e.g. '8:0 rbps=1048576',
+                separating the devices with ';'.
+
 Shared options:
     These options are passed to the internal rsync commands, but they are also
     used by syncere. Below only the syncere meaning is explained; refer to the
@@ -271,6 +392,15 @@ class CLIArgs:
         group.add_argument('--command', action='append', dest='commands',
                            default=[])
         group.add_argument('--experimental', action='store_true')
+        group.add_argument('--ssh-multiplex', action='store_true')
+        group.add_argument('--batch-transfer', action='store_true')
+        group.add_argument('--metrics-file')
+        group.add_argument('--metrics-format', default='prometheus',
+                           choices=('prometheus', 'jsonl'))
+        group.add_argument('--serve')
+        group.add_argument('--also-to', action='append', default=[])
+        group.add_argument('--rsync-executable', default='rsync')
+        group.add_argument('--change-store')
 
     def _shared(self):
         group = self.parser.add_argument_group('shared')
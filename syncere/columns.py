@@ -0,0 +1,154 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+# NumPy is optional: without it the filters are simply tested on each change
+try:
+    import numpy as _m_numpy
+except ImportError:
+    _m_numpy = None
+
+# The Change attributes stored as category codes, i.e. the index of the value
+# in the list of the distinct values, since the filters compare them exactly
+# as strings
+CATEGORIES = ('operation', 'permissions', 'uid', 'gid', 'tstamp', 'mark')
+DECISION_CODES = {None: -1, True: 1, False: 0}
+# The code of the unknown lengths, e.g. with the 'lean' preview profile
+UNKNOWN = -1
+
+
+def available():
+    return _m_numpy is not None
+
+
+def _length(change):
+    # Only the canonical decimal numbers that rsync reports can be compared
+    # as integers
+    length = change.length
+    if length is None or not length.isdigit() or (length[0] == '0' and
+                                                   length != '0'):
+        return UNKNOWN
+    return int(length)
+
+
+class ChangeColumns:
+    """
+    The fields of the pending changes stored in NumPy arrays, one per field,
+    so that the filters that compare a whole field are evaluated as
+    vectorized boolean masks, and the decisions of a whole selection are
+    compared and assigned at once.
+
+    Like the Rollups, the columns refer to the list of the pending changes;
+    they are built the first time that they are needed after a preview or
+    after the details of some changes have been retrieved, and the decisions
+    are kept up to date by update().
+    """
+    def __init__(self, changes):
+        self.changes = changes
+        self.stale = True
+        self.length = None
+        self.icode = None
+        self.decision = None
+        # attribute -> (value -> code, array of codes)
+        self.categories = {}
+
+    @property
+    def enabled(self):
+        # A ChangeStore evaluates the filters with SQL queries instead
+        return _m_numpy is not None and isinstance(self.changes, list)
+
+    def invalidate(self):
+        self.stale = True
+        self.categories = {}
+
+    def _build(self):
+        if not self.stale:
+            return
+        numpy = _m_numpy
+        count = len(self.changes)
+        self.length = numpy.fromiter((_length(change)
+                                      for change in self.changes),
+                                     numpy.int64, count)
+        self.icode = numpy.fromiter((change.icode for change in self.changes),
+                                    numpy.int64, count)
+        self.decision = numpy.fromiter((DECISION_CODES[change.included]
+                                        for change in self.changes),
+                                       numpy.int8, count)
+        for attribute in CATEGORIES:
+            value_to_code = {}
+            codes = numpy.fromiter((value_to_code.setdefault(
+                                        getattr(change, attribute),
+                                        len(value_to_code))
+                                    for change in self.changes),
+                                   numpy.int32, count)
+            self.categories[attribute] = (value_to_code, codes)
+        self.stale = False
+
+    def update(self, change):
+        """
+        Record the current decision of a change.
+        """
+        if not self.stale:
+            self.decision[change.id_ - 1] = DECISION_CODES[change.included]
+
+    def ids_mask(self, ranges):
+        """
+        Return the mask of the (start, stop) ranges of 0-based indices.
+        """
+        self._build()
+        mask = _m_numpy.zeros(len(self.changes), bool)
+        for start, stop in ranges:
+            mask[start:stop] = True
+        return mask
+
+    def field_mask(self, attribute, tests):
+        """
+        Return the mask of the changes whose attribute is equal to any of the
+        tests, which are strings like the attributes.
+        """
+        self._build()
+        numpy = _m_numpy
+        if attribute == 'length':
+            values = [int(test) for test in tests
+                      if test.isdigit() and str(int(test)) == test]
+            return numpy.isin(self.length, values)
+        value_to_code, codes = self.categories[attribute]
+        return numpy.isin(codes, [value_to_code[test] for test in tests
+                                  if test in value_to_code])
+
+    def icode_mask(self, patterns):
+        """
+        Return the mask of the changes whose itemized change code matches any
+        of the (mask, value) patterns.
+        """
+        self._build()
+        mask = _m_numpy.zeros(len(self.changes), bool)
+        for pmask, pvalue in patterns:
+            mask |= self.icode & pmask == pvalue
+        return mask
+
+    def assign(self, indices, decision):
+        """
+        Assign a decision to the changes at the given indices, returning the
+        indices of the ones whose decision was different.
+        """
+        self._build()
+        code = DECISION_CODES[decision]
+        indices = _m_numpy.asarray(indices, _m_numpy.int64)
+        changed = indices[self.decision[indices] != code]
+        self.decision[changed] = code
+        return changed
@@ -0,0 +1,143 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect as _m_bisect
+
+
+class _Node:
+    __slots__ = ('children', 'keys')
+
+    def __init__(self):
+        # Component name -> _Node; directory names keep their trailing slash
+        self.children = {}
+        # The sorted component names, computed lazily and cached
+        self.keys = None
+
+
+class PathIndex:
+    """
+    A trie of the path components of the pending changes, used to complete
+    paths in a time that does not depend on the number of changes.
+    """
+    def __init__(self):
+        self.root = _Node()
+
+    def clear(self):
+        self.root = _Node()
+
+    def rebuild(self, changes):
+        """
+        Index the paths of the changes instead of the current ones.
+        """
+        self.clear()
+        for change in changes:
+            self.add(change.sfilename)
+
+    def add(self, path):
+        node = self.root
+        start = 0
+        while True:
+            end = path.find('/', start) + 1
+            component = path[start:end] if end else path[start:]
+            if not component:
+                break
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _Node()
+                node.keys = None
+            node = child
+            if not end:
+                break
+            start = end
+
+    def complete(self, prefix, limit):
+        """
+        Return at most limit paths, or directory paths, that start with prefix,
+        completing only the last path component.
+        """
+        head, sep, tail = prefix.rpartition('/')
+        node = self.root
+        if sep:
+            for component in head.split('/'):
+                node = node.children.get(component + '/')
+                if node is None:
+                    return []
+
+        if node.keys is None:
+            node.keys = sorted(node.children)
+        keys = node.keys
+
+        matches = []
+        index = _m_bisect.bisect_left(keys, tail)
+        while index < len(keys) and len(matches) < limit:
+            key = keys[index]
+            if not key.startswith(tail):
+                break
+            matches.append(head + sep + key)
+            index += 1
+        return matches
+
+
+def _successor(prefix):
+    # The first string that is greater than all the ones starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class StoredPathIndex:
+    """
+    The PathIndex of the changes kept in a ChangeStore, which queries the
+    index of the paths in the database instead of keeping its own.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def clear(self):
+        pass
+
+    def rebuild(self, changes):
+        pass
+
+    def complete(self, prefix, limit):
+        """
+        Return at most limit paths, or directory paths, that start with prefix,
+        completing only the last path component.
+        """
+        head, sep, tail = prefix.rpartition('/')
+        stop = _successor(prefix) if prefix else None
+        matches = []
+        start = prefix
+        strict = False
+        while len(matches) < limit:
+            path = self.store.first_path(start, stop, strict)
+            if path is None:
+                break
+            end = path.find('/', len(head + sep)) + 1
+            if len(path) == len(head + sep):
+                # The directory of the prefix itself
+                start = path
+                strict = True
+            elif end:
+                # Skip the other paths in the same directory
+                matches.append(path[:end])
+                start = _successor(path[:end])
+                strict = False
+            else:
+                matches.append(path)
+                start = path
+                strict = True
+        return matches
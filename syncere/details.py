@@ -0,0 +1,159 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import stat as _m_stat
+import time as _m_time
+import subprocess as _m_subprocess
+import concurrent.futures as _m_futures
+
+from . import parsing
+
+# The same format as rsync's %M
+TIMESTAMP_FORMAT = '%Y/%m/%d-%H:%M:%S'
+
+# The Change attributes that can be retrieved on demand
+DETAIL_FIELDS = ('permissions', 'uid', 'gid', 'length', 'tstamp')
+
+
+def format_stat(stat):
+    """
+    Return the permissions, uid, gid, length and timestamp of a file in the
+    same format as the preview command's output.
+    """
+    return (_m_stat.filemode(stat.st_mode)[1:], str(stat.st_uid),
+            str(stat.st_gid), str(stat.st_size),
+            _m_time.strftime(TIMESTAMP_FORMAT,
+                             _m_time.localtime(stat.st_mtime)))
+
+
+class DetailsFetcher:
+    """
+    Retrieve the details of the pending changes that were not requested by a
+    lean preview profile, only for the changes that actually need them.
+    """
+    # The number of files examined by each task of the thread pool
+    BATCH_SIZE = 256
+
+    def __init__(self, rootapp):
+        self.rootapp = rootapp
+        # Whether the last preview profile already requested all the fields
+        self.complete = True
+
+    def reset(self, profile):
+        self.complete = parsing.PROFILES[profile].complete
+
+    def fetch(self, changes, fields=DETAIL_FIELDS):
+        """
+        Retrieve the details of the changes for which any of the given
+        attributes is unknown.
+        """
+        if self.complete:
+            return
+        missing = [change for change in changes
+                   if any(getattr(change, field) is None for field in fields)]
+        if not missing:
+            return
+
+        if all(location.local for location in self.rootapp.sources) and \
+                self.rootapp.destination.local:
+            self._fetch_local(missing)
+        else:
+            self._fetch_remote(missing)
+
+        # The groups by owner and the byte counts may have changed
+        self.rootapp.rollups.invalidate()
+        self.rootapp.columns.invalidate()
+
+    def _candidate_paths(self, change):
+        # Deleted files only exist in the destination
+        if change.operation == 'del.':
+            locations = (self.rootapp.destination, )
+        else:
+            locations = self.rootapp.sources
+        return [_m_os.path.join(location.root, change.sfilename)
+                for location in locations]
+
+    def _stat_batch(self, changes):
+        for change in changes:
+            for path in self._candidate_paths(change):
+                try:
+                    stat = _m_os.lstat(path)
+                except OSError:
+                    continue
+                else:
+                    change.set_details(*format_stat(stat), lfilename=path)
+                    break
+
+    def _fetch_local(self, changes):
+        with _m_futures.ThreadPoolExecutor() as pool:
+            # Consume the results to propagate any exception
+            list(pool.map(self._stat_batch,
+                          (changes[index:index + self.BATCH_SIZE]
+                           for index in range(0, len(changes),
+                                              self.BATCH_SIZE))))
+
+    def _fetch_remote(self, changes):
+        # Ask rsync itself, but only about the selected files
+        byname = {change.sfilename: change for change in changes}
+        previewargs = self.rootapp.filter_rsync_args(
+                            groups=('shared', 'checksum', 'experimental',
+                                    'safe'),
+                            exclude=('locations', 'files_from',
+                                     'write_batch', 'only_write_batch',
+                                     'read_batch'))
+
+        for source in self.rootapp.sources:
+            if not byname:
+                break
+            root = source.root
+            if not root.endswith('/'):
+                root += '/'
+            if source.host is not None:
+                root = source.string[:len(source.string) -
+                                     len(source.path)] + root
+
+            # --files-from does not recurse into the listed directories unless
+            # -r is explicitly given, so make sure that it is disabled
+            call = self.rootapp.popen('preview', [
+                                        *self.rootapp.rsync, *previewargs,
+                                        '--dry-run', '--no-recursive',
+                                        '--dirs', '--ignore-missing-args',
+                                        '--files-from=-',
+                                        '--out-format=' + parsing.PROFILES[
+                                                        'full'].out_format,
+                                        root,
+                                        self.rootapp.destination.string],
+                                        stdin=_m_subprocess.PIPE,
+                                        stdout=_m_subprocess.PIPE,
+                                        universal_newlines=True)
+            stdout = call.communicate('\n'.join(byname) + '\n')[0]
+            if call.returncode != 0:
+                # The details will simply stay unknown
+                continue
+
+            fields, others = parsing.parse_chunk(stdout)
+            for record in parsing.iter_records(fields):
+                record = dict(zip(parsing.CHANGE_FIELDS, record))
+                change = byname.pop(record['sfilename'], None)
+                if change is not None:
+                    change.set_details(record['permissions'], record['uid'],
+                                       record['gid'], record['length'],
+                                       record['tstamp'],
+                                       lfilename=record['lfilename'],
+                                       checksum=record['checksum'])
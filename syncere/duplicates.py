@@ -0,0 +1,158 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import shlex as _m_shlex
+import hashlib as _m_hashlib
+import subprocess as _m_subprocess
+import collections as _m_collections
+
+from .moves import valid_checksum, parse_size
+
+# original is the change that rsync transfers, copies the changes that are
+# then materialized from it on the destination, size the bytes of each file
+Duplicates = _m_collections.namedtuple('Duplicates', ('original', 'copies',
+                                                      'size'))
+
+# The values of the 'transfer-duplicates' configuration option, besides the
+# empty string, which disables the detection
+MODES = ('copy', 'link')
+# Run in the destination directory: create COPY from ORIGINAL for each 'N
+# ORIGINAL COPY DIRECTORY' line of the script, only if COPY does not exist,
+# printing N if it succeeded; a copy is a reflink where the file system
+# supports it
+MATERIALIZE = {
+    'copy': ('if [ ! -e {2} ] && [ ! -L {2} ] && mkdir -p -- {3} && '
+             'cp --reflink=auto -p -- {1} {2}; then echo {0}; fi'),
+    'link': ('if [ ! -e {2} ] && [ ! -L {2} ] && mkdir -p -- {3} && '
+             'ln -- {1} {2}; then echo {0}; fi'),
+}
+# The bytes read at a time from the local files
+CHUNK_SIZE = 1 << 20
+
+
+def _digest(path):
+    hash_ = _m_hashlib.md5()
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(CHUNK_SIZE), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+class DuplicateFinder:
+    """
+    Find the groups of new files with the same content among the included
+    changes, so that rsync only transfers one file of each group, and the
+    others are then created on the destination from it, with a hard link or
+    a copy, depending on the mode.
+
+    The files are first grouped by size, permissions, owner, group and
+    modification time, so that a copy or a link ends up exactly like the
+    file that rsync would have transferred, and only the files of the groups
+    with more than one file are compared by checksum: the checksums of the
+    preview are used if all the files of the group have one, otherwise they
+    are computed reading the files, if the source is local, or the group is
+    skipped.
+    """
+    def __init__(self, source, destination, rsh, mode):
+        self.source = source
+        self.destination = destination
+        # The remote shell command, used for a remote destination
+        self.rsh = rsh
+        self.mode = mode
+        self.root = destination.path or '.'
+
+    def _checksums(self, changes):
+        if all(valid_checksum(change.checksum) for change in changes):
+            return [change.checksum for change in changes]
+        if not self.source.local:
+            return None
+        try:
+            return [_digest(_m_os.path.join(self.source.root,
+                                            change.sfilename))
+                    for change in changes]
+        except OSError:
+            return None
+
+    def find(self, changes):
+        """
+        Return the list of Duplicates tuples found among the changes.
+        """
+        # (size, permissions, uid, gid, tstamp) -> [changes]
+        buckets = _m_collections.defaultdict(list)
+        for change in changes:
+            if not change.ichange.startswith('>f+') or \
+                    change.included is not True:
+                continue
+            size = parse_size(change.length)
+            # Empty files would not save anything
+            if not size:
+                continue
+            buckets[(size, change.permissions, change.uid, change.gid,
+                     change.tstamp)].append(change)
+
+        groups = []
+        for key, bucket in buckets.items():
+            if len(bucket) < 2:
+                continue
+            checksums = self._checksums(bucket)
+            if checksums is None:
+                continue
+            checksum_to_changes = _m_collections.defaultdict(list)
+            for checksum, change in zip(checksums, bucket):
+                checksum_to_changes[checksum].append(change)
+            for group in checksum_to_changes.values():
+                if len(group) > 1:
+                    group.sort(key=lambda change: change.id_)
+                    groups.append(Duplicates(group[0], group[1:], key[0]))
+        groups.sort(key=lambda group: group.original.id_)
+        return groups
+
+    def materialize(self, groups):
+        """
+        Create the copies on the destination from their transferred
+        originals, and return the changes that could not be created.
+        """
+        pairs = [(group.original, copy) for group in groups
+                 for copy in group.copies]
+        script = ''.join(self._line(index, original, copy)
+                         for index, (original, copy) in enumerate(pairs))
+        if self.destination.local:
+            args = ['sh']
+            cwd = self.root
+        else:
+            args = [*self.rsh, self.destination.host,
+                    'cd -- {} && sh'.format(_m_shlex.quote(self.root))]
+            cwd = None
+        try:
+            call = _m_subprocess.run(args, input=script, cwd=cwd,
+                                     stdout=_m_subprocess.PIPE,
+                                     universal_newlines=True)
+        except OSError:
+            return [copy for original, copy in pairs]
+        done = set(int(line) for line in call.stdout.splitlines()
+                   if line.isdigit())
+        return [copy for index, (original, copy) in enumerate(pairs)
+                if index not in done]
+
+    def _line(self, index, original, copy):
+        return MATERIALIZE[self.mode].format(
+                    index, _m_shlex.quote(original.sfilename),
+                    _m_shlex.quote(copy.sfilename),
+                    _m_shlex.quote(_m_os.path.dirname(copy.sfilename) or
+                                   '.')) + '\n'
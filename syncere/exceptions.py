@@ -63,3 +63,7 @@ class UnrecognizedItemizedChangeError(SyncereError):
 
 class UnsupportedOptionError(SyncereError):
     pass
+
+
+class BadExpressionError(SyncereError):
+    pass
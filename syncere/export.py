@@ -0,0 +1,137 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv as _m_csv
+import json as _m_json
+
+FORMATS = ('jsonl', 'csv', 'nul', 'tsv')
+# The exported fields, in order; the last ones are not Change attributes with
+# the same name
+FIELDS = ('id', 'decision', 'mark', 'ichange', 'operation', 'permissions',
+          'uid', 'gid', 'length', 'tstamp', 'sfilename', 'lfilename', 'link',
+          'checksum', 'destinations')
+DECISION_TO_NAME = {True: 'included', False: 'excluded', None: 'undecided'}
+NAME_TO_DECISION = {name: decision
+                    for decision, name in DECISION_TO_NAME.items()}
+# The size of the buffer of the exported files, and of the blocks read from
+# the imported nul files
+BUFFER_SIZE = 1 << 16
+
+
+def guess_format(path, default='jsonl'):
+    """
+    Return the format that corresponds to the extension of a file name.
+    """
+    extension = path.rpartition('.')[2]
+    return extension if extension in FORMATS else default
+
+
+def _values(change):
+    return (change.id_, DECISION_TO_NAME[change.included], change.mark,
+            change.ichange, change.operation, change.permissions, change.uid,
+            change.gid, change.length, change.tstamp, change.sfilename,
+            change.lfilename, change.link, change.checksum,
+            # The same numbers as the -D/--destination filter
+            [index + 1 for index in change.destinations])
+
+
+def _text(value):
+    # The textual formats have no null values
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ','.join(str(item) for item in value)
+    return str(value)
+
+
+def write_changes(changes, format_, stream):
+    """
+    Write a record with all the fields of each change to a text stream,
+    one change at a time.
+
+    jsonl writes a JSON object per line; csv and tsv write a header line,
+    quoting the values only where necessary; nul terminates each field with
+    a NUL character, without a header, so that also the paths with newlines
+    can be read back unambiguously.
+
+    Return the number of written records.
+    """
+    count = 0
+    if format_ == 'jsonl':
+        for change in changes:
+            stream.write(_m_json.dumps(dict(zip(FIELDS, _values(change)))) +
+                         '\n')
+            count += 1
+    elif format_ == 'nul':
+        for change in changes:
+            stream.write('\0'.join(map(_text, _values(change))) + '\0')
+            count += 1
+    else:
+        writer = _m_csv.writer(stream, dialect='excel' if format_ == 'csv'
+                               else 'excel-tab', lineterminator='\n')
+        writer.writerow(FIELDS)
+        for change in changes:
+            writer.writerow(map(_text, _values(change)))
+            count += 1
+    return count
+
+
+def _iter_nul(stream):
+    buffer = ''
+    record = []
+    while True:
+        block = stream.read(BUFFER_SIZE)
+        if not block:
+            break
+        *fields, buffer = (buffer + block).split('\0')
+        for field in fields:
+            record.append(field)
+            if len(record) == len(FIELDS):
+                yield dict(zip(FIELDS, record))
+                record = []
+    if buffer or record:
+        raise ValueError('truncated record')
+
+
+def read_decisions(stream, format_):
+    """
+    Iterate over the (sfilename, decision) tuples of the records of a file
+    written by write_changes; the other fields are ignored.
+
+    Raise ValueError with the number of the bad record if a record has no
+    path or an unknown decision.
+    """
+    if format_ == 'jsonl':
+        records = (_m_json.loads(line) for line in stream if line.strip())
+    elif format_ == 'nul':
+        records = _iter_nul(stream)
+    else:
+        records = _m_csv.DictReader(stream, dialect='excel' if format_ == 'csv'
+                                    else 'excel-tab')
+
+    number = 1
+    try:
+        for record in records:
+            decision = NAME_TO_DECISION[record['decision']]
+            sfilename = record['sfilename']
+            if not isinstance(sfilename, str) or not sfilename:
+                raise ValueError()
+            yield (sfilename, decision)
+            number += 1
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(number)
@@ -0,0 +1,233 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import re as _m_re
+import fnmatch as _m_fnmatch
+
+from . import exceptions
+from .rollups import change_bytes
+
+TOKEN = _m_re.compile(r'''\s*(?:(\()|(\))|'''
+                      r'''((?:[^\s()'"]|'[^']*'|"[^"]*")+))''')
+TEST = _m_re.compile(r'([a-z]+)(<=|>=|!=|=|<|>|:)(.*)$', _m_re.S)
+SIZE = _m_re.compile(r'([0-9]+)([KMGT]?)$', _m_re.I)
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+
+# Name -> (Change attribute, allowed operators, cost, detail field); the cost
+# is a rough estimate of the relative time needed by the test
+FIELDS = {
+    'op': ('operation', ('=', '!='), 1, None),
+    'ichange': ('ichange', ('=', '!='), 1, None),
+    'path': ('sfilename', ('=', '!='), 1, None),
+    'uid': ('uid', ('=', '!='), 1, 'uid'),
+    'gid': ('gid', ('=', '!='), 1, 'gid'),
+    'perms': ('permissions', ('=', '!='), 1, 'permissions'),
+    'dest': ('destinations', ('=', '!='), 1, None),
+    'size': ('length', COMPARISONS, 2, 'length'),
+    # The timestamps can be compared as strings, also by prefix
+    'time': ('tstamp', COMPARISONS, 2, 'tstamp'),
+}
+# Name -> (regex flags, translate the glob, cost)
+PATTERNS = {
+    'glob': (0, True, 4),
+    'iglob': (_m_re.I, True, 4),
+    'regex': (0, False, 8),
+    'iregex': (_m_re.I, False, 8),
+}
+KEYWORDS = ('and', 'or', 'not')
+
+
+def _unquote(value):
+    # Quotes can also surround only part of a value, e.g. ichange='.d  '
+    return ''.join(part[1:-1] if part[:1] in '\'"' else part
+                   for part in _m_re.findall(r''''[^']*'|"[^"]*"|[^'"]+''',
+                                             value))
+
+
+class _Node:
+    """
+    A node of the syntax tree: its Python source code and its cost.
+    """
+    __slots__ = ('code', 'cost')
+
+    def __init__(self, code, cost):
+        self.code = code
+        self.cost = cost
+
+
+class Expression:
+    """
+    A filter expression such as
+
+        op=send and (glob:*.log or size>1G) and not uid=0
+
+    parsed once and compiled into a single Python function; the operands of
+    each 'and' and 'or' are reordered so that the cheapest tests are evaluated
+    first, and the evaluation stops as soon as the result is known.
+
+    predicate is a function that takes a Change and returns a bool; details is
+    the set of the Change attributes that may have to be retrieved before
+    calling it.
+    """
+    def __init__(self, string):
+        self.string = string
+        self.constants = []
+        self.details = set()
+        self.tokens = self._tokenize(string)
+        self.position = 0
+
+        node = self._parse_or()
+        if self.position < len(self.tokens):
+            raise exceptions.BadExpressionError(
+                            'unexpected', self.tokens[self.position])
+        self.code = node.code
+        self.predicate = eval('lambda change: ' + node.code,
+                              {'k': self.constants, 'size': change_bytes})
+        del self.tokens
+
+    @staticmethod
+    def _tokenize(string):
+        tokens = []
+        position = 0
+        string = string.rstrip()
+        while position < len(string):
+            match = TOKEN.match(string, position)
+            if not match:
+                raise exceptions.BadExpressionError('unbalanced quotes')
+            tokens.append(match.group(match.lastindex))
+            position = match.end()
+        return tokens
+
+    def _peek(self):
+        try:
+            return self.tokens[self.position]
+        except IndexError:
+            return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise exceptions.BadExpressionError('unexpected end')
+        self.position += 1
+        return token
+
+    def _constant(self, value):
+        self.constants.append(value)
+        return 'k[{}]'.format(len(self.constants) - 1)
+
+    def _combine(self, operator, nodes):
+        if len(nodes) == 1:
+            return nodes[0]
+        # The operands are side-effect free, so they can be safely reordered;
+        # sorted is stable, so equal costs keep the original order
+        nodes = sorted(nodes, key=lambda node: node.cost)
+        return _Node('({})'.format(' {} '.format(operator).join(
+                                            node.code for node in nodes)),
+                     sum(node.cost for node in nodes))
+
+    def _parse_or(self):
+        nodes = [self._parse_and()]
+        while self._peek() == 'or':
+            self._next()
+            nodes.append(self._parse_and())
+        return self._combine('or', nodes)
+
+    def _parse_and(self):
+        nodes = [self._parse_not()]
+        while self._peek() == 'and':
+            self._next()
+            nodes.append(self._parse_not())
+        return self._combine('and', nodes)
+
+    def _parse_not(self):
+        if self._peek() == 'not':
+            self._next()
+            node = self._parse_not()
+            return _Node('(not {})'.format(node.code), node.cost)
+        return self._parse_atom()
+
+    def _parse_atom(self):
+        token = self._next()
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                raise exceptions.BadExpressionError('missing )')
+            return node
+        if token == ')' or token in KEYWORDS:
+            raise exceptions.BadExpressionError('unexpected', token)
+        return self._parse_test(token)
+
+    def _parse_test(self, token):
+        match = TEST.match(token)
+        if not match:
+            raise exceptions.BadExpressionError('bad test', token)
+        name, operator, value = match.groups()
+        value = _unquote(value)
+
+        if operator == ':':
+            try:
+                flags, glob, cost = PATTERNS[name]
+            except KeyError:
+                raise exceptions.BadExpressionError('unknown pattern', name)
+            try:
+                regex = _m_re.compile(_m_fnmatch.translate(value) if glob
+                                      else value, flags)
+            except _m_re.error:
+                raise exceptions.BadExpressionError('bad pattern', value)
+            # The translated globs are anchored at both ends
+            return _Node('({}.{}(change.sfilename) is not None)'.format(
+                                self._constant(regex),
+                                'match' if glob else 'search'), cost)
+
+        try:
+            attribute, operators, cost, detail = FIELDS[name]
+        except KeyError:
+            raise exceptions.BadExpressionError('unknown field', name)
+        if operator not in operators:
+            raise exceptions.BadExpressionError('bad operator', token)
+        if detail is not None:
+            self.details.add(detail)
+        python_operator = '==' if operator == '=' else operator
+
+        if name == 'size':
+            match = SIZE.match(value)
+            if not match:
+                raise exceptions.BadExpressionError('bad size', value)
+            nbytes = int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+            return _Node('(size(change) {} {})'.format(python_operator,
+                                                       nbytes), cost)
+
+        if name == 'dest':
+            try:
+                index = int(value) - 1
+            except ValueError:
+                raise exceptions.BadExpressionError('bad destination', value)
+            return _Node('({} {}in change.destinations)'.format(
+                                index, 'not ' if operator == '!=' else ''),
+                         cost)
+
+        if name == 'time' and operator != '=' and operator != '!=':
+            # Compare only the given prefix of the timestamp, so that e.g.
+            # time<2016/05 works as expected
+            return _Node('((change.tstamp or "")[:{}] {} {})'.format(
+                                len(value), python_operator,
+                                self._constant(value)), cost)
+
+        return _Node('(change.{} {} {})'.format(attribute, python_operator,
+                                                self._constant(value)), cost)
@@ -0,0 +1,318 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import sys as _m_sys
+import json as _m_json
+import shutil as _m_shutil
+import ctypes as _m_ctypes
+import platform as _m_platform
+import subprocess as _m_subprocess
+
+# The configuration options of each phase, e.g. preview-nice
+LIMITS = ('cgroup', 'cpu-max', 'cpus', 'io-max', 'ionice', 'nice')
+CGROUP_ROOT = '/sys/fs/cgroup'
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no wrapper in the C library, and its number depends on the
+# architecture
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64': 273,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+
+def parse_cpus(string):
+    """
+    Convert a CPU list such as '0-3,6' into a set of CPU numbers.
+    """
+    cpus = set()
+    for item in string.split(','):
+        first, _, last = item.strip().partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    if not cpus:
+        raise ValueError(string)
+    return cpus
+
+
+def format_cpus(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else
+                    '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def parse_ionice(string):
+    """
+    Convert an I/O scheduling class with an optional priority level, such as
+    'idle' or 'best-effort:7', into the value of ioprio_set.
+    """
+    class_, _, level = string.partition(':')
+    level = int(level or 0)
+    if not 0 <= level <= 7:
+        raise ValueError(string)
+    return IOPRIO_CLASSES[class_.strip()] << IOPRIO_CLASS_SHIFT | level
+
+
+def parse_cpu_max(string):
+    """
+    Return the content of a cgroup's cpu.max file, also accepting a
+    percentage of one CPU, e.g. '50%'.
+    """
+    if string.endswith('%'):
+        return '{} 100000'.format(int(float(string[:-1]) * 1000))
+    return string
+
+
+def apply_limits(limits):
+    """
+    Apply the limits of a _Plan to the current process, and return the ones
+    actually in effect; it never raises, since rsync should run anyway.
+    """
+    applied = []
+    if limits['cgroup_procs'] is not None:
+        try:
+            with open(limits['cgroup_procs'], 'w') as procs:
+                procs.write('0\n')
+        except OSError as exc:
+            applied.append('cgroup=failed ({})'.format(exc.strerror))
+        else:
+            applied.append('cgroup=' + _m_os.path.dirname(
+                            limits['cgroup_procs'])[len(CGROUP_ROOT):])
+    if limits['nice'] is not None:
+        try:
+            _m_os.nice(limits['nice'])
+        except OSError as exc:
+            applied.append('nice=failed ({})'.format(exc.strerror))
+        else:
+            applied.append('nice={}'.format(_m_os.getpriority(
+                                                _m_os.PRIO_PROCESS, 0)))
+    if limits['ioprio'] is not None:
+        ioprio = limits['ioprio']
+        syscall = _m_ctypes.CDLL(None, use_errno=True).syscall
+        if syscall(limits['syscall'], IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            applied.append('ionice=failed ({})'.format(_m_os.strerror(
+                                                _m_ctypes.get_errno())))
+        else:
+            class_ = ioprio >> IOPRIO_CLASS_SHIFT
+            applied.append('ionice={}:{}'.format(
+                        next(name for name, value in IOPRIO_CLASSES.items()
+                             if value == class_),
+                        ioprio & ((1 << IOPRIO_CLASS_SHIFT) - 1)))
+    if limits['cpus'] is not None:
+        try:
+            _m_os.sched_setaffinity(0, limits['cpus'])
+        except OSError as exc:
+            applied.append('cpus=failed ({})'.format(exc.strerror))
+        else:
+            applied.append('cpus=' + format_cpus(_m_os.sched_getaffinity(0)))
+    return ' '.join(applied)
+
+
+def _exec_limited(argv):
+    """
+    The wrapper that ResourceGovernor executes instead of rsync: apply the
+    limits, write the ones in effect to a file descriptor, then replace
+    itself with rsync, so that also the processes that rsync forks inherit
+    them.
+
+    argv is the file descriptor, the limits as JSON, the path of rsync and
+    its arguments.
+    """
+    fd, limits, executable, *args = argv
+    fd = int(fd)
+    _m_os.write(fd, apply_limits(_m_json.loads(limits)).encode())
+    _m_os.close(fd)
+    _m_os.execv(executable, args)
+
+
+class _Plan:
+    """
+    The limits of a phase, validated in syncere's process, so that the
+    wrapper process only has to apply them right before executing rsync.
+    """
+    def __init__(self, values):
+        # Limit -> reason why it cannot be applied
+        self.errors = {}
+        self.nice = self._parse(values, 'nice', int)
+        self.ioprio = self._parse(values, 'ionice', parse_ionice)
+        self.cpus = self._parse(values, 'cpus', parse_cpus)
+        self.cgroup_procs = None
+        self.syscall = None
+
+        if self.ioprio is not None:
+            number = IOPRIO_SET_SYSCALLS.get(_m_platform.machine())
+            if number is None:
+                self.errors['ionice'] = 'unsupported architecture'
+                self.ioprio = None
+            else:
+                self.syscall = number
+
+        cgroup = values['cgroup']
+        if cgroup:
+            self._prepare_cgroup(cgroup, values)
+        else:
+            for limit in ('cpu-max', 'io-max'):
+                if values[limit]:
+                    self.errors[limit] = 'no cgroup'
+
+    def _parse(self, values, limit, parse):
+        if not values[limit]:
+            return None
+        try:
+            return parse(values[limit])
+        except (ValueError, KeyError):
+            self.errors[limit] = 'invalid value'
+            return None
+
+    def _prepare_cgroup(self, cgroup, values):
+        # The cgroup must already exist and be delegated to the user, e.g. by
+        # systemd, since syncere's own cgroup cannot have children with
+        # controllers while it contains processes
+        path = _m_os.path.join(CGROUP_ROOT, cgroup.lstrip('/'))
+        if not _m_os.path.isfile(_m_os.path.join(path, 'cgroup.procs')):
+            self.errors['cgroup'] = 'not a cgroup v2 directory'
+            for limit in ('cpu-max', 'io-max'):
+                if values[limit]:
+                    self.errors[limit] = 'no cgroup'
+            return
+        self.cgroup_procs = _m_os.path.join(path, 'cgroup.procs')
+
+        # The limits apply to the whole cgroup, so they are written only once
+        for limit, lines in (('cpu-max', (parse_cpu_max(values['cpu-max']),
+                                          ) if values['cpu-max'] else ()),
+                             ('io-max', [line.strip() for line
+                                         in values['io-max'].split(';')
+                                         if line.strip()])):
+            try:
+                for line in lines:
+                    # io.max only accepts one device per write
+                    with open(_m_os.path.join(path, limit.replace('-', '.')),
+                              'w') as file_:
+                        file_.write(line + '\n')
+            except OSError as exc:
+                self.errors[limit] = exc.strerror
+
+    def __bool__(self):
+        return any(value is not None for value in (self.nice, self.ioprio,
+                                                   self.cpus,
+                                                   self.cgroup_procs))
+
+    def limits(self):
+        """
+        Return the limits to be applied, as a JSON string for the wrapper.
+        """
+        return _m_json.dumps({
+            'cgroup_procs': self.cgroup_procs,
+            'nice': self.nice,
+            'ioprio': self.ioprio,
+            'syscall': self.syscall,
+            'cpus': None if self.cpus is None else sorted(self.cpus),
+        })
+
+
+class ResourceGovernor:
+    """
+    Launch the rsync processes of each phase, i.e. the previews and the
+    transfers, with the nice value, I/O priority, CPU affinity and cgroup
+    configured for it, and report the limits that are actually in effect.
+
+    The limits are applied by a wrapper process, i.e. this very module
+    executed by the Python interpreter, which then executes rsync, so that
+    also the processes that rsync forks inherit them. Applying them in the
+    child process between fork and exec, with preexec_fn, would not be safe,
+    since syncere runs other threads, e.g. to prefetch the previews.
+    """
+    def __init__(self, configuration):
+        self.configuration = configuration
+        # Phase -> (configuration values, _Plan)
+        self.plans = {}
+        # Phase -> the last report of the limits in effect
+        self.reports = {}
+
+    def _plan(self, phase):
+        values = {limit: self.configuration['-'.join((phase, limit))].strip()
+                  for limit in LIMITS}
+        cached = self.plans.get(phase)
+        if cached is None or cached[0] != values:
+            # Only prepare the limits again if the configuration has changed
+            cached = (values, _Plan(values))
+            self.plans[phase] = cached
+        return cached[1]
+
+    def popen(self, phase, args, quiet=False, **kwargs):
+        """
+        Start an rsync process for a phase with subprocess.Popen.
+
+        Return a tuple with the Popen object and the report of the limits in
+        effect, which is None if it did not change since the previous process
+        of the same phase, if no limits are configured, or if quiet: then the
+        report is not recorded either, so that the next process that is not
+        quiet reports it.
+        """
+        plan = self._plan(phase)
+        if not plan and not plan.errors:
+            return (_m_subprocess.Popen(args, **kwargs), None)
+
+        applied = ''
+        if plan:
+            # Fail like Popen itself if rsync cannot be found, instead of in
+            # the wrapper
+            executable = _m_shutil.which(args[0])
+            if executable is None:
+                raise FileNotFoundError(args[0])
+            read, write = _m_os.pipe()
+            try:
+                call = _m_subprocess.Popen(
+                            [_m_sys.executable, _m_os.path.abspath(__file__),
+                             str(write), plan.limits(), executable, *args],
+                            pass_fds=(write, ), **kwargs)
+            except BaseException:
+                _m_os.close(read)
+                raise
+            finally:
+                _m_os.close(write)
+            # The wrapper closes the pipe before executing rsync
+            with open(read, 'rb') as pipe:
+                applied = pipe.read().decode()
+        else:
+            call = _m_subprocess.Popen(args, **kwargs)
+
+        report = ' '.join((applied, *('{}=not applied ({})'.format(
+                                                        limit, reason)
+                                      for limit, reason
+                                      in sorted(plan.errors.items())))).strip()
+        if quiet or report == self.reports.get(phase):
+            return (call, None)
+        self.reports[phase] = report
+        return (call, report)
+
+
+if __name__ == '__main__':
+    _exec_limited(_m_sys.argv[1:])
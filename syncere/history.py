@@ -0,0 +1,129 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections as _m_collections
+
+
+def encode_deltas(deltas):
+    """
+    Compress a sequence of (index, old, new) decisions, sorted by index, into
+    (start, stop, old, new) runs of consecutive indices.
+    """
+    runs = []
+    for index, old, new in deltas:
+        if runs:
+            start, stop, rold, rnew = runs[-1]
+            if stop == index and rold is old and rnew is new:
+                runs[-1] = (start, index + 1, old, new)
+                continue
+        runs.append((index, index + 1, old, new))
+    return tuple(runs)
+
+
+def encode_decisions(changes):
+    """
+    Compress the decisions of all the changes into (start, stop, decision)
+    runs.
+    """
+    runs = []
+    start = 0
+    decision = None
+    for index, change in enumerate(changes):
+        if index == 0:
+            decision = change.included
+        elif change.included is not decision:
+            runs.append((start, index, decision))
+            start = index
+            decision = change.included
+    if changes:
+        runs.append((start, len(changes), decision))
+    return tuple(runs)
+
+
+Entry = _m_collections.namedtuple('Entry', ('label', 'runs'))
+
+
+class DecisionHistory:
+    """
+    The undoable decisions on the pending changes.
+
+    Each entry only stores the runs of consecutive changes whose decision was
+    modified, with the old and the new decision, so that bulk decisions such
+    as 'include *' take constant memory; the checkpoints store the decisions
+    of all the changes in the same run-length encoding.
+    """
+    def __init__(self):
+        self.undo_stack = _m_collections.deque()
+        self.redo_stack = []
+        # Name -> (start, stop, decision) runs
+        self.checkpoints = {}
+
+    def clear(self):
+        """
+        Forget everything, for example because the pending changes have been
+        replaced or renumbered.
+        """
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.checkpoints.clear()
+
+    def record(self, label, deltas, depth):
+        """
+        Store a new entry made of the (index, old, new) deltas, keeping at
+        most depth entries.
+        """
+        if not deltas:
+            return
+        self.undo_stack.append(Entry(label, encode_deltas(sorted(
+                                        deltas, key=lambda delta: delta[0]))))
+        while len(self.undo_stack) > depth:
+            self.undo_stack.popleft()
+        # A new decision makes the undone ones unreachable
+        self.redo_stack.clear()
+
+    def undo(self):
+        try:
+            entry = self.undo_stack.pop()
+        except IndexError:
+            return None
+        self.redo_stack.append(entry)
+        return entry
+
+    def redo(self):
+        try:
+            entry = self.redo_stack.pop()
+        except IndexError:
+            return None
+        self.undo_stack.append(entry)
+        return entry
+
+    def save_checkpoint(self, name, changes):
+        self.checkpoints[name] = encode_decisions(changes)
+
+    def checkpoint_deltas(self, name, changes):
+        """
+        Return the (index, old, new) deltas that restore the decisions of a
+        checkpoint; raise KeyError if it does not exist.
+        """
+        deltas = []
+        for start, stop, decision in self.checkpoints[name]:
+            for index in range(start, stop):
+                old = changes[index].included
+                if old is not decision:
+                    deltas.append((index, old, decision))
+        return deltas
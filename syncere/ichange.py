@@ -0,0 +1,157 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools as _m_functools
+
+# The characters of rsync's itemized changes, i.e. the %i escape, YXcstpoguax
+UPDATE_TYPES = '<>ch.*'
+FILE_TYPES = 'fdLDS'
+ATTRIBUTES = 'cstpoguax'
+# The update type '*' is followed by a message instead of the other fields
+MESSAGES = ('deleting', )
+
+# The layout of the integer codes: one bit per changed attribute, one bit for
+# the new items, whose attributes are all '+', then the index + 1 of the
+# update type, file type and message, 0 meaning none or unknown
+ATTRIBUTE_BITS = (1 << len(ATTRIBUTES)) - 1
+NEW = 1 << len(ATTRIBUTES)
+UPDATE_SHIFT = 10
+TYPE_SHIFT = 13
+MESSAGE_SHIFT = 16
+FIELD_BITS = 0b111
+UPDATE_MASK = FIELD_BITS << UPDATE_SHIFT
+TYPE_MASK = FIELD_BITS << TYPE_SHIFT
+MESSAGE_MASK = FIELD_BITS << MESSAGE_SHIFT
+MESSAGE = (UPDATE_TYPES.index('*') + 1) << UPDATE_SHIFT
+
+
+# Only a few distinct itemized changes occur in a preview, so the cache makes
+# encoding them practically free
+@_m_functools.lru_cache(maxsize=4096)
+def encode_ichange(ichange):
+    """
+    Convert an itemized change into an integer code.
+    """
+    code = (UPDATE_TYPES.find(ichange[:1]) + 1) << UPDATE_SHIFT
+    if code == MESSAGE:
+        message = ichange[1:].rstrip()
+        if message in MESSAGES:
+            code |= (MESSAGES.index(message) + 1) << MESSAGE_SHIFT
+        # The message is not made of attributes: setting all their bits, as
+        # well as NEW, prevents any attribute pattern from matching
+        return code | ATTRIBUTE_BITS | NEW
+    code |= (FILE_TYPES.find(ichange[1:2]) + 1) << TYPE_SHIFT
+    for bit, char in enumerate(ichange[2:2 + len(ATTRIBUTES)]):
+        if char == '+':
+            code |= NEW
+        elif char.isalpha():
+            code |= 1 << bit
+    return code
+
+
+@_m_functools.lru_cache(maxsize=256)
+def compile_ichange_pattern(pattern):
+    """
+    Convert a pattern of itemized changes into a (mask, value) tuple: a change
+    matches if its code & mask == value.
+
+    Each character of the pattern matches the same position of the itemized
+    change: '?' matches anything, and a final '*' matches all the remaining
+    positions, which otherwise must be unchanged attributes. For the
+    attributes, '.' or ' ' means unchanged, any letter changed (e.g. 't' also
+    matches 'T'), and '+' a new item. '*' alone matches any change, while
+    '*deleting' or '*del*' match the deletions.
+
+    For example '>f.st*' matches the received files whose size and time
+    changed, regardless of the other attributes, and '??..t' the items whose
+    only difference is the time.
+
+    Raise ValueError if the pattern is not valid.
+    """
+    if pattern == '*':
+        return (0, 0)
+    if pattern[:1] == '*':
+        word = pattern[1:].rstrip(' ')
+        open_ = word.endswith('*')
+        if open_:
+            word = word[:-1]
+            messages = [message for message in MESSAGES
+                        if message.startswith(word)]
+        else:
+            messages = [message for message in MESSAGES if message == word]
+        if not messages or '*' in word or '?' in word:
+            raise ValueError(pattern)
+        if open_ and len(messages) == len(MESSAGES):
+            # Also match the messages that syncere does not know
+            return (UPDATE_MASK, MESSAGE)
+        if len(messages) > 1:
+            raise ValueError(pattern)
+        return (UPDATE_MASK | MESSAGE_MASK, MESSAGE | (MESSAGES.index(
+                                    messages[0]) + 1) << MESSAGE_SHIFT)
+
+    mask = 0
+    value = 0
+    if pattern.endswith('*'):
+        pattern = pattern[:-1]
+        open_ = True
+    else:
+        open_ = False
+    if not pattern or len(pattern) > 2 + len(ATTRIBUTES) or '*' in pattern:
+        raise ValueError(pattern)
+
+    for position, char in enumerate(pattern[:2]):
+        if char == '?':
+            continue
+        types, shift = ((UPDATE_TYPES[:-1], UPDATE_SHIFT),
+                        (FILE_TYPES, TYPE_SHIFT))[position]
+        index = types.find(char)
+        if index < 0:
+            raise ValueError(pattern)
+        mask |= FIELD_BITS << shift
+        value |= (index + 1) << shift
+
+    attributes = pattern[2:]
+    if not open_:
+        attributes = attributes.ljust(len(ATTRIBUTES), '.')
+    for bit, char in enumerate(attributes):
+        if char == '?':
+            continue
+        if char in '. ':
+            mask |= 1 << bit | NEW
+        elif char == '+':
+            mask |= 1 << bit | NEW
+            value |= NEW
+        elif char.isalpha():
+            mask |= 1 << bit | NEW
+            value |= 1 << bit
+        else:
+            raise ValueError(pattern)
+    return (mask, value)
+
+
+def ichange_flags(code):
+    """
+    Return the names of the changed attributes of a code, or 'new' for a new
+    item; deletions and the other messages have none.
+    """
+    if code & UPDATE_MASK == MESSAGE:
+        return ()
+    if code & NEW:
+        return ('new', )
+    return tuple(attribute for bit, attribute in enumerate(ATTRIBUTES)
+                 if code & 1 << bit)
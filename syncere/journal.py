@@ -0,0 +1,152 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import glob as _m_glob
+import json as _m_json
+
+from .metrics import write_atomically
+
+# rsync prefixes each line of its --log-file with a timestamp and its pid
+LOG_MARKER = '{syncere-journal}'
+LOG_FORMAT = LOG_MARKER + '%i %n'
+
+
+class TransferJournal:
+    """
+    The record of a transfer and of its attempts, kept on disk until it
+    succeeds, so that the changes that were not transferred can be retried
+    also after syncere itself has terminated.
+
+    The journal file is made of JSON lines: the first one describes the
+    locations and the included changes, then each attempt appends a line
+    when it starts and one with rsync's return code when it ends. Each
+    attempt makes rsync report the completed changes in its own --log-file,
+    which rsync writes while the transfer is running.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.locations = None
+        # (sfilename, operation) tuples
+        self.changes = []
+        # Attempt number -> return code, or None if it never ended
+        self.attempts = {}
+
+    def exists(self):
+        return _m_os.path.exists(self.path)
+
+    def log_path(self, attempt):
+        return '{}.{}.log'.format(self.path, attempt)
+
+    def start(self, locations, changes):
+        self.locations = list(locations)
+        self.changes = [(change.sfilename, change.operation)
+                        for change in changes]
+        self.attempts = {}
+        for log in _m_glob.glob(_m_glob.escape(self.path) + '.*.log'):
+            _m_os.remove(log)
+        write_atomically(self.path, _m_json.dumps(
+                            {'locations': self.locations,
+                             'changes': self.changes}) + '\n')
+
+    def _append(self, record):
+        with open(self.path, 'a') as journal:
+            journal.write(_m_json.dumps(record) + '\n')
+            journal.flush()
+            _m_os.fsync(journal.fileno())
+
+    def begin_attempt(self):
+        """
+        Record a new attempt, and return the path of its rsync log file.
+        """
+        attempt = len(self.attempts) + 1
+        self.attempts[attempt] = None
+        self._append({'attempt': attempt})
+        return self.log_path(attempt)
+
+    def end_attempt(self, returncode):
+        attempt = len(self.attempts)
+        self.attempts[attempt] = returncode
+        self._append({'attempt': attempt, 'returncode': returncode})
+
+    def load(self):
+        """
+        Read the journal; raise OSError if it cannot be read, or ValueError
+        if it is corrupted.
+        """
+        with open(self.path) as journal:
+            lines = journal.read().splitlines()
+        try:
+            header = _m_json.loads(lines[0])
+            self.locations = header['locations']
+            self.changes = [tuple(change) for change in header['changes']]
+            self.attempts = {}
+            for line in lines[1:]:
+                try:
+                    record = _m_json.loads(line)
+                except ValueError:
+                    # syncere may have been killed while writing the line
+                    continue
+                self.attempts[record['attempt']] = record.get('returncode')
+        except (IndexError, KeyError, TypeError):
+            raise ValueError('corrupted journal')
+
+    def _logged(self, attempt):
+        names = []
+        try:
+            log = open(self.log_path(attempt))
+        except FileNotFoundError:
+            return names
+        with log:
+            for line in log:
+                index = line.find(LOG_MARKER)
+                if index > -1:
+                    # Skip the itemized changes and the following space
+                    names.append(line[index + len(LOG_MARKER) +
+                                      12:].rstrip('\n'))
+        return names
+
+    def remaining(self, overlap):
+        """
+        Return the (sfilename, operation) tuples of the changes that have not
+        been transferred yet, in their original order.
+
+        rsync may log a file when it has been sent, before the receiver has
+        finished writing it, so the last overlap changes logged by a failed
+        attempt are considered not transferred; rsync will skip the ones that
+        did complete.
+        """
+        done = set()
+        for attempt, returncode in sorted(self.attempts.items()):
+            if returncode == 0:
+                # All the listed changes are done, including the ones that
+                # rsync found already up to date and did not log
+                return []
+            names = self._logged(attempt)
+            if overlap > 0:
+                names = names[:-overlap]
+            done.update(names)
+        return [change for change in self.changes if change[0] not in done]
+
+    def discard(self):
+        for path in (self.path, *(self.log_path(attempt)
+                                  for attempt in self.attempts)):
+            try:
+                _m_os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,79 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+
+
+class Location:
+    """
+    Objects of this class represent the [src] and [dest] arguments of the
+    rsync command line.
+    """
+    def __init__(self, string):
+        self.string = string
+        self.host = None
+        self.daemon = False
+
+        if string.startswith('rsync://'):
+            self.daemon = True
+            self.host, _, self.path = string[8:].partition('/')
+        else:
+            # Like rsync, only consider a colon that comes before any slash,
+            # so that local paths such as './foo:bar' are still recognized
+            head, sep, tail = string.partition(':')
+            if sep and '/' not in head:
+                self.host = head
+                if tail.startswith(':'):
+                    self.daemon = True
+                    self.path = tail[1:]
+                else:
+                    self.path = tail
+            else:
+                self.path = string
+
+    @property
+    def remote(self):
+        """
+        True if the location is accessed through a remote shell.
+        """
+        return self.host is not None and not self.daemon
+
+    @property
+    def local(self):
+        return self.host is None
+
+    @property
+    def root(self):
+        """
+        The directory that the %n file names output by rsync are relative to.
+
+        Like rsync, a trailing slash means "the contents of the directory",
+        otherwise the last path component is part of the transferred names.
+        """
+        if self.path.endswith('/'):
+            return self.path
+        return _m_os.path.dirname(self.path) or '.'
+
+
+def parse_locations(locations):
+    """
+    Split the positional arguments in a tuple of source Location objects and
+    the destination Location object.
+    """
+    sources = tuple(Location(string) for string in locations[:-1])
+    return (sources, Location(locations[-1]))
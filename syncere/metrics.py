@@ -0,0 +1,184 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import json as _m_json
+import time as _m_time
+
+DECISION_TO_LABEL = {True: 'included', False: 'excluded', None: 'undecided'}
+
+
+def write_atomically(path, text):
+    """
+    Replace the content of path so that readers never see a partial file.
+    """
+    # The temporary file must be in the same file system for os.replace to be
+    # atomic; unlike mkstemp, which creates it readable only by the owner,
+    # give it the mode of a file created normally, e.g. the node exporter
+    # usually runs as another user, and let the kernel apply the umask
+    dirname, basename = _m_os.path.split(path)
+    while True:
+        temppath = _m_os.path.join(dirname or '.', '.{}.{}'.format(
+                                        basename, _m_os.urandom(6).hex()))
+        try:
+            fd = _m_os.open(temppath, _m_os.O_WRONLY | _m_os.O_CREAT |
+                            _m_os.O_EXCL | _m_os.O_CLOEXEC, 0o666)
+        except FileExistsError:
+            continue
+        break
+    try:
+        with open(fd, 'w') as tempfile:
+            tempfile.write(text)
+        _m_os.replace(temppath, path)
+    except BaseException:
+        _m_os.remove(temppath)
+        raise
+
+
+class SessionMetrics:
+    """
+    The numbers of a syncere session, exported when it ends.
+    """
+    FORMATS = ('prometheus', 'jsonl')
+
+    def __init__(self):
+        self.preview_count = 0
+        self.preview_duration = None
+        self.preview_returncode = None
+        self.transfer_duration = None
+        self.transfer_bytes = None
+        self.transfer_returncode = None
+        # (operation, decision) -> number of changes
+        self.changes = {}
+        self.connection_setup = {}
+
+    def record_changes(self, op_groups):
+        """
+        Store the number of changes by operation and decision from the
+        aggregates by operation.
+        """
+        self.changes = {(operation, decision): count
+                        for operation, aggregate in op_groups.items()
+                        for decision, count
+                        in aggregate.decision_count.items()}
+
+    def record_preview(self, duration, returncode):
+        self.preview_count += 1
+        self.preview_duration = duration
+        self.preview_returncode = returncode
+
+    def record_transfer(self, duration, nbytes, returncode):
+        self.transfer_duration = duration
+        self.transfer_bytes = nbytes
+        self.transfer_returncode = returncode
+
+    @property
+    def transfer_throughput(self):
+        if not self.transfer_duration or self.transfer_bytes is None:
+            return None
+        return self.transfer_bytes / self.transfer_duration
+
+    def to_dict(self):
+        return {
+            'timestamp': _m_time.time(),
+            'preview_count': self.preview_count,
+            'preview_duration_seconds': self.preview_duration,
+            'preview_return_code': self.preview_returncode,
+            'changes': [{'operation': operation,
+                         'decision': DECISION_TO_LABEL[decision],
+                         'count': count}
+                        for (operation, decision), count
+                        in sorted(self.changes.items(), key=str)],
+            'transfer_bytes': self.transfer_bytes,
+            'transfer_duration_seconds': self.transfer_duration,
+            'transfer_throughput_bytes_per_second':
+                self.transfer_throughput,
+            'transfer_return_code': self.transfer_returncode,
+            'connection_setup_seconds': self.connection_setup,
+        }
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the text exposition format, suitable for the
+        textfile collector of the Prometheus node exporter.
+        """
+        lines = []
+
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace(
+                                            '"', '\\"').replace('\n', '\\n')
+
+        def add(name, type_, help_, samples):
+            samples = [(labels, value) for labels, value in samples
+                       if value is not None]
+            if not samples:
+                return
+            lines.append('# HELP syncere_{} {}'.format(name, help_))
+            lines.append('# TYPE syncere_{} {}'.format(name, type_))
+            for labels, value in samples:
+                if labels:
+                    labels = '{{{}}}'.format(','.join(
+                                    '{}="{}"'.format(label, escape(lvalue))
+                                    for label, lvalue in labels))
+                else:
+                    labels = ''
+                lines.append('syncere_{}{} {}'.format(name, labels, value))
+
+        add('session_end_timestamp_seconds', 'gauge',
+            'Time when the syncere session ended.', (((), _m_time.time()), ))
+        add('preview_runs', 'gauge', 'Number of preview commands executed.',
+            (((), self.preview_count), ))
+        add('preview_duration_seconds', 'gauge',
+            'Duration of the last preview command.',
+            (((), self.preview_duration), ))
+        add('preview_return_code', 'gauge',
+            'Return code of the last preview command.',
+            (((), self.preview_returncode), ))
+        add('changes', 'gauge',
+            'Pending changes by operation and decision.',
+            ((((('operation', operation),
+                 ('decision', DECISION_TO_LABEL[decision])), count))
+             for (operation, decision), count
+             in sorted(self.changes.items(), key=str)))
+        add('transfer_bytes', 'gauge',
+            'Bytes of the changes included in the transfer.',
+            (((), self.transfer_bytes), ))
+        add('transfer_duration_seconds', 'gauge',
+            'Duration of the transfer command.',
+            (((), self.transfer_duration), ))
+        add('transfer_throughput_bytes_per_second', 'gauge',
+            'Bytes of the included changes divided by the transfer duration.',
+            (((), self.transfer_throughput), ))
+        add('transfer_return_code', 'gauge',
+            'Return code of the transfer command.',
+            (((), self.transfer_returncode), ))
+        add('connection_setup_seconds', 'gauge',
+            'Time taken to set up the shared remote-shell connection.',
+            (((('host', host), ), seconds)
+             for host, seconds in self.connection_setup.items()))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format_):
+        if format_ == 'jsonl':
+            # Each session appends one line, written at once, so the readers
+            # see whole lines
+            with open(path, 'a') as metrics:
+                metrics.write(_m_json.dumps(self.to_dict(), sort_keys=True) +
+                              '\n')
+        else:
+            write_atomically(path, self.to_prometheus())
@@ -0,0 +1,227 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import stat as _m_stat
+import time as _m_time
+import shlex as _m_shlex
+import subprocess as _m_subprocess
+import collections as _m_collections
+
+from .details import TIMESTAMP_FORMAT
+
+Move = _m_collections.namedtuple('Move', ('deletion', 'creation', 'size'))
+
+# Run by the remote shell in the destination directory: print the size,
+# modification time, raw mode and name of each regular file whose name is
+# read from the standard input, terminated by NUL
+REMOTE_STAT = "xargs -0 stat --printf '%s %Y %f %n\\0' --"
+# Also run in the destination directory: rename OLD to NEW for each 'N OLD
+# NEW' line of the script, only if OLD is still a regular file and NEW does
+# not exist, printing N if the rename succeeded
+REMOTE_MOVE = ('if [ -f {1} ] && [ ! -e {2} ] && [ ! -L {2} ] && '
+               'mkdir -p -- {3} && mv -- {1} {2}; then echo {0}; fi')
+
+
+def valid_checksum(checksum):
+    # rsync prints a blank or zero checksum when it did not compute one
+    return bool(checksum and checksum.strip(' 0'))
+
+
+def _epoch(tstamp):
+    try:
+        return int(_m_time.mktime(_m_time.strptime(tstamp,
+                                                   TIMESTAMP_FORMAT)))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_size(length):
+    try:
+        return int(length)
+    except (TypeError, ValueError):
+        return None
+
+
+def _pair(deletions, creations):
+    """
+    Pair the deletions and the creations of a bucket, whose files all have
+    the same size and modification time.
+    """
+    if len(deletions) == 1 and len(creations) == 1:
+        deletion, creation = deletions[0], creations[0]
+        if valid_checksum(deletion.checksum) and \
+                valid_checksum(creation.checksum) and \
+                deletion.checksum != creation.checksum:
+            return []
+        return [(deletion, creation)]
+
+    # Several files with the same size and time can only be told apart by
+    # their checksums, otherwise the bucket is ambiguous and left alone
+    if not all(valid_checksum(change.checksum)
+               for change in (*deletions, *creations)):
+        return []
+    checksum_to_deletions = _m_collections.defaultdict(list)
+    for deletion in deletions:
+        checksum_to_deletions[deletion.checksum].append(deletion)
+    pairs = []
+    for creation in creations:
+        candidates = checksum_to_deletions.get(creation.checksum)
+        if candidates:
+            pairs.append((candidates.pop(), creation))
+    return pairs
+
+
+class MoveDetector:
+    """
+    Find the pending deletions that are actually moves or renames of a new
+    file in the source, and rename the files on the destination, so that
+    rsync does not need to transfer their data again.
+
+    The deletions, whose details rsync does not report, are examined on the
+    destination, locally or through the remote shell; they are bucketed by
+    size and modification time with the new files, and a deletion and a new
+    file are only paired if they are the only ones in their bucket, unless
+    all the files in the bucket have a checksum, i.e. with --checksum and a
+    preview profile that requests it, in which case the checksums must be
+    equal. The directories, the symbolic links and the excluded changes are
+    never paired.
+    """
+    def __init__(self, destination, rsh):
+        self.destination = destination
+        # The remote shell command, used for a remote destination
+        self.rsh = rsh
+        self.root = destination.path or '.'
+
+    def _stat_local(self, paths):
+        stats = {}
+        for path in paths:
+            try:
+                stat = _m_os.lstat(_m_os.path.join(self.root, path))
+            except OSError:
+                continue
+            if _m_stat.S_ISREG(stat.st_mode):
+                stats[path] = (stat.st_size, int(stat.st_mtime))
+        return stats
+
+    def _remote(self, command, input_):
+        call = _m_subprocess.run(
+                        [*self.rsh, self.destination.host,
+                         'cd -- {} && {}'.format(_m_shlex.quote(self.root),
+                                                 command)],
+                        input=input_, stdout=_m_subprocess.PIPE,
+                        universal_newlines=True)
+        # The files that cannot be examined or renamed are simply left out
+        return call.stdout
+
+    def _stat_remote(self, paths):
+        stats = {}
+        output = self._remote(REMOTE_STAT, ''.join(path + '\0'
+                                                   for path in paths))
+        for record in output.split('\0'):
+            try:
+                size, mtime, mode, path = record.split(' ', 3)
+                if _m_stat.S_ISREG(int(mode, 16)):
+                    stats[path] = (int(size), int(mtime))
+            except ValueError:
+                continue
+        return stats
+
+    def find(self, changes):
+        """
+        Return the list of Move tuples found among the changes.
+        """
+        deletions = [change for change in changes
+                     if change.operation == 'del.' and
+                     not change.sfilename.endswith('/') and
+                     change.included is not False]
+        creations = [change for change in changes
+                     if change.ichange.startswith('>f+') and
+                     change.included is not False]
+        if not deletions or not creations:
+            return []
+
+        stat = self._stat_local if self.destination.local else \
+            self._stat_remote
+        stats = stat([change.sfilename for change in deletions])
+
+        # (size, mtime) -> ([deletions], [creations])
+        buckets = {}
+        for deletion in deletions:
+            try:
+                key = stats[deletion.sfilename]
+            except KeyError:
+                continue
+            buckets.setdefault(key, ([], []))[0].append(deletion)
+        for creation in creations:
+            key = (parse_size(creation.length), _epoch(creation.tstamp))
+            try:
+                buckets[key][1].append(creation)
+            except KeyError:
+                continue
+
+        moves = []
+        for (size, mtime), (bdeletions, bcreations) in buckets.items():
+            moves.extend(Move(deletion, creation, size) for deletion, creation
+                         in _pair(bdeletions, bcreations))
+        moves.sort(key=lambda move: move.creation.id_)
+        return moves
+
+    def _apply_local(self, moves):
+        done = []
+        for move in moves:
+            old = _m_os.path.join(self.root, move.deletion.sfilename)
+            new = _m_os.path.join(self.root, move.creation.sfilename)
+            # Never overwrite anything, nor move a file modified in the
+            # meantime
+            if _m_os.path.lexists(new) or self._stat_local(
+                        (move.deletion.sfilename, )).get(
+                            move.deletion.sfilename) != (
+                                move.size, _epoch(move.creation.tstamp)):
+                continue
+            try:
+                _m_os.makedirs(_m_os.path.dirname(new), exist_ok=True)
+                _m_os.rename(old, new)
+            except OSError:
+                continue
+            done.append(move)
+        return done
+
+    def _apply_remote(self, moves):
+        script = ''.join(REMOTE_MOVE.format(
+                            index, _m_shlex.quote(move.deletion.sfilename),
+                            _m_shlex.quote(move.creation.sfilename),
+                            _m_shlex.quote(_m_os.path.dirname(
+                                        move.creation.sfilename) or '.')) +
+                         '\n' for index, move in enumerate(moves))
+        indices = set()
+        for line in self._remote('sh', script).splitlines():
+            if line.isdigit():
+                indices.add(int(line))
+        return [move for index, move in enumerate(moves) if index in indices]
+
+    def apply(self, moves):
+        """
+        Rename the deleted files to the new ones on the destination, and
+        return the moves that succeeded; a move fails, leaving the changes as
+        they are, if the new file already exists on the destination, the old
+        one was modified or removed in the meantime, or the rename fails.
+        """
+        if self.destination.local:
+            return self._apply_local(moves)
+        return self._apply_remote(moves)
@@ -0,0 +1,101 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import shlex as _m_shlex
+import shutil as _m_shutil
+import subprocess as _m_subprocess
+import tempfile as _m_tempfile
+import time as _m_time
+
+
+class SharedConnection:
+    """
+    A session-scoped OpenSSH ControlMaster connection, reused by all the
+    internal rsync commands through their --rsh option.
+    """
+    DEFAULT_RSH = 'ssh'
+
+    def __init__(self, rsh, hosts):
+        self.rsh = _m_shlex.split(rsh or _m_os.environ.get('RSYNC_RSH') or
+                                  self.DEFAULT_RSH)
+        # Preserve the order, but do not connect twice to the same host
+        self.hosts = list(dict.fromkeys(hosts))
+        self.directory = None
+        self.control_path = None
+        # Host -> seconds taken to set up the master connection, or None if it
+        # could not be set up (the rsync commands will then open their own
+        # connections, since ControlMaster=auto is used)
+        self.setup_times = {}
+
+    def _control_options(self, master):
+        return ['-o', 'ControlMaster={}'.format(master),
+                '-o', 'ControlPath={}'.format(self.control_path),
+                '-o', 'ControlPersist=yes']
+
+    def open(self):
+        # A private directory ensures that other users can't hijack the socket
+        self.directory = _m_tempfile.mkdtemp(prefix='syncere-')
+        # %C is a hash of the local host, remote host, port and user, and keeps
+        # the socket path short
+        self.control_path = _m_os.path.join(self.directory, '%C')
+
+        for host in self.hosts:
+            start = _m_time.monotonic()
+            call = _m_subprocess.run([*self.rsh,
+                                      *self._control_options('yes'),
+                                      '-N', '-f', host],
+                                     stdin=_m_subprocess.DEVNULL)
+            if call.returncode == 0:
+                self.setup_times[host] = _m_time.monotonic() - start
+            else:
+                self.setup_times[host] = None
+
+    def close(self):
+        if self.directory is None:
+            return
+
+        for host, setup_time in self.setup_times.items():
+            if setup_time is not None:
+                _m_subprocess.run([*self.rsh,
+                                   '-o', 'ControlPath={}'.format(
+                                                        self.control_path),
+                                   '-O', 'exit', host],
+                                  stdin=_m_subprocess.DEVNULL,
+                                  stdout=_m_subprocess.DEVNULL,
+                                  stderr=_m_subprocess.DEVNULL)
+
+        _m_shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+        self.setup_times.clear()
+
+    def command(self):
+        """
+        Return the remote shell command, as a list of words, that reuses the
+        connection.
+        """
+        return [*self.rsh, *self._control_options('auto')]
+
+    def rsh_option(self):
+        """
+        Return the --rsh option for the rsync commands that reuse the
+        connection.
+        """
+        # rsync splits the --rsh value itself, so quote every word
+        return '--rsh={}'.format(' '.join(_m_shlex.quote(word)
+                                          for word in self.command()))
@@ -0,0 +1,202 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import re as _m_re
+import concurrent.futures as _m_futures
+
+from . import exceptions
+
+# The names of the Change constructor arguments after id_
+CHANGE_FIELDS = ('ichange', 'operation', 'permissions', 'uid', 'gid', 'length',
+                 'tstamp', 'lfilename', 'sfilename', 'link', 'checksum')
+
+LINE_PREFIX = '{syncere}'
+
+# File names cannot contain NUL characters, so the fields of a whole chunk can
+# be safely joined in a single string, which is much cheaper to pass between
+# processes than a list of tuples
+FIELD_SEPARATOR = '\0'
+
+
+class Profile:
+    """
+    An --out-format for the preview command, with the regular expression that
+    parses its lines and the Change fields that it captures.
+    """
+    def __init__(self, out_format, regex, fields):
+        self.out_format = out_format
+        self.regex = _m_re.compile(regex)
+        self.fields = fields
+        # The number of values captured for each pending change
+        self.number_of_fields = len(fields)
+        self.positions = tuple(CHANGE_FIELDS.index(field) for field in fields)
+        self.complete = fields == CHANGE_FIELDS
+
+
+PROFILES = {
+    'full': Profile(
+        '{syncere}%i '  # itemized changes
+        '%o '  # operation
+        '%B '  # permissions
+        '%U '  # uid
+        '%G '  # gid
+        '%l '  # length (bytes)
+        '{//}%M'  # last mod timestamp
+        '{//}%f'  # filename (long)
+        '{//}%n'  # filename (short)
+        '{//}%L'  # link string
+        '{//}%C'  # md5
+        '{/syncere}',
+        r'\{syncere}(.{11}) '
+        r'(send|recv|del\.) '
+        # TODO #42: test if %B shows ACLs like ls -l
+        r'(.+?) '
+        r'([0-9]+) '
+        r'([0-9]+|DEFAULT) '
+        r'([0-9]+) '
+        r'\{//\}(.+?)'
+        r'\{//\}(.+?)'
+        r'\{//\}(.+?)'
+        r'\{//\}(.*?)'
+        r'\{//\}([0-9a-fA-F]{32}| {32})'
+        r'\{/syncere\}',
+        CHANGE_FIELDS),
+    # The lean profiles only request what the default 'list' command shows,
+    # the other details are retrieved on demand for the selected changes
+    'lean': Profile(
+        '{syncere}%i '  # itemized changes
+        '%o '  # operation
+        '{//}%n'  # filename (short)
+        '{//}%L'  # link string
+        '{/syncere}',
+        r'\{syncere}(.{11}) '
+        r'(send|recv|del\.) '
+        r'\{//\}(.+?)'
+        r'\{//\}(.*?)'
+        r'\{/syncere\}',
+        ('ichange', 'operation', 'sfilename', 'link')),
+    'lean-size': Profile(
+        '{syncere}%i '  # itemized changes
+        '%o '  # operation
+        '%l '  # length (bytes)
+        '{//}%n'  # filename (short)
+        '{//}%L'  # link string
+        '{/syncere}',
+        r'\{syncere}(.{11}) '
+        r'(send|recv|del\.) '
+        r'([0-9]+) '
+        r'\{//\}(.+?)'
+        r'\{//\}(.*?)'
+        r'\{/syncere\}',
+        ('ichange', 'operation', 'length', 'sfilename', 'link')),
+}
+
+
+def parse_chunk(text, profile='full'):
+    """
+    Parse a block of complete lines of the preview command's output.
+
+    Return a tuple with a string of the NUL-separated fields of the recognized
+    pending changes, and a list of the other lines.
+    """
+    # Pass the profile by name, so that it is cheap to send to the workers of a
+    # process pool
+    regex = PROFILES[profile].regex
+    fields = []
+    others = []
+    for line in text.splitlines():
+        if line[:9] == LINE_PREFIX:
+            match = regex.match(line)
+            if match:
+                fields.extend(match.groups())
+            else:
+                raise exceptions.UnrecognizedItemizedChangeError(line)
+        else:
+            others.append(line)
+    return (FIELD_SEPARATOR.join(fields), others)
+
+
+def iter_records(fields, profile='full'):
+    """
+    Iterate over the lists of Change constructor arguments (except id_)
+    serialized by parse_chunk; the fields not captured by the profile are None.
+    """
+    if not fields:
+        return
+    profile = PROFILES[profile]
+    number = profile.number_of_fields
+    fields = fields.split(FIELD_SEPARATOR)
+
+    if profile.complete:
+        for index in range(0, len(fields), number):
+            yield fields[index:index + number]
+    else:
+        for index in range(0, len(fields), number):
+            record = [None] * len(CHANGE_FIELDS)
+            for position, value in zip(profile.positions,
+                                       fields[index:index + number]):
+                record[position] = value
+            yield record
+
+
+class ParallelParser:
+    """
+    Parse the preview command's output in a pool of processes while rsync is
+    still producing it.
+
+    The output is split in line-aligned chunks, and the results are yielded in
+    the original order, so that the pending changes can be numbered
+    sequentially.
+    """
+    CHUNK_SIZE = 1 << 22
+
+    def __init__(self, workers, profile='full'):
+        self.workers = workers
+        self.profile = profile
+
+    def parse(self, stream):
+        with _m_futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = []
+            remainder = ''
+
+            while True:
+                block = stream.read(self.CHUNK_SIZE)
+                if not block:
+                    break
+                # Only submit complete lines, keep the last partial one for the
+                # next chunk
+                cut = block.rfind('\n') + 1
+                if cut:
+                    pending.append(pool.submit(parse_chunk,
+                                               remainder + block[:cut],
+                                               self.profile))
+                    remainder = block[cut:]
+                else:
+                    remainder += block
+
+                # Merge the chunks that are already parsed while rsync is still
+                # running, always preserving the order
+                while pending and pending[0].done():
+                    yield pending.pop(0).result()
+
+            if remainder:
+                pending.append(pool.submit(parse_chunk, remainder,
+                                           self.profile))
+
+            for future in pending:
+                yield future.result()
@@ -0,0 +1,109 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import time as _m_time
+import threading as _m_threading
+import collections as _m_collections
+
+# changes is the new list of changes, others the lines of the rsync output
+# that are not changes, finished the time.monotonic of the end of the scan
+Prefetched = _m_collections.namedtuple('Prefetched', ('key', 'changes',
+                                                      'returncode', 'others',
+                                                      'finished'))
+
+
+class PreviewPrefetcher:
+    """
+    Run the next preview in a background thread while the pending changes are
+    being reviewed, keeping its result in a second list of changes until the
+    preview command swaps it in.
+
+    The background thread only builds its own list: the pending changes, and
+    thus what the filters and the list views read, are only replaced by the
+    swap, which happens in the interface thread like any other command.
+    """
+    def __init__(self):
+        self.condition = _m_threading.Condition()
+        # The Event that stops the current thread
+        self.stopping = None
+        # The stopping Event of the thread that is running a scan, if any
+        self.scanning = None
+        self.result = None
+
+    def start(self, scan, delay, key):
+        """
+        Call scan(), which must return a (changes, returncode, others) tuple,
+        in a background thread after delay seconds; with a positive delay,
+        repeat it every delay seconds, always keeping only the latest result.
+
+        key identifies the arguments of the scan, so that a result is not
+        used after they have changed.
+        """
+        self.cancel()
+        stopping = self.stopping = _m_threading.Event()
+        _m_threading.Thread(target=self._run, args=(scan, delay, key,
+                                                     stopping),
+                            daemon=True).start()
+
+    def _run(self, scan, delay, key, stopping):
+        while not stopping.wait(delay):
+            with self.condition:
+                if stopping.is_set():
+                    break
+                self.scanning = stopping
+            try:
+                result = Prefetched(key, *scan(), _m_time.monotonic())
+            except Exception:
+                # The preview command will simply run the preview itself
+                result = None
+            with self.condition:
+                if self.scanning is stopping:
+                    self.scanning = None
+                if not stopping.is_set() and result is not None:
+                    self.result = result
+                self.condition.notify_all()
+            if delay <= 0:
+                break
+
+    def cancel(self):
+        """
+        Stop prefetching and forget the last result; a scan that is already
+        running is left to finish, but its result is discarded.
+        """
+        with self.condition:
+            if self.stopping is not None:
+                self.stopping.set()
+                self.stopping = None
+            self.result = None
+            self.condition.notify_all()
+
+    def take(self, key):
+        """
+        Return and forget the latest successful result for key, first waiting
+        for the running scan, if any; return None if there is none.
+        """
+        with self.condition:
+            if self.stopping is not None:
+                stopping = self.stopping
+                self.condition.wait_for(
+                                lambda: self.scanning is not stopping)
+            result = self.result
+            self.result = None
+        if result is None or result.key != key or result.returncode != 0:
+            return None
+        return result
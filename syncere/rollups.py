@@ -0,0 +1,199 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+from .ichange import ichange_flags
+
+ROOT_DIR = './'
+
+
+def change_bytes(change):
+    # The length is unknown with the 'lean' preview profile
+    try:
+        return int(change.length)
+    except (TypeError, ValueError):
+        return 0
+
+
+def parent_dir(change):
+    """
+    Return the directory that contains the change, with a trailing slash.
+    """
+    # Directories have a trailing slash themselves
+    cut = change.sfilename.rstrip('/').rfind('/') + 1
+    return change.sfilename[:cut] or ROOT_DIR
+
+
+def truncate_dir(dirname, depth):
+    if dirname == ROOT_DIR:
+        return dirname
+    components = dirname.split('/')[:-1]
+    if len(components) <= depth:
+        return dirname
+    return '/'.join(components[:depth]) + '/'
+
+
+class Aggregate:
+    """
+    The number of changes and bytes of a group, also broken down by decision.
+    """
+    __slots__ = ('count', 'bytes', 'decision_count', 'decision_bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.decision_count = {None: 0, True: 0, False: 0}
+        self.decision_bytes = {None: 0, True: 0, False: 0}
+
+    def add(self, nbytes, decision):
+        self.count += 1
+        self.bytes += nbytes
+        self.decision_count[decision] += 1
+        self.decision_bytes[decision] += nbytes
+
+    def move(self, nbytes, old, new):
+        self.decision_count[old] -= 1
+        self.decision_bytes[old] -= nbytes
+        self.decision_count[new] += 1
+        self.decision_bytes[new] += nbytes
+
+    def merge(self, other):
+        self.count += other.count
+        self.bytes += other.bytes
+        for decision in self.decision_count:
+            self.decision_count[decision] += other.decision_count[decision]
+            self.decision_bytes[decision] += other.decision_bytes[decision]
+
+
+class Rollups:
+    """
+    Aggregates of the pending changes by parent directory, operation and
+    owner, computed in one pass after the preview and kept up to date when the
+    decisions change, so that the grouped views do not rescan all the changes.
+    """
+    DIMENSIONS = {
+        'dir': parent_dir,
+        'op': lambda change: change.operation,
+        'uid': lambda change: change.uid if change.uid is not None else '?',
+        # There are only a few distinct codes, and the groups by flag are
+        # derived from them
+        'ichange': lambda change: change.icode,
+    }
+    # The dimensions that the list command can show
+    VIEWS = ('dir', 'op', 'uid', 'flag')
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.dimension_to_groups = {dimension: {} for dimension
+                                    in self.DIMENSIONS}
+        self.stale = False
+
+    def clear(self):
+        for groups in self.dimension_to_groups.values():
+            groups.clear()
+        self.stale = False
+
+    def invalidate(self):
+        """
+        Mark the aggregates as outdated, for example because the details of
+        some changes have been retrieved after the preview.
+        """
+        self.stale = True
+
+    def rebuild(self):
+        self.clear()
+        for change in self.changes:
+            nbytes = change_bytes(change)
+            for dimension, key in self.DIMENSIONS.items():
+                groups = self.dimension_to_groups[dimension]
+                group_key = key(change)
+                try:
+                    aggregate = groups[group_key]
+                except KeyError:
+                    aggregate = groups[group_key] = Aggregate()
+                aggregate.add(nbytes, change.included)
+
+    def update(self, change, old):
+        """
+        Move a change whose decision was old to its current decision.
+        """
+        if self.stale:
+            # Everything will be recomputed anyway
+            return
+        nbytes = change_bytes(change)
+        for dimension, key in self.DIMENSIONS.items():
+            self.dimension_to_groups[dimension][key(change)].move(
+                                            nbytes, old, change.included)
+
+    def groups(self, dimension, depth=None):
+        """
+        Return a dictionary of group key -> Aggregate.
+
+        The directory groups can be limited to the first depth components.
+        """
+        if self.stale:
+            self.rebuild()
+        if dimension == 'flag':
+            return self._flag_groups(self.dimension_to_groups['ichange'])
+        groups = self.dimension_to_groups[dimension]
+        if dimension != 'dir' or depth is None:
+            return groups
+
+        truncated = {}
+        for dirname, aggregate in groups.items():
+            key = truncate_dir(dirname, depth)
+            try:
+                truncated[key].merge(aggregate)
+            except KeyError:
+                truncated[key] = Aggregate()
+                truncated[key].merge(aggregate)
+        return truncated
+
+    @classmethod
+    def aggregate(cls, changes, dimension, depth=None):
+        """
+        Compute the groups of an arbitrary selection of changes in one pass.
+        """
+        if dimension == 'flag':
+            return cls._flag_groups(cls.aggregate(changes, 'ichange'))
+        key = cls.DIMENSIONS[dimension]
+        groups = {}
+        for change in changes:
+            group_key = key(change)
+            if dimension == 'dir' and depth is not None:
+                group_key = truncate_dir(group_key, depth)
+            try:
+                aggregate = groups[group_key]
+            except KeyError:
+                aggregate = groups[group_key] = Aggregate()
+            aggregate.add(change_bytes(change), change.included)
+        return groups
+
+    @staticmethod
+    def _flag_groups(code_groups):
+        """
+        Merge the groups by itemized change code into one group for each
+        changed attribute, so that a change can be in several groups.
+        """
+        groups = {}
+        for code, aggregate in code_groups.items():
+            for flag in ichange_flags(code):
+                try:
+                    groups[flag].merge(aggregate)
+                except KeyError:
+                    groups[flag] = Aggregate()
+                    groups[flag].merge(aggregate)
+        return groups
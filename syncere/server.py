@@ -0,0 +1,263 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import io as _m_io
+import os as _m_os
+import json as _m_json
+import tempfile as _m_tempfile
+import threading as _m_threading
+import contextlib as _m_contextlib
+import socketserver as _m_socketserver
+
+from . import parsing
+from .rollups import change_bytes
+
+# The number of ids sent in each line of a 'select' response
+IDS_PER_LINE = 1024
+
+
+class _RequestHandler(_m_socketserver.StreamRequestHandler):
+    """
+    Read one JSON object per line, and answer each request with zero or more
+    JSON lines, terminated by a line with an "end" key.
+    """
+    # Buffer the streamed responses, they are flushed at the end of each one
+    wbufsize = 1 << 16
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = _m_json.loads(line.decode())
+                command = request['command']
+                args = request.get('args', [])
+                if not isinstance(args, list) or not all(
+                                    isinstance(arg, str) for arg in args):
+                    raise ValueError()
+                method = self.server.COMMANDS[command]
+            except (ValueError, KeyError, TypeError):
+                self._send({'end': True, 'ok': False,
+                            'error': 'Bad request'})
+                continue
+
+            try:
+                for response in method(self.server, *args):
+                    self._send(response)
+            except ConnectionError:
+                # The client has gone away
+                return
+            except Exception as exc:
+                # e.g. the wrong number of arguments, or a command that
+                # failed: the client must still receive the end of the
+                # response, and the session must survive
+                self._send({'end': True, 'ok': False, 'error': str(exc)})
+                continue
+            if command == 'shutdown':
+                return
+
+    def _send(self, response):
+        self.wfile.write(_m_json.dumps(response).encode() + b'\n')
+        if 'end' in response:
+            self.wfile.flush()
+
+
+class SessionServer(_m_socketserver.ThreadingMixIn,
+                    _m_socketserver.UnixStreamServer):
+    """
+    Expose the pending changes of a session to other processes through a
+    Unix-domain socket.
+
+    All the requests that read or modify the session are serialized by a
+    lock; the records of large selections are copied while holding the lock,
+    and sent to the client after releasing it.
+    """
+    daemon_threads = True
+
+    def __init__(self, rootapp, path, selector, menu):
+        # selector parses the filter arguments of the 'list' command and
+        # returns the selected changes; menu runs the commands that print
+        # their results
+        self.rootapp = rootapp
+        self.path = path
+        self.selector = selector
+        self.menu = menu
+        self.lock = _m_threading.RLock()
+        super().__init__(path, _RequestHandler)
+
+    def server_bind(self):
+        # The socket is bound in a private directory, where no other user can
+        # connect to it before its permissions are restricted, and only then
+        # linked to its path, which fails if the path already exists
+        directory = _m_tempfile.mkdtemp(prefix='.syncere-', dir=(
+                        _m_os.path.dirname(_m_os.path.abspath(self.path))))
+        private = _m_os.path.join(directory, 'socket')
+        try:
+            self.socket.bind(private)
+            _m_os.chmod(private, 0o600)
+            _m_os.link(private, self.path)
+        finally:
+            try:
+                _m_os.remove(private)
+            except FileNotFoundError:
+                pass
+            _m_os.rmdir(directory)
+        self.server_address = self.path
+
+    def server_close(self):
+        super().server_close()
+        try:
+            _m_os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @_m_contextlib.contextmanager
+    def _capture(self):
+        # The lock serializes all the commands, so the standard output can be
+        # redirected globally
+        output = _m_io.StringIO()
+        with self.lock, _m_contextlib.redirect_stdout(output):
+            yield output
+
+    def _select(self, args):
+        """
+        Return the selected changes and the messages printed while selecting
+        them; the lock must be held.
+        """
+        with _m_contextlib.redirect_stdout(_m_io.StringIO()) as output:
+            changes = self.selector(*args)
+        return (changes, output.getvalue().splitlines())
+
+    def status(self):
+        with self.lock:
+            rootapp = self.rootapp
+            response = {'end': True, 'ok': True,
+                        'preview_needed': rootapp.preview_needed,
+                        'pending': len(rootapp.pending_changes)}
+            if not rootapp.preview_needed:
+                for decision, label in ((True, 'included'),
+                                        (False, 'excluded'),
+                                        (None, 'undecided')):
+                    count = 0
+                    nbytes = 0
+                    for aggregate in rootapp.rollups.groups('op').values():
+                        count += aggregate.decision_count[decision]
+                        nbytes += aggregate.decision_bytes[decision]
+                    response[label] = count
+                    response[label + '_bytes'] = nbytes
+        yield response
+
+    def list_(self, *args):
+        with self.lock:
+            changes, messages = self._select(args)
+            if changes is None:
+                records = None
+            else:
+                records = [(change.id_, change.included,
+                            *(getattr(change, field)
+                              for field in parsing.CHANGE_FIELDS))
+                           for change in changes]
+        if records is None:
+            yield {'end': True, 'ok': False, 'messages': messages}
+            return
+        for id_, included, *fields in records:
+            record = dict(zip(parsing.CHANGE_FIELDS, fields))
+            record['id'] = id_
+            record['included'] = included
+            yield record
+        yield {'end': True, 'ok': True, 'count': len(records),
+               'messages': messages}
+
+    def select(self, *args):
+        with self.lock:
+            changes, messages = self._select(args)
+            ids = None if changes is None else [change.id_
+                                                for change in changes]
+        if ids is None:
+            yield {'end': True, 'ok': False, 'messages': messages}
+            return
+        for index in range(0, len(ids), IDS_PER_LINE):
+            yield {'ids': ids[index:index + IDS_PER_LINE]}
+        yield {'end': True, 'ok': True, 'count': len(ids),
+               'messages': messages}
+
+    def _decide(self, decision, args):
+        with self.lock:
+            changes, messages = self._select(args)
+            if changes is not None:
+                self.rootapp.decide(changes, decision)
+                nbytes = sum(change_bytes(change) for change in changes)
+        if changes is None:
+            yield {'end': True, 'ok': False, 'messages': messages}
+        else:
+            yield {'end': True, 'ok': True, 'count': len(changes),
+                   'bytes': nbytes, 'messages': messages}
+
+    def include(self, *args):
+        return self._decide(True, args)
+
+    def exclude(self, *args):
+        return self._decide(False, args)
+
+    def reset(self, *args):
+        return self._decide(None, args)
+
+    def _run(self, *args):
+        ok = True
+        with self._capture() as output:
+            try:
+                self.menu.run_command(*args)
+            except self.menu.BreakLoops:
+                pass
+            except SystemExit:
+                # The preview command exits if rsync fails, but the session
+                # must survive
+                ok = False
+        yield {'end': True, 'ok': ok,
+               'messages': output.getvalue().splitlines()}
+
+    def preview(self, *args):
+        return self._run('preview', *args)
+
+    def transfer(self, *args):
+        # The lock is held until rsync terminates, so that the decisions
+        # cannot change in the meantime
+        with self.lock:
+            self.rootapp.metrics.transfer_returncode = None
+            for response in self._run('transfer', *args):
+                response['returncode'] = \
+                    self.rootapp.metrics.transfer_returncode
+                response['ok'] = response['ok'] and \
+                    response['returncode'] in (None, 0)
+        yield response
+
+    def shutdown_(self):
+        yield {'end': True, 'ok': True}
+        # shutdown waits for serve_forever to return, which happens in
+        # another thread
+        _m_threading.Thread(target=self.shutdown).start()
+
+    COMMANDS = {
+        'status': status,
+        'list': list_,
+        'select': select,
+        'include': include,
+        'exclude': exclude,
+        'reset': reset,
+        'preview': preview,
+        'transfer': transfer,
+        'shutdown': shutdown_,
+    }
@@ -0,0 +1,281 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+# This module does not import anything from the package, so that it can also
+# be executed as a script, e.g.
+#   --rsync-executable='python3 /path/to/simulator.py --sim-changes=1e6'
+
+import os as _m_os
+import sys as _m_sys
+import re as _m_re
+import json as _m_json
+import time as _m_time
+import hashlib as _m_hashlib
+import argparse as _m_argparse
+
+# The options that make rsync read a list of paths from a file
+LIST_OPTIONS = ('--exclude-from', '--include-from', '--files-from')
+FORMAT_ESCAPE = _m_re.compile(r'%([a-zA-Z])')
+FORMAT_KEYS = 'ioBUGlMfnLC'
+# The number of changes written at once
+CHUNK_SIZE = 10000
+# rsync's return code for a partial transfer
+PARTIAL_TRANSFER = 23
+# The earliest and latest modification times of the simulated files
+EPOCH = 1262304000
+SPAN = 1 << 28
+
+
+class SimulatedChange:
+    """
+    The attributes of a simulated pending change, all derived from a hash of
+    its path, so that the same path always produces the same change, also
+    when its details are requested again with --files-from.
+    """
+    __slots__ = ('values', )
+
+    def __init__(self, path, seed, max_size, delete_ratio):
+        digest = _m_hashlib.blake2b('{}:{}'.format(seed, path).encode(),
+                                    digest_size=16).digest()
+        isdir = path.endswith('/')
+        size = 4096 if isdir else int.from_bytes(digest[:4], 'big') % (
+                                                                max_size + 1)
+        tstamp = _m_time.strftime('%Y/%m/%d-%H:%M:%S', _m_time.gmtime(
+                        EPOCH + int.from_bytes(digest[4:8], 'big') % SPAN))
+        if not isdir and digest[8] < delete_ratio * 256:
+            ichange, operation = '*deleting  ', 'del.'
+        elif isdir:
+            ichange, operation = 'cd+++++++++', 'send'
+        elif digest[9] < 64:
+            ichange, operation = '>f.st......', 'send'
+        else:
+            ichange, operation = '>f+++++++++', 'send'
+        self.values = {
+            'i': ichange,
+            'o': operation,
+            'B': 'rwxr-xr-x' if isdir else 'rw-r--r--',
+            'U': '1000',
+            'G': '1000',
+            'l': str(size),
+            'M': tstamp,
+            'f': path,
+            'n': path,
+            'L': '',
+            'C': ' ' * 32 if isdir else digest.hex(),
+        }
+
+    def format(self, template):
+        return template.format_map(self.values)
+
+
+def compile_format(out_format):
+    """
+    Convert an rsync --out-format into a str.format template, so that the
+    escapes are not searched again for each change.
+    """
+    template = out_format.replace('{', '{{').replace('}', '}}')
+    # Any escape other than the ones in SimulatedChange.values is rendered as
+    # an empty string
+    return FORMAT_ESCAPE.sub(lambda match: '{{{}}}'.format(match.group(1))
+                             if match.group(1) in FORMAT_KEYS else '',
+                             template)
+
+
+def iter_paths(count, files_per_dir):
+    """
+    Yield count paths, each directory followed by its files, as rsync lists
+    them.
+    """
+    index = 0
+    directory = 0
+    while index < count:
+        dirname = 'd{:06d}/'.format(directory)
+        yield dirname
+        index += 1
+        for number in range(min(files_per_dir, count - index)):
+            yield '{}f{:05d}.dat'.format(dirname, number)
+        index += min(files_per_dir, count - index)
+        directory += 1
+
+
+def _parse_arguments(argv):
+    parser = _m_argparse.ArgumentParser(
+                    prog='syncere-rsync-simulator', add_help=False,
+                    allow_abbrev=False,
+                    description='Imitate the rsync commands executed by '
+                                'syncere, without transferring any file.')
+    # Accept for example 1e6
+    parser.add_argument('--sim-changes', type=lambda value: int(float(value)),
+                        default=1000,
+                        help='the number of pending changes to preview')
+    parser.add_argument('--sim-rate', type=float, default=0,
+                        help='the pending changes previewed per second, 0 '
+                             'means as fast as possible')
+    parser.add_argument('--sim-seed', default='0',
+                        help='the seed of the attributes of the changes')
+    parser.add_argument('--sim-files-per-dir', type=int, default=100)
+    parser.add_argument('--sim-max-size', type=int, default=1 << 20,
+                        help='the maximum size of the files, in bytes')
+    parser.add_argument('--sim-delete-ratio', type=float, default=0.05,
+                        help='the fraction of files to be deleted')
+    parser.add_argument('--sim-record',
+                        help='append a JSON line with the arguments and the '
+                             'lists of paths of each transfer to this file')
+    parser.add_argument('--sim-exit-code', type=int, default=0,
+                        help='the return code of the transfers')
+    parser.add_argument('--sim-fail-after', type=int,
+                        help='make the transfers of more changes fail after '
+                             'this number, with return code 23')
+    # There is no -h/--help option, since -h is also an rsync option
+    return parser.parse_known_args(argv)
+
+
+def _option_values(args, option):
+    # rsync options are passed as --option=value or --option value
+    values = []
+    for index, arg in enumerate(args):
+        if arg.startswith(option + '='):
+            values.append(arg[len(option) + 1:])
+        elif arg == option and index + 1 < len(args):
+            values.append(args[index + 1])
+    return values
+
+
+def _option_value(args, option):
+    values = _option_values(args, option)
+    return values[0] if values else None
+
+
+def _preview(options, args, out_format):
+    template = compile_format(out_format)
+
+    def make(path):
+        return SimulatedChange(path, options.sim_seed, options.sim_max_size,
+                               options.sim_delete_ratio).format(template)
+
+    if _option_value(args, '--files-from') == '-':
+        # The details of some selected changes
+        for line in _m_sys.stdin:
+            path = line.rstrip('\n')
+            if path:
+                _m_sys.stdout.write(make(path) + '\n')
+        return
+
+    # Keep the rate smooth also when it is low
+    size = CHUNK_SIZE if options.sim_rate <= 0 else max(1, min(
+                                    CHUNK_SIZE, int(options.sim_rate / 10)))
+    start = _m_time.monotonic()
+    chunk = []
+    written = 0
+    for path in iter_paths(options.sim_changes, options.sim_files_per_dir):
+        chunk.append(make(path))
+        if len(chunk) == size:
+            _m_sys.stdout.write('\n'.join(chunk) + '\n')
+            written += len(chunk)
+            chunk.clear()
+            if options.sim_rate > 0:
+                delay = written / options.sim_rate - (_m_time.monotonic() -
+                                                      start)
+                if delay > 0:
+                    _m_sys.stdout.flush()
+                    _m_time.sleep(delay)
+    if chunk:
+        _m_sys.stdout.write('\n'.join(chunk) + '\n')
+
+
+def _read_lists(args):
+    lists = {}
+    for option in LIST_OPTIONS:
+        path = _option_value(args, option)
+        if path is not None and path != '-':
+            with open(path) as file_:
+                lists[option] = file_.read().splitlines()
+    return lists
+
+
+def _transferred(options, args, lists):
+    """
+    Return the paths of the previewed changes that the filters of a transfer
+    command generated by syncere let through.
+    """
+    for option in ('--files-from', '--include-from'):
+        if option in lists:
+            return lists[option]
+    # The include mode lists the included paths, followed by --exclude=*
+    includes = _option_values(args, '--include')
+    if includes:
+        return includes
+    excluded = set(_option_values(args, '--exclude'))
+    excluded.update(lists.get('--exclude-from', ()))
+    return [path for path in iter_paths(options.sim_changes,
+                                        options.sim_files_per_dir)
+            if path not in excluded]
+
+
+def _transfer(options, args):
+    lists = _read_lists(args)
+    if options.sim_record is not None:
+        with open(options.sim_record, 'a') as record:
+            record.write(_m_json.dumps({'args': args, 'lists': lists}) +
+                         '\n')
+
+    paths = None
+    failed = False
+    if options.sim_fail_after is not None:
+        paths = _transferred(options, args, lists)
+        if len(paths) > options.sim_fail_after:
+            paths = paths[:options.sim_fail_after]
+            failed = True
+
+    log = _option_value(args, '--log-file')
+    if log is not None:
+        if paths is None:
+            paths = _transferred(options, args, lists)
+        template = compile_format(_option_value(args, '--log-file-format') or
+                                  '%i %n%L')
+        # Imitate the prefix of rsync's log lines
+        prefix = '{} [{}] '.format(_m_time.strftime('%Y/%m/%d %H:%M:%S'),
+                                   _m_os.getpid())
+        with open(log, 'a') as logfile:
+            for path in paths:
+                logfile.write(prefix + SimulatedChange(
+                                path, options.sim_seed, options.sim_max_size,
+                                options.sim_delete_ratio).format(template) +
+                              '\n')
+
+    return PARTIAL_TRANSFER if failed else options.sim_exit_code
+
+
+def main(argv=None):
+    options, args = _parse_arguments(_m_sys.argv[1:] if argv is None
+                                     else argv)
+    out_format = _option_value(args, '--out-format')
+
+    # Only the internal preview commands request syncere's own format
+    if out_format is not None and out_format.startswith('{syncere}'):
+        batch = _option_value(args, '--only-write-batch')
+        if batch is not None:
+            open(batch, 'w').close()
+        _preview(options, args, out_format)
+        return 0
+
+    return _transfer(options, args)
+
+
+if __name__ == '__main__':
+    _m_sys.exit(main())
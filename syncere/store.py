@@ -0,0 +1,605 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import sqlite3 as _m_sqlite3
+import threading as _m_threading
+import weakref as _m_weakref
+import itertools as _m_itertools
+import collections.abc as _m_abc
+
+from .parsing import CHANGE_FIELDS
+
+# The columns of the changes table; the decision is NULL, 1 or 0
+COLUMNS = ('id', 'included', 'mark', 'destinations', 'icode', *CHANGE_FIELDS)
+# The columns of the indexes, i.e. the path, operation, size, timestamp and
+# decision
+INDEXED = ('sfilename', 'operation', 'length', 'tstamp', 'included')
+DETAIL_COLUMNS = ('permissions', 'uid', 'gid', 'length', 'tstamp',
+                  'lfilename', 'checksum')
+# The number of rows inserted or read at a time, and of the decisions and
+# details written back at a time
+BATCH_SIZE = 4096
+# Each staging store has its own table, numbered from this counter, so that
+# a background preview never drops the rows of another one
+STAGING_TABLE = 'staging{}'
+_STAGING_IDS = _m_itertools.count(1)
+# The temporary tables where the queries copy the ids of their results
+_QUERY_IDS = _m_itertools.count(1)
+# The columns copied as they are by a refresh, i.e. all but the id, the
+# decision and the mark
+COPIED = COLUMNS[3:]
+
+
+def _encode(change):
+    return (change.id_,
+            None if change.included is None else int(change.included),
+            change.mark, ','.join(map(str, change.destinations)),
+            change.icode, *(getattr(change, field) for field in CHANGE_FIELDS))
+
+
+def _close(connection, path):
+    connection.close()
+    try:
+        _m_os.remove(path)
+    except OSError:
+        pass
+
+
+def _drop(connection, lock, table):
+    with lock:
+        try:
+            connection.execute('DROP TABLE IF EXISTS ' + table)
+        except _m_sqlite3.Error:
+            # e.g. the connection has already been closed
+            pass
+
+
+class ChangeStore(_m_abc.MutableSequence):
+    """
+    A sequence of pending changes kept in a SQLite database instead of memory,
+    for the sessions whose changes would not fit in it.
+
+    Like the list that it replaces, the changes are numbered by their
+    1-based positions. Reading a change creates an object of change_class
+    from its row, which only lives as long as it is referenced; while it
+    does, reading the same change again returns the same object. The
+    decisions and details set on the objects are written back in batches,
+    always before the next query.
+
+    where() returns a ChangeQuery, which reads only the rows that satisfy an
+    SQL condition, through the indexes, and streams them in batches.
+    refresh() and merge() replace the rows with those of a new preview in
+    SQL, without reading them.
+
+    The database file is deleted by close(), which is also called when the
+    store is garbage-collected or syncere quits.
+    """
+    def __init__(self, path, change_class, connection=None, table='changes',
+                 lock=None):
+        self.path = path
+        # The class of the objects created from the rows, which write their
+        # decisions and details back, see StoredChange
+        self.change_class = change_class
+        self.table = table
+        if connection is None:
+            # The path is a scratch file: a previous session's one is simply
+            # replaced, and nothing needs to survive a crash
+            try:
+                _m_os.remove(path)
+            except FileNotFoundError:
+                pass
+            # The details can be set by the DetailsFetcher's threads, but
+            # they only fill self.dirty_details; the staging stores can
+            # instead be filled by the prefetcher's thread, so all the stores
+            # of the connection serialize its use with the same lock
+            connection = _m_sqlite3.connect(path, check_same_thread=False)
+            lock = _m_threading.RLock()
+            connection.execute('PRAGMA journal_mode = MEMORY')
+            connection.execute('PRAGMA synchronous = OFF')
+            # Also when syncere quits
+            self.close = _m_weakref.finalize(self, _close, connection, path)
+        self.connection = connection
+        self.lock = lock
+        self.thread = _m_threading.get_ident()
+        with self.lock:
+            self.connection.execute('DROP TABLE IF EXISTS ' + table)
+            self.connection.execute(
+                        'CREATE TABLE {} (id INTEGER PRIMARY KEY, {})'.format(
+                                            table, ', '.join(COLUMNS[1:])))
+        self.count = 0
+        # The appended changes that have not been inserted yet
+        self.buffer = []
+        # id -> decision, and id -> change object, to be written back
+        self.dirty_decisions = {}
+        self.dirty_details = {}
+        # id -> the object that currently represents the row
+        self.live = _m_weakref.WeakValueDictionary()
+
+    def staging(self):
+        """
+        Return an empty store in the same database, where a preview can
+        stream its changes before they replace the pending ones with
+        extend(), which then only copies the rows; it can be filled by
+        another thread. Its table is dropped when it is garbage-collected.
+        """
+        table = STAGING_TABLE.format(next(_STAGING_IDS))
+        store = ChangeStore(self.path, self.change_class,
+                            connection=self.connection, table=table,
+                            lock=self.lock)
+        _m_weakref.finalize(store, _drop, self.connection, self.lock, table)
+        return store
+
+    def _create_indexes(self):
+        with self.lock:
+            for column in INDEXED:
+                self.connection.execute(
+                        'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'
+                        .format(self.table, column))
+
+    def _drop_indexes(self):
+        with self.lock:
+            for column in INDEXED:
+                self.connection.execute('DROP INDEX IF EXISTS {}_{}'.format(
+                                                        self.table, column))
+
+    def flush(self):
+        """
+        Insert the appended changes, and write back the decisions and details
+        set since the last flush.
+        """
+        if self.buffer:
+            buffer = self.buffer
+            self.buffer = []
+            self._insert(buffer)
+        if self.dirty_decisions:
+            decisions = self.dirty_decisions
+            self.dirty_decisions = {}
+            with self.lock, self.connection:
+                self.connection.executemany(
+                        'UPDATE {} SET included = ? WHERE id = ?'.format(
+                                                                self.table),
+                        ((None if decision is None else int(decision), id_)
+                         for id_, decision in decisions.items()))
+        if self.dirty_details:
+            changes = self.dirty_details
+            self.dirty_details = {}
+            with self.lock, self.connection:
+                self.connection.executemany(
+                        'UPDATE {} SET {} WHERE id = ?'.format(
+                            self.table, ', '.join(column + ' = ?' for column
+                                                  in DETAIL_COLUMNS)),
+                        ((*(getattr(change, column) for column
+                            in DETAIL_COLUMNS), id_)
+                         for id_, change in changes.items()))
+
+    def flush_soon(self):
+        # The setters may run in other threads, which must not use the
+        # connection, and only flush the batches when they are full
+        if len(self.dirty_decisions) >= BATCH_SIZE or \
+                len(self.dirty_details) >= BATCH_SIZE:
+            if _m_threading.get_ident() == self.thread:
+                self.flush()
+
+    def _insert(self, changes):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                        'INSERT INTO {} VALUES ({})'.format(
+                                    self.table, ', '.join('?' * len(COLUMNS))),
+                        map(_encode, changes))
+        for change in changes:
+            if isinstance(change, self.change_class):
+                # e.g. the changes kept by a refresh of the preview
+                change.store = self
+                self.live[change.id_] = change
+
+    def _make(self, row):
+        try:
+            return self.live[row[0]]
+        except KeyError:
+            pass
+        change = self.change_class.__new__(self.change_class)
+        values = dict(zip(COLUMNS, row))
+        change.id_ = values.pop('id')
+        change._included = {None: None, 1: True, 0: False}[
+                                                    values.pop('included')]
+        change.destinations = tuple(int(index) for index
+                                    in values.pop('destinations').split(','))
+        change.__dict__.update(values)
+        change.store = self
+        self.live[change.id_] = change
+        return change
+
+    def query(self, where='', params=(), order='id', order_params=()):
+        """
+        Iterate over the changes that satisfy an SQL condition, by default in
+        order of id.
+
+        The ids of the results are first copied in order to a temporary
+        table, which is then read in batches: no statement is left pending
+        while the caller writes decisions and details back.
+        """
+        self.flush()
+        snapshot = 'query{}'.format(next(_QUERY_IDS))
+        with self.lock, self.connection:
+            self.connection.execute(
+                        'CREATE TEMP TABLE {} (position INTEGER PRIMARY KEY, '
+                        'id INTEGER)'.format(snapshot))
+            self.connection.execute(
+                        'INSERT INTO temp.{} (id) SELECT id FROM {} {} '
+                        'ORDER BY {}'.format(
+                            snapshot, self.table,
+                            'WHERE ' + where if where else '', order),
+                        (*params, *order_params))
+        try:
+            position = 0
+            while True:
+                with self.lock:
+                    rows = self.connection.execute(
+                            'SELECT snapshot.position, changes.* '
+                            'FROM temp.{} AS snapshot '
+                            'JOIN {} AS changes ON changes.id = snapshot.id '
+                            'WHERE snapshot.position > ? '
+                            'ORDER BY snapshot.position LIMIT ?'.format(
+                                                    snapshot, self.table),
+                            (position, BATCH_SIZE)).fetchall()
+                if not rows:
+                    break
+                position = rows[-1][0]
+                for row in rows:
+                    yield self._make(row[1:])
+        finally:
+            _drop(self.connection, self.lock, 'temp.' + snapshot)
+
+    def get(self, id_):
+        """
+        Return the change with the given id.
+        """
+        try:
+            return self.live[id_]
+        except KeyError:
+            pass
+        self.flush()
+        with self.lock:
+            row = self.connection.execute(
+                        'SELECT * FROM {} WHERE id = ?'.format(self.table),
+                        (id_, )).fetchone()
+        if row is None:
+            raise IndexError(id_ - 1)
+        return self._make(row)
+
+    def first_path(self, start, stop=None, strict=False):
+        """
+        Return the first path in order, through the index, that is greater
+        than start, or equal to it unless strict, and less than stop, if it
+        is not None; return None if there is none.
+        """
+        self.flush()
+        with self.lock:
+            row = self.connection.execute(
+                        'SELECT sfilename FROM {} WHERE sfilename {} ? {} '
+                        'ORDER BY sfilename LIMIT 1'.format(
+                            self.table, '>' if strict else '>=',
+                            '' if stop is None else 'AND sfilename < ?'),
+                        (start, ) if stop is None else (start, stop)
+                        ).fetchone()
+        return None if row is None else row[0]
+
+    def where(self, conditions=(), params=(), order='id', order_params=()):
+        """
+        Return a ChangeQuery of the changes that satisfy all the conditions.
+        """
+        return ChangeQuery(self, ' AND '.join('({})'.format(condition)
+                                               for condition in conditions),
+                           tuple(params), order, tuple(order_params))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.query()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return list(self)[index]
+            if start >= stop:
+                return []
+            return list(self.query('id BETWEEN ? AND ?', (start + 1, stop)))
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.get(index + 1)
+
+    def clear(self):
+        self.buffer = []
+        self.dirty_decisions = {}
+        self.dirty_details = {}
+        self.live.clear()
+        # extend() builds them again
+        self._drop_indexes()
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM ' + self.table)
+        self.count = 0
+
+    def append(self, change):
+        change.id_ = self.count + 1
+        self.buffer.append(change)
+        self.count += 1
+        if len(self.buffer) >= BATCH_SIZE:
+            self.flush()
+
+    def extend(self, changes):
+        if isinstance(changes, ChangeStore) and \
+                changes.connection is self.connection and changes is not self:
+            # Only copy the rows, renumbering them
+            changes.flush()
+            self.flush()
+            # Building the indexes once at the end is faster than updating
+            # them for each row
+            self._drop_indexes()
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'INSERT INTO {0} SELECT id + ?, {1} FROM {2} ORDER BY id'
+                    .format(self.table, ', '.join(COLUMNS[1:]),
+                            changes.table), (self.count, ))
+            self._create_indexes()
+            # The objects already read from the other store now represent
+            # the copied rows, where their decisions must be written back
+            for change in list(changes.live.values()):
+                change.id_ += self.count
+                change.store = self
+                self.live[change.id_] = change
+            changes.live.clear()
+            self.count += len(changes)
+            return
+        for change in list(changes) if changes is self else changes:
+            self.append(change)
+        self.flush()
+        self._create_indexes()
+
+    def _staged(self, changes):
+        # The new changes must be in a table of the same database
+        if isinstance(changes, ChangeStore) and \
+                changes.connection is self.connection and changes is not self:
+            changes.flush()
+            return changes
+        staging = self.staging()
+        staging.extend(changes)
+        return staging
+
+    def _pair(self, new, fields):
+        """
+        Pair the rows of the staging store new with the rows of the same path,
+        preferably for the same destinations, in the temporary table pairs,
+        telling whether the fields are also the same.
+        """
+        execute = self.connection.execute
+        execute('DROP TABLE IF EXISTS temp.pairs')
+        execute('CREATE TEMP TABLE pairs (new_id INTEGER PRIMARY KEY, '
+                'old_id INTEGER UNIQUE, same INTEGER)')
+        # The n-th row of a path in each table is paired with the n-th one
+        # in the other, first among the rows for the same destinations, then
+        # among the remaining ones
+        ranked = ('SELECT id, sfilename, destinations, ROW_NUMBER() OVER '
+                  '(PARTITION BY sfilename{1} ORDER BY id) AS rank FROM {0} '
+                  'WHERE id NOT IN (SELECT {2} FROM temp.pairs)')
+        for partition, using in ((', destinations',
+                                  'sfilename, destinations, rank'),
+                                 ('', 'sfilename, rank')):
+            execute('INSERT INTO temp.pairs (new_id, old_id) '
+                    'SELECT n.id, o.id FROM ({}) AS n JOIN ({}) AS o '
+                    'USING ({})'.format(
+                        ranked.format(new.table, partition, 'new_id'),
+                        ranked.format(self.table, partition, 'old_id'),
+                        using))
+        execute('UPDATE temp.pairs SET same = (SELECT {} FROM {} AS n, '
+                '{} AS o WHERE n.id = pairs.new_id AND o.id = pairs.old_id)'
+                .format(
+                    ' AND '.join('o.{0} IS n.{0}'.format(field) for field
+                                 in (*fields, 'destinations')),
+                    new.table, self.table))
+        execute('DROP TABLE IF EXISTS temp.layout')
+        # The rows of the result: those copied from this store have old_id,
+        # the others new_id and their mark
+        execute('CREATE TEMP TABLE layout (id INTEGER PRIMARY KEY, '
+                'old_id INTEGER, new_id INTEGER, mark)')
+
+    def _marks(self):
+        # The numbers of new and altered changes in the temporary table
+        # layout
+        counts = {'new': 0, 'altered': 0}
+        counts.update(self.connection.execute(
+                        'SELECT mark, COUNT(*) FROM temp.layout WHERE mark IS '
+                        'NOT NULL GROUP BY mark'))
+        return counts
+
+    def _swap(self, new, kept_mark):
+        """
+        Replace the rows with the ones described by the temporary table
+        layout, and rebind the objects of the rows that are kept.
+        """
+        execute = self.connection.execute
+        execute('CREATE INDEX temp.layout_old_id ON layout (old_id)')
+        execute('CREATE INDEX temp.layout_new_id ON layout (new_id)')
+        table = self.table + '_swap'
+        execute('DROP TABLE IF EXISTS ' + table)
+        execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, {})'.format(
+                                            table, ', '.join(COLUMNS[1:])))
+        copied = ', '.join('{0}.' + column for column in COPIED)
+        execute('INSERT INTO {0} SELECT layout.id, o.included, {1}, {2} '
+                'FROM temp.layout JOIN {3} AS o ON o.id = layout.old_id'
+                .format(table, kept_mark, copied.format('o'), self.table))
+        execute('INSERT INTO {0} SELECT layout.id, n.included, layout.mark, '
+                '{1} FROM temp.layout JOIN {2} AS n ON n.id = layout.new_id'
+                .format(table, copied.format('n'), new.table))
+
+        # The objects of the rows that are not in the result any longer
+        # are simply detached
+        live = _m_weakref.WeakValueDictionary()
+        for store, column, mark in ((self, 'old_id', kept_mark != 'o.mark'),
+                                    (new, 'new_id', True)):
+            changes = dict(store.live.items())
+            store.live.clear()
+            for change in changes.values():
+                change.store = None
+            ids = list(changes)
+            for index in range(0, len(ids), 500):
+                batch = ids[index:index + 500]
+                for old_id, id_, new_mark in execute(
+                        'SELECT {0}, id, mark FROM temp.layout WHERE {0} IN '
+                        '({1})'.format(column, ', '.join('?' * len(batch))),
+                        batch).fetchall():
+                    change = changes[old_id]
+                    change.id_ = id_
+                    if mark:
+                        change.mark = new_mark
+                    change.store = self
+                    live[id_] = change
+        self.live = live
+
+        execute('DROP TABLE ' + self.table)
+        execute('ALTER TABLE {} RENAME TO {}'.format(table, self.table))
+        self.count = execute('SELECT COUNT(*) FROM temp.layout').fetchone()[0]
+        execute('DROP TABLE temp.layout')
+        execute('DROP TABLE temp.pairs')
+
+    def refresh(self, changes, fields):
+        """
+        Replace the changes with the ones of a new preview, in their order,
+        keeping the rows, with their decisions and details, of the changes
+        whose fields and destinations have not been altered; the new and
+        altered changes are marked. The rows are joined by path in SQL.
+
+        Return the numbers of kept, added, altered and vanished changes.
+        """
+        self.flush()
+        new = self._staged(changes)
+        with self.lock, self.connection:
+            self._pair(new, fields)
+            execute = self.connection.execute
+            execute("INSERT INTO temp.layout SELECT n.id, "
+                    "CASE WHEN p.same THEN p.old_id END, "
+                    "CASE WHEN p.same THEN NULL ELSE n.id END, "
+                    "CASE WHEN p.old_id IS NULL THEN 'new' "
+                    "WHEN NOT p.same THEN 'altered' END "
+                    "FROM {} AS n LEFT JOIN temp.pairs AS p "
+                    "ON p.new_id = n.id".format(new.table))
+            paired = execute('SELECT COUNT(*) FROM temp.pairs').fetchone()[0]
+            counts = self._marks()
+            vanished = self.count - paired
+            self._swap(new, 'NULL')
+        self._create_indexes()
+        return (paired - counts['altered'], counts['new'], counts['altered'],
+                vanished)
+
+    def merge(self, changes, fields, covers):
+        """
+        Update the changes whose paths satisfy covers, a function, with the
+        ones of a partial preview, keeping the rows of the changes that have
+        not been altered; the rows are then renumbered, and the added
+        changes follow the others.
+
+        Return the numbers of added, altered and removed changes.
+        """
+        self.flush()
+        new = self._staged(changes)
+        with self.lock, self.connection:
+            self._pair(new, fields)
+            execute = self.connection.execute
+            self.connection.create_function('syncere_covers', 1,
+                                            lambda path: bool(covers(path)))
+            try:
+                # rsync may also report some paths that were not asked for,
+                # e.g. the deletions in a listed directory
+                execute("INSERT INTO temp.layout (old_id, new_id, mark) "
+                        "SELECT CASE WHEN p.same = 0 THEN NULL ELSE o.id END, "
+                        "CASE WHEN p.same = 0 THEN p.new_id END, "
+                        "CASE WHEN p.same = 0 THEN 'altered' END "
+                        "FROM {0} AS o LEFT JOIN temp.pairs AS p "
+                        "ON p.old_id = o.id WHERE p.old_id IS NOT NULL OR NOT "
+                        "(o.sfilename IN (SELECT sfilename FROM {1}) OR "
+                        "syncere_covers(o.sfilename)) ORDER BY o.id".format(
+                                                    self.table, new.table))
+            finally:
+                self.connection.create_function('syncere_covers', 1, None)
+            execute("INSERT INTO temp.layout (old_id, new_id, mark) "
+                    "SELECT NULL, n.id, 'new' FROM {} AS n WHERE n.id NOT IN "
+                    "(SELECT new_id FROM temp.pairs) ORDER BY n.id".format(
+                                                                new.table))
+            counts = self._marks()
+            removed = self.count - execute(
+                        'SELECT COUNT(*) FROM temp.layout WHERE old_id IS NOT '
+                        'NULL').fetchone()[0] - counts['altered']
+            self._swap(new, 'o.mark')
+        self._create_indexes()
+        return (counts['new'], counts['altered'], removed)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice) and index == slice(None):
+            # The objects may be read back from this very store
+            value = list(value)
+            self.clear()
+            self.extend(value)
+            return
+        changes = list(self)
+        changes[index] = value
+        self[:] = changes
+
+    def __delitem__(self, index):
+        changes = list(self)
+        del changes[index]
+        self[:] = changes
+
+    def insert(self, index, value):
+        changes = list(self)
+        changes.insert(index, value)
+        self[:] = changes
+
+
+class ChangeQuery:
+    """
+    The changes of a ChangeStore that satisfy an SQL condition, read again
+    with a new cursor each time that they are iterated.
+    """
+    def __init__(self, store, where, params, order='id', order_params=()):
+        self.store = store
+        self.where = where
+        self.params = params
+        self.order = order
+        self.order_params = order_params
+
+    def __iter__(self):
+        return self.store.query(self.where, self.params, self.order,
+                                self.order_params)
+
+    def __len__(self):
+        if not self.where:
+            return len(self.store)
+        self.store.flush()
+        with self.store.lock:
+            return self.store.connection.execute(
+                    'SELECT COUNT(*) FROM {} WHERE {}'.format(
+                                            self.store.table, self.where),
+                    self.params).fetchone()[0]
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
@@ -0,0 +1,265 @@
+# syncere - Interactive rsync-based data synchronization.
+# Copyright (C) 2016 Dario Giovannetti <dev@dariogiovannetti.net>
+#
+# This file is part of syncere.
+#
+# syncere is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# syncere is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with syncere.  If not, see <http://www.gnu.org/licenses/>.
+
+import os as _m_os
+import errno as _m_errno
+import select as _m_select
+import struct as _m_struct
+import ctypes as _m_ctypes
+import ctypes.util as _m_ctypes_util
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+REMOVAL_MASK = IN_MOVED_FROM | IN_DELETE
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+EVENT_HEADER = _m_struct.Struct('iIII')
+READ_SIZE = 1 << 16
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = _m_ctypes.CDLL(_m_ctypes_util.find_library('c'),
+                               use_errno=True)
+        # Raise AttributeError now if the system does not support inotify
+        _libc.inotify_init1
+        _libc.inotify_add_watch.argtypes = (_m_ctypes.c_int,
+                                            _m_ctypes.c_char_p,
+                                            _m_ctypes.c_uint32)
+    return _libc
+
+
+class DirtyPaths:
+    """
+    The paths that changed in a source since the last update, relative to the
+    directory that the rsync file names are relative to.
+    """
+    def __init__(self):
+        # The (source index, path) tuples of the entries that must be examined
+        # again; directories have a trailing slash, but only the directory
+        # itself is concerned
+        self.paths = set()
+        # The same paths, regardless of the source
+        self.names = set()
+        # The directories whose whole content is affected, i.e. directories
+        # that were created, moved or deleted; all their entries that still
+        # exist are also in paths
+        self.trees = set()
+        # Whether some entries were deleted or moved away
+        self.removals = False
+        # Whether some events were lost, so that only a full preview can be
+        # trusted
+        self.overflow = False
+
+    def __bool__(self):
+        return bool(self.names or self.trees or self.overflow)
+
+    def covers(self, path):
+        """
+        Tell whether the pending change of path must be updated.
+        """
+        if path in self.names:
+            return True
+        cut = path.rstrip('/').rfind('/')
+        while cut > -1:
+            if path[:cut + 1] in self.trees:
+                return True
+            cut = path.rfind('/', 0, cut)
+        return False
+
+
+class TreeWatcher:
+    """
+    Watch the local sources with inotify, and collect the changed paths until
+    no more events arrive for a debounce window.
+    """
+    def __init__(self, sources):
+        # The sources are Location objects
+        self.sources = sources
+        self.fd = None
+        # Watch descriptor -> (source index, watched path)
+        self.wd_to_path = {}
+        self.dirty = None
+        # Whether some directories could not be watched, because the limit
+        # of watches per user was reached: their changes go unnoticed as long
+        # as the watcher runs
+        self.limited = False
+
+    def open(self):
+        try:
+            libc = _get_libc()
+        except (OSError, AttributeError):
+            raise OSError(_m_errno.ENOSYS, 'inotify is not available')
+        fd = libc.inotify_init1(_m_os.O_NONBLOCK | _m_os.O_CLOEXEC)
+        if fd < 0:
+            errno = _m_ctypes.get_errno()
+            raise OSError(errno, _m_os.strerror(errno))
+        self.fd = fd
+        self.dirty = DirtyPaths()
+        for index, source in enumerate(self.sources):
+            # The initial scan is not a change
+            self._watch_tree(index, source.path, mark=False)
+
+    def close(self):
+        if self.fd is not None:
+            _m_os.close(self.fd)
+            self.fd = None
+            self.wd_to_path.clear()
+
+    def _add_watch(self, index, path, mask):
+        wd = _get_libc().inotify_add_watch(self.fd, _m_os.fsencode(path),
+                                           mask)
+        if wd < 0:
+            errno = _m_ctypes.get_errno()
+            if errno == _m_errno.ENOSPC:
+                # The limit of watches per user has been reached: the changes
+                # in the unwatched directories would go unnoticed
+                self.limited = True
+                self.dirty.overflow = True
+            # Other errors mean that the path has already disappeared, which
+            # will be reported by the parent directory's watch
+            return
+        self.wd_to_path[wd] = (index, path)
+
+    def _watch_tree(self, index, top, mark=True):
+        """
+        Watch a directory and all its subdirectories, optionally marking all
+        their entries as dirty.
+        """
+        if not _m_os.path.isdir(top) or _m_os.path.islink(top):
+            # A single file given as a source
+            self._add_watch(index, top, WATCH_MASK)
+            return
+        if mark:
+            self._mark(index, top, True, tree=True)
+        for dirpath, dirnames, filenames in _m_os.walk(top):
+            self._add_watch(index, dirpath, WATCH_MASK | IN_ONLYDIR)
+            if mark:
+                for dirname in dirnames:
+                    path = _m_os.path.join(dirpath, dirname)
+                    # Symbolic links to directories are not followed
+                    self._mark(index, path, not _m_os.path.islink(path))
+                for filename in filenames:
+                    self._mark(index, _m_os.path.join(dirpath, filename),
+                               False)
+            if self.dirty.overflow:
+                return
+
+    def _relative(self, index, path, isdir):
+        relpath = _m_os.path.relpath(path, self.sources[index].root)
+        if isdir:
+            relpath += '/'
+        return relpath
+
+    def _mark(self, index, path, isdir, tree=False):
+        relpath = self._relative(index, path, isdir)
+        if relpath.startswith('../'):
+            return
+        self.dirty.paths.add((index, relpath))
+        self.dirty.names.add(relpath)
+        if tree:
+            self.dirty.trees.add(relpath)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = _m_os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data,
+                                                                    offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                self._process_event(wd, mask, _m_os.fsdecode(name))
+
+    def _process_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.dirty.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self.wd_to_path.pop(wd, None)
+            return
+        try:
+            index, watched = self.wd_to_path[wd]
+        except KeyError:
+            return
+
+        if not name:
+            # An event on the watched path itself
+            if watched == self.sources[index].path:
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # A whole source has disappeared
+                    self.dirty.overflow = True
+                elif not mask & IN_ISDIR:
+                    # A single file given as a source
+                    self._mark(index, watched, False)
+            return
+
+        path = _m_os.path.join(watched, name)
+        isdir = bool(mask & IN_ISDIR)
+        if mask & REMOVAL_MASK:
+            self.dirty.removals = True
+            self._mark(index, path, isdir, tree=isdir)
+        elif isdir and mask & (IN_CREATE | IN_MOVED_TO):
+            # The new directory may already contain some entries
+            self._watch_tree(index, path)
+        else:
+            self._mark(index, path, isdir)
+
+    def wait(self, debounce, timeout=None):
+        """
+        Wait for some changes, then keep collecting them until none arrive for
+        debounce seconds; return the DirtyPaths, which are empty if nothing
+        changed within timeout seconds.
+
+        Once some directories could not be watched, every change is reported
+        as an overflow, since others may have happened in those directories.
+        """
+        ready = _m_select.select((self.fd, ), (), (), timeout)[0]
+        while ready:
+            self._read_events()
+            ready = _m_select.select((self.fd, ), (), (), debounce)[0]
+        dirty = self.dirty
+        self.dirty = DirtyPaths()
+        if dirty:
+            dirty.overflow = dirty.overflow or self.limited
+        return dirty
@@ -2,6 +2,8 @@ import pytest
 import subprocess
 import textwrap
 
+from .syncere import Change
+
 
 @pytest.fixture
 def testdir(tmpdir):
@@ -19,3 +21,24 @@ class Utils:
         #       find . -printf "%i\t%k\t%M\t%n\t%u\t%g\t%s\t%A+\t%C+\t%T+\t//\t%P\t//->\t%l\t//\n"
         assert subprocess.run(textwrap.dedent(commands), shell=True,
                               check=True).returncode == 0
+
+    @staticmethod
+    def preview_line(name, ichange='>f+++++++++', operation='send',
+                     permissions='rw-r--r--', uid='1000', gid='1000',
+                     length='4', tstamp='2016/05/07-12:00:00', link='',
+                     checksum=' ' * 32):
+        """
+        Return a line of the preview command's output as rsync would print it.
+        """
+        return ('{{syncere}}{} {} {} {} {} {} '
+                '{{//}}{}{{//}}{}{{//}}{}{{//}}{}{{//}}{}{{/syncere}}'.format(
+                    ichange, operation, permissions, uid, gid, length, tstamp,
+                    name, name, link, checksum))
+
+    @staticmethod
+    def make_change(id_, name, ichange='>f+++++++++', operation='send',
+                    permissions='rw-r--r--', uid='1000', gid='1000',
+                    length='4', tstamp='2016/05/07-12:00:00', link='',
+                    checksum=' ' * 32):
+        return Change(id_, ichange, operation, permissions, uid, gid, length,
+                      tstamp, name, name, link, checksum)
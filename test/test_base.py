@@ -1,6 +1,35 @@
+import io
+import os
+import errno
+import ctypes
+import sys
+import json
+import socket
+import subprocess
+import threading
+import time
+
 import pytest
 
 from .syncere import Syncere, exceptions, _m_cmenu
+from .syncere.locations import Location
+from .syncere.multiplex import SharedConnection
+from .syncere.batch import PreviewBatch
+from .syncere import parsing
+from .syncere.completion import PathIndex, StoredPathIndex
+from .syncere.metrics import SessionMetrics
+from .syncere import watch
+from .syncere.watch import TreeWatcher
+from .syncere.server import SessionServer
+from .syncere.expressions import Expression
+from .syncere.history import encode_deltas
+from .syncere.ancestors import HiddenChanges
+from .syncere.store import ChangeStore
+from .syncere import columns
+from .syncere.moves import MoveDetector
+from .syncere.duplicates import DuplicateFinder
+from .syncere.ichange import (encode_ichange, compile_ichange_pattern,
+                              ichange_flags)
 from .conftest import Utils
 
 
@@ -260,6 +289,1661 @@ class TestSyncereOptions(Utils):
         """)
 
 
+class TestLocations(Utils):
+    """
+    Test the recognition of local and remote locations.
+    """
+    @pytest.mark.parametrize('string,host,path,remote,root', (
+                    ('./source/', None, './source/', False, './source/'),
+                    ('./source', None, './source', False, '.'),
+                    ('./foo:bar/', None, './foo:bar/', False, './foo:bar/'),
+                    ('host:source/', 'host', 'source/', True, 'source/'),
+                    ('user@host:/src', 'user@host', '/src', True, '/'),
+                    ('host::module/', 'host', 'module/', False, 'module/'),
+                    ('rsync://host/module', 'host', 'module', False, '.')))
+    def test_location(self, string, host, path, remote, root):
+        location = Location(string)
+        assert location.host == host
+        assert location.path == path
+        assert location.remote is remote
+        assert location.root == root
+
+
+@pytest.mark.usefixtures('testdir')
+class TestSharedConnection(Utils):
+    """
+    Test the shared remote-shell connection against a fake ssh command that
+    only logs its arguments.
+    """
+    def _fake_ssh(self):
+        self.populate("""
+        command mkdir destination
+        printf '#!/bin/sh\\necho "$@" >> fakessh.log\\n' > fakessh
+        command chmod +x fakessh
+        """)
+
+    def test_open_close(self):
+        self._fake_ssh()
+        Syncere('-e ./fakessh --ssh-multiplex host:source/ ./destination/',
+                test=True, commands=['quit'])
+        with open('fakessh.log') as log:
+            lines = log.read().splitlines()
+        assert len(lines) == 2
+        assert lines[0].startswith('-o ControlMaster=yes -o ControlPath=')
+        assert lines[0].endswith('-N -f host')
+        assert lines[1].endswith('-O exit host')
+        assert lines[0].split()[3] == lines[1].split()[1]
+
+    def test_local_only(self):
+        self._fake_ssh()
+        Syncere('-e ./fakessh --ssh-multiplex ./source/ ./destination/',
+                test=True, commands=['quit'])
+        self.verify("""
+        ! [ -f fakessh.log ]
+        """)
+
+    def test_rsh_option(self):
+        self._fake_ssh()
+        connection = SharedConnection('./fakessh -p 2222', ['host'])
+        connection.open()
+        try:
+            assert connection.setup_times['host'] >= 0
+            option = connection.rsh_option()
+            assert option.startswith('--rsh=./fakessh -p 2222 ')
+            assert 'ControlMaster=auto' in option
+            assert 'ControlPath={}'.format(connection.control_path) in option
+        finally:
+            connection.close()
+        assert connection.directory is None
+
+
+@pytest.mark.usefixtures('testdir')
+class TestPreviewBatch(Utils):
+    """
+    Test the validation of the batch files recorded by the preview command.
+    """
+    def test_batch_possible(self):
+        app = Syncere('./source/ ./destination/ -a --batch-transfer',
+                      test=True, commands=['quit'])
+        assert app.batch_possible()
+        app = Syncere('./source/ ./destination/ -an --batch-transfer',
+                      test=True, commands=['quit'])
+        assert not app.batch_possible()
+        app = Syncere('./source/ host:destination/ -a --batch-transfer',
+                      test=True, commands=['quit'])
+        assert not app.batch_possible()
+        app = Syncere('./source/ ./destination/ -a', test=True,
+                      commands=['quit'])
+        assert not app.batch_possible()
+
+    def test_fingerprint(self):
+        self.populate("""
+        command mkdir -p source/abc source/other
+        command mkdir destination
+        command echo "foo" > source/abc/foo.txt
+        """)
+        # The files must be older than the preview at the granularity of the
+        # file timestamps
+        time.sleep(0.05)
+        app = Syncere('./source/ ./destination/ -a --batch-transfer',
+                      test=True, commands=['quit'])
+        batch = PreviewBatch((*app.sources, app.destination))
+        paths = ('./', 'abc/', 'abc/foo.txt')
+        try:
+            assert batch.preview_args() == ['--only-write-batch={}'.format(
+                                                                batch.path)]
+            batch.record(paths)
+            # The batch file has not been written
+            assert not batch.is_valid(paths)
+            open(batch.path, 'w').close()
+            assert batch.is_valid(paths)
+            # Only the listed paths are examined
+            self.populate("""
+            command echo "bar" > source/other/bar.txt
+            """)
+            assert batch.is_valid(paths)
+            self.populate("""
+            command echo "bar" > source/abc/bar.txt
+            """)
+            assert not batch.is_valid(paths)
+        finally:
+            batch.discard()
+
+        # The paths that change during the preview are noticed even if they
+        # are then left unchanged
+        batch = PreviewBatch((*app.sources, app.destination))
+        try:
+            open(batch.path, 'w').close()
+            self.populate("""
+            command echo "baz" > source/abc/foo.txt
+            """)
+            batch.record(paths[2:])
+            assert not batch.is_valid(paths[2:])
+        finally:
+            batch.discard()
+
+
+class TestPreviewParsing(Utils):
+    """
+    Test the parsing of the preview command's output.
+    """
+    def _output(self, number):
+        lines = []
+        for index in range(number):
+            lines.append(self.preview_line('dir/file{}'.format(index),
+                                           length=str(index)))
+            if index % 7 == 0:
+                lines.append('some message {}'.format(index))
+        return '\n'.join(lines) + '\n'
+
+    def test_parse_chunk(self):
+        fields, others = parsing.parse_chunk(self._output(10))
+        records = list(parsing.iter_records(fields))
+        assert len(records) == 10
+        assert records[3] == ['>f+++++++++', 'send', 'rw-r--r--', '1000',
+                              '1000', '3', '2016/05/07-12:00:00',
+                              'dir/file3', 'dir/file3', '', ' ' * 32]
+        assert others == ['some message 0', 'some message 7']
+
+    def test_unrecognized_line(self):
+        with pytest.raises(exceptions.UnrecognizedItemizedChangeError):
+            parsing.parse_chunk('{syncere}garbage{/syncere}\n')
+
+    def test_parallel(self, monkeypatch):
+        output = self._output(1000)
+        # Force many chunks, also cutting lines in the middle
+        monkeypatch.setattr(parsing.ParallelParser, 'CHUNK_SIZE', 997)
+        results = list(parsing.ParallelParser(3).parse(io.StringIO(output)))
+        assert len(results) > 10
+        fields, others = parsing.parse_chunk(output)
+        assert [record for fields_, others_ in results
+                for record in parsing.iter_records(fields_)] == \
+            list(parsing.iter_records(fields))
+        assert [line for fields_, others_ in results
+                for line in others_] == others
+
+
+@pytest.mark.usefixtures('testdir')
+class TestLeanPreview(Utils):
+    """
+    Test the lean preview profiles and the retrieval of the details on demand.
+    """
+    def test_parse_lean(self):
+        line = '{syncere}>f+++++++++ send {//}abc/foo.txt{//}{/syncere}'
+        fields, others = parsing.parse_chunk(line, 'lean')
+        record = dict(zip(parsing.CHANGE_FIELDS,
+                          next(parsing.iter_records(fields, 'lean'))))
+        assert record['ichange'] == '>f+++++++++'
+        assert record['operation'] == 'send'
+        assert record['sfilename'] == 'abc/foo.txt'
+        assert record['link'] == ''
+        assert record['permissions'] is None
+        assert record['length'] is None
+
+    def test_parse_lean_size(self):
+        line = '{syncere}.d..t...... send 4096 {//}abc/{//}{/syncere}'
+        fields, others = parsing.parse_chunk(line, 'lean-size')
+        record = dict(zip(parsing.CHANGE_FIELDS,
+                          next(parsing.iter_records(fields, 'lean-size'))))
+        assert record['length'] == '4096'
+        assert record['sfilename'] == 'abc/'
+        assert record['uid'] is None
+
+    def test_fetch_local(self):
+        self.populate("""
+        command mkdir -p source/abc source/other
+        command mkdir destination
+        command echo "foo" > source/abc/foo.txt
+        command echo "barbar" > destination/bar.txt
+        command chmod 640 source/abc/foo.txt
+        """)
+        app = Syncere('./source/ ./destination/ -a', test=True,
+                      commands=['quit'])
+        send = self.make_change(1, 'abc/foo.txt', permissions=None, uid=None,
+                                gid=None, length=None, tstamp=None)
+        delete = self.make_change(2, 'bar.txt', ichange='*deleting  ',
+                                  operation='del.', permissions=None,
+                                  uid=None, gid=None, length=None,
+                                  tstamp=None)
+        missing = self.make_change(3, 'missing.txt', permissions=None,
+                                   uid=None, gid=None, length=None,
+                                   tstamp=None)
+        app.details_fetcher.reset('lean')
+        app.details_fetcher.fetch([send, delete, missing])
+        assert send.permissions == 'rw-r-----'
+        assert send.length == '4'
+        assert send.uid.isdigit()
+        assert len(send.tstamp) == 19
+        assert delete.length == '7'
+        assert missing.get_details()[1:] == ('?', ) * 5
+
+
+@pytest.mark.usefixtures('testdir')
+class TestPathCompletion(Utils):
+    """
+    Test the completion of the paths of the pending changes.
+    """
+    PATHS = ('./', 'abc/', 'abc/some.file', 'abc/some.link', 'abc/def/',
+             'abc/def/other.file', 'foo.txt', 'bar.txt')
+
+    def test_index(self):
+        index = PathIndex()
+        for path in self.PATHS:
+            index.add(path)
+        assert index.complete('', 10) == ['./', 'abc/', 'bar.txt',
+                                          'foo.txt']
+        assert index.complete('a', 10) == ['abc/']
+        assert index.complete('abc/', 10) == ['abc/def/', 'abc/some.file',
+                                              'abc/some.link']
+        assert index.complete('abc/so', 1) == ['abc/some.file']
+        assert index.complete('abc/def/o', 10) == ['abc/def/other.file']
+        assert index.complete('abc/x', 10) == []
+        assert index.complete('xyz/', 10) == []
+
+    @pytest.mark.usefixtures('testdir')
+    def test_stored_index(self):
+        app = Syncere('--change-store=changes.sqlite ./source/ '
+                      './destination/', test=True, commands=['quit'])
+        app.load_preview([self.make_change(id_, path) for id_, path
+                          in enumerate(self.PATHS, start=1)])
+        index = app.path_index
+        assert isinstance(index, StoredPathIndex)
+        assert index.complete('', 10) == ['./', 'abc/', 'bar.txt',
+                                          'foo.txt']
+        assert index.complete('', 2) == ['./', 'abc/']
+        assert index.complete('abc/', 10) == ['abc/def/', 'abc/some.file',
+                                              'abc/some.link']
+        assert index.complete('abc/so', 1) == ['abc/some.file']
+        assert index.complete('abc/x', 10) == []
+
+    def _complete(self, app, line, rl_prefix):
+        return app.mainmenu.complete(_m_cmenu.SPLIT_ARGS(line), line,
+                                     rl_prefix, 0, 0)
+
+    def test_command(self):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['quit'])
+        for path in self.PATHS:
+            app.path_index.add(path)
+        assert self._complete(app, 'include -f abc/so', 'so') == \
+            ['some.file', 'some.link']
+        assert self._complete(app, 'list --glob-path=abc/d', 'd') == \
+            ['def/']
+        assert self._complete(app, 'exclude -w ', '') == \
+            ['./', 'abc/', 'bar.txt', 'foo.txt']
+        assert self._complete(app, 'reset -w abc/*', '') == []
+        assert self._complete(app, 'include abc/so', 'so') == []
+
+
+@pytest.mark.usefixtures('testdir')
+class TestListViews(Utils):
+    """
+    Test the sorted and grouped views of the 'list' command.
+    """
+    def _app(self):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'abc/', ichange='cd+++++++++', length='4096',
+                             tstamp='2016/05/01-00:00:00'),
+            self.make_change(2, 'abc/def/big.file', length='1000',
+                             tstamp='2016/05/03-00:00:00'),
+            self.make_change(3, 'abc/def/small.file', length='10',
+                             tstamp='2016/05/04-00:00:00'),
+            self.make_change(4, 'abc/some.file', length='100', uid='0',
+                             tstamp='2016/05/02-00:00:00'),
+            self.make_change(5, 'old.file', ichange='*deleting  ',
+                             operation='del.', length='1',
+                             tstamp='2016/05/05-00:00:00'),
+        ])
+        return app
+
+    def _list(self, app, capsys, line):
+        capsys.readouterr()
+        app.mainmenu.run_line(line)
+        return capsys.readouterr().out.splitlines()
+
+    def test_sort(self, capsys):
+        app = self._app()
+        assert [line.split()[-1] for line in self._list(
+                                    app, capsys, 'list --sort size')] == \
+            ['abc/', 'abc/def/big.file', 'abc/some.file',
+             'abc/def/small.file', 'old.file']
+        assert [line.split()[-1] for line in self._list(
+                                    app, capsys, 'list --sort time')] == \
+            ['old.file', 'abc/def/small.file', 'abc/def/big.file',
+             'abc/some.file', 'abc/']
+        assert [line.split()[-1] for line in self._list(
+                                    app, capsys, 'list --sort op')][-1] == \
+            'abc/some.file'
+
+    def test_group_by(self, capsys):
+        app = self._app()
+        app.mainmenu.run_line('include -w abc/def/*')
+        app.mainmenu.run_line('exclude 5')
+        lines = self._list(app, capsys, 'list --group-by dir:1')
+        assert [line.split() for line in lines] == [
+            ['2', '4097', '>', '0', '0', '!', '1', '1', '?', '1', '4096',
+             './'],
+            ['3', '1110', '>', '2', '1010', '!', '0', '0', '?', '1', '100',
+             'abc/'],
+        ]
+        lines = self._list(app, capsys, 'list --group-by dir')
+        assert lines[1].split() == ['2', '1010', '>', '2', '1010', '!', '0',
+                                    '0', '?', '0', '0', 'abc/def/']
+        # The precomputed aggregates follow the decisions
+        app.mainmenu.run_line('reset *')
+        lines = self._list(app, capsys, 'list --group-by op')
+        assert lines[0].split() == ['4', '5206', '>', '0', '0', '!', '0',
+                                    '0', '?', '4', '5206', 'send']
+        lines = self._list(app, capsys, 'list --group-by uid -o send')
+        assert lines[1].split()[-1] == '0'
+        assert self._list(app, capsys, 'list --group-by size') == \
+            ['Bad command syntax']
+
+
+class TestMetrics(Utils):
+    """
+    Test the export of the session metrics.
+    """
+    def test_prometheus(self, tmpdir):
+        path = str(tmpdir.join('syncere.prom'))
+        app = Syncere('--metrics-file={} ./source/ ./destination/'.format(
+                      path), test=True, commands=['quit'])
+        app.load_preview([
+            self.make_change(1, 'abc/', ichange='cd+++++++++', length='4096'),
+            self.make_change(2, 'abc/some.file', length='100'),
+            self.make_change(3, 'old.file', ichange='*deleting  ',
+                             operation='del.', length='1'),
+        ])
+        app.decide(app.pending_changes[1:2], True)
+        app.decide(app.pending_changes[2:], False)
+        app.metrics.record_preview(2.5, 0)
+        app.metrics.record_transfer(2.0, 100, 0)
+        app._write_metrics()
+
+        lines = open(path).read().splitlines()
+        assert 'syncere_preview_duration_seconds 2.5' in lines
+        assert 'syncere_changes{operation="send",decision="included"} 1' in \
+            lines
+        assert 'syncere_changes{operation="send",decision="undecided"} 1' \
+            in lines
+        assert 'syncere_changes{operation="del.",decision="excluded"} 1' in \
+            lines
+        assert 'syncere_transfer_throughput_bytes_per_second 50.0' in lines
+        assert 'syncere_transfer_return_code 0' in lines
+        assert '# TYPE syncere_transfer_bytes gauge' in lines
+        # No temporary files are left behind
+        assert tmpdir.listdir() == [tmpdir.join('syncere.prom')]
+
+    def test_mode(self, tmpdir):
+        path = str(tmpdir.join('syncere.prom'))
+        umask = os.umask(0o022)
+        try:
+            SessionMetrics().write(path, 'prometheus')
+        finally:
+            os.umask(umask)
+        # Readable by the other users, e.g. the node exporter
+        assert os.stat(path).st_mode & 0o777 == 0o644
+
+    def test_jsonl(self, tmpdir):
+        path = str(tmpdir.join('syncere.jsonl'))
+        for returncode in (0, 23):
+            metrics = SessionMetrics()
+            metrics.record_transfer(0, 10, returncode)
+            metrics.write(path, 'jsonl')
+        records = [json.loads(line) for line in open(path)]
+        assert [record['transfer_return_code'] for record in records] == \
+            [0, 23]
+        assert records[0]['transfer_throughput_bytes_per_second'] is None
+        assert records[0]['preview_count'] == 0
+
+
+@pytest.mark.usefixtures('testdir')
+class TestWatch(Utils):
+    """
+    Test the incremental updates of the pending changes.
+    """
+    def test_watcher(self):
+        self.populate("""
+        mkdir -p source/sub
+        echo 'a' > source/a.file
+        """)
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['quit'])
+        watcher = TreeWatcher(app.sources)
+        try:
+            watcher.open()
+        except OSError:
+            pytest.skip('inotify is not available')
+        try:
+            assert not watcher.wait(0.05, timeout=0)
+            self.populate("""
+            echo 'b' >> source/a.file
+            echo 'c' > source/sub/c.file
+            mkdir -p source/new/deep
+            echo 'd' > source/new/deep/d.file
+            """)
+            dirty = watcher.wait(0.1, timeout=1)
+            assert {'a.file', 'sub/c.file', 'new/', 'new/deep/',
+                    'new/deep/d.file'} <= dirty.names
+            assert dirty.trees == {'new/'}
+            assert not dirty.removals and not dirty.overflow
+            assert dirty.covers('new/deep/other.file')
+            assert not dirty.covers('sub/other.file')
+
+            # The new directories are watched too
+            self.populate("""
+            rm source/new/deep/d.file
+            """)
+            dirty = watcher.wait(0.1, timeout=1)
+            assert dirty.names == {'new/deep/d.file'}
+            assert dirty.removals
+        finally:
+            watcher.close()
+
+    def test_watch_limit(self, monkeypatch):
+        self.populate("""
+        mkdir -p source/sub
+        """)
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['quit'])
+        watcher = TreeWatcher(app.sources)
+        try:
+            watcher.open()
+        except OSError:
+            pytest.skip('inotify is not available')
+        libc = watch._get_libc()
+
+        class Exhausted:
+            def inotify_add_watch(self, fd, path, mask):
+                ctypes.set_errno(errno.ENOSPC)
+                return -1
+
+        try:
+            monkeypatch.setattr(watch, '_libc', Exhausted())
+            self.populate("""
+            mkdir source/new
+            """)
+            assert watcher.wait(0.1, timeout=1).overflow
+            monkeypatch.setattr(watch, '_libc', libc)
+
+            # The changes in the unwatched directory would be lost, so the
+            # next ones are overflows too
+            self.populate("""
+            echo 'a' > source/sub/a.file
+            """)
+            dirty = watcher.wait(0.1, timeout=1)
+            assert dirty.names == {'sub/a.file'}
+            assert dirty.overflow
+            assert not watcher.wait(0.05, timeout=0)
+        finally:
+            watcher.close()
+
+    @pytest.mark.parametrize('store', ('', '--change-store=changes.sqlite '))
+    def test_merge(self, store):
+        app = Syncere(store + './source/ ./destination/', test=True,
+                      commands=['quit'])
+        app.load_preview([
+            self.make_change(1, 'kept.file'),
+            self.make_change(2, 'same.file'),
+            self.make_change(3, 'altered.file'),
+            self.make_change(4, 'removed.file'),
+            self.make_change(5, 'dir/removed.file'),
+        ])
+        app.decide(app.pending_changes, True)
+
+        dirty = ['same.file', 'altered.file', 'removed.file', 'new.file']
+        added, altered, removed = app.merge_preview(
+            [self.make_change(1, 'same.file'),
+             self.make_change(2, 'altered.file', length='5'),
+             self.make_change(3, 'new.file')],
+            lambda path: path in dirty or path.startswith('dir/'))
+        assert (added, altered, removed) == (1, 1, 2)
+        assert [(change.id_, change.sfilename, change.included)
+                for change in app.pending_changes] == [
+            (1, 'kept.file', True),
+            (2, 'same.file', True),
+            (3, 'altered.file', None),
+            (4, 'new.file', None),
+        ]
+        assert app.rollups.groups('op')['send'].decision_count[True] == 2
+        assert app.path_index.complete('n', 10) == ['new.file']
+
+        # A change that affects other destinations is altered too
+        app.mainmenu.run_line('include *')
+        change = self.make_change(1, 'kept.file')
+        change.destinations = (0, 1)
+        assert app.merge_preview([change], lambda path: path == 'kept.file') \
+            == (0, 1, 0)
+        assert app.pending_changes[0].included is None
+
+
+class TestExpressions(Utils):
+    """
+    Test the filter expressions.
+    """
+    def test_compile(self):
+        expression = Expression('regex:a and (glob:*.log or size>1G) and '
+                                'not uid=0 and op=send')
+        # The cheapest tests come first
+        assert expression.code.index('change.operation') < \
+            expression.code.index('size(change)')
+        assert expression.code.index('change.uid') < \
+            expression.code.index('size(change)') < \
+            expression.code.index('.match(') < \
+            expression.code.index('.search(')
+        assert expression.details == {'length', 'uid'}
+
+        for string in ('op=send and', '(op=send', 'op=send)', 'op~send',
+                       'color=red', 'size>1X', 'regex:(', 'op<send',
+                       "ichange='*deleting"):
+            with pytest.raises(exceptions.BadExpressionError):
+                Expression(string)
+
+    def test_select(self, capsys):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'abc/', ichange='cd+++++++++', length='4096'),
+            self.make_change(2, 'abc/big.log', length=str(2 << 30)),
+            self.make_change(3, 'abc/small.log', length='10', uid='0'),
+            self.make_change(4, 'abc/some.file', length='100',
+                             tstamp='2015/01/01-00:00:00'),
+            self.make_change(5, 'old.log', ichange='*deleting  ',
+                             operation='del.', length='1'),
+        ])
+
+        def select(*args):
+            return [change.id_ for change in app.main.select_changes(*args)]
+
+        assert select('-e', 'op=send and (glob:*.log or size>1K) and '
+                            'not uid=0') == [1, 2]
+        assert select('-e', "ichange='*deleting  ' or time<2016") == [4, 5]
+        assert select('-e', 'iregex:BIG or path=abc/', '-o', 'send') == \
+            [1, 2]
+        # Several expressions must all match
+        assert select('-e', 'glob:*.log', '-e', 'not op=del.', '2-5') == \
+            [2, 3]
+        capsys.readouterr()
+        assert select('-e', 'size>') == []
+        assert capsys.readouterr().out.splitlines() == [
+            'Bad filter expression: bad size ']
+
+
+@pytest.mark.usefixtures('testdir')
+class TestFanOut(Utils):
+    """
+    Test the synchronization to several destinations.
+    """
+    def test_different_changes(self, capsys):
+        app = Syncere('--also-to=./mirror1/ --also-to=./mirror2/ ./source/ '
+                      './destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        results = [
+            ([self.make_change(1, 'a.file')], 0),
+            ([self.make_change(1, 'a.file', ichange='>f.st......',
+                               length='9')], 0),
+            ([self.make_change(1, 'a.file')], 0),
+        ]
+        app.main._run_preview = lambda args, profile, others=None, \
+            quiet=False: results.pop(0)
+        app.mainmenu.run_line('preview')
+        # Each destination keeps the attributes that rsync reported for it
+        assert [(change.id_, change.ichange, change.length,
+                 change.destinations)
+                for change in app.pending_changes] == [
+            (1, '>f+++++++++', '4', (0, 2)),
+            (2, '>f.st......', '9', (1, ))]
+        app.mainmenu.run_line('exclude -s 9')
+        app.mainmenu.run_line('include -i ">f+*"')
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --view-only --files-from')
+        assert capsys.readouterr().out.splitlines() == [
+            'Nothing to transfer to ./mirror1/',
+            'rsync --files-from ./files-from.1 ./source/ ./destination/',
+            'rsync --files-from ./files-from.3 ./source/ ./mirror2/']
+
+    def test_merge_and_transfer(self, capsys):
+        app = Syncere('--also-to=./mirror1/ --also-to=./mirror2/ ./source/ '
+                      './destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        assert [destination.string for destination in app.destinations] == \
+            ['./destination/', './mirror1/', './mirror2/']
+
+        results = [
+            ([self.make_change(1, 'a.file'), self.make_change(2, 'b.file')],
+             0),
+            ([self.make_change(1, 'b.file')], 0),
+            ([self.make_change(1, 'c.file'), self.make_change(2, 'a.file')],
+             0),
+        ]
+        app.main._run_preview = lambda args, profile, others=None, \
+            quiet=False: results.pop(0)
+        app.mainmenu.run_line('preview')
+        assert [(change.id_, change.sfilename, change.destinations)
+                for change in app.pending_changes] == [
+            (1, 'a.file', (0, 2)),
+            (2, 'b.file', (0, 1)),
+            (3, 'c.file', (2, )),
+        ]
+
+        capsys.readouterr()
+        app.mainmenu.run_line('list')
+        assert [line.split()[-2:] for line in
+                capsys.readouterr().out.splitlines()] == [
+            ['1-3', 'a.file'], ['12-', 'b.file'], ['--3', 'c.file']]
+
+        app.mainmenu.run_line('include -D 2')
+        assert [change.included for change in app.pending_changes] == \
+            [None, True, None]
+        app.mainmenu.run_line('exclude 3')
+        app.mainmenu.run_line('include 1')
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --view-only --exclude')
+        lines = capsys.readouterr().out.splitlines()
+        assert lines == [
+            'rsync ./source/ ./destination/',
+            'rsync ./source/ ./mirror1/',
+            'rsync --exclude c.file ./source/ ./mirror2/',
+        ]
+
+        app.mainmenu.run_line('exclude 1')
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --view-only --include')
+        assert capsys.readouterr().out.splitlines() == [
+            'Nothing to transfer to ./mirror2/',
+            'rsync --include b.file --exclude * ./source/ ./destination/',
+            'rsync --include b.file --exclude * ./source/ ./mirror1/',
+        ]
+
+
+class TestServer(Utils):
+    """
+    Test the socket API of a resident session.
+    """
+    def _request(self, stream, command, *args):
+        stream.write(json.dumps({'command': command,
+                                 'args': args}).encode() + b'\n')
+        stream.flush()
+        responses = []
+        while True:
+            responses.append(json.loads(stream.readline().decode()))
+            if 'end' in responses[-1]:
+                return responses
+
+    def test_requests(self, tmpdir):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'abc/', ichange='cd+++++++++', length='4096'),
+            self.make_change(2, 'abc/some.file', length='100'),
+            self.make_change(3, 'old.file', ichange='*deleting  ',
+                             operation='del.', length='1'),
+        ])
+        path = str(tmpdir.join('syncere.sock'))
+        server = SessionServer(app, path, app.main.select_changes,
+                               app.mainmenu)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            clients = [socket.socket(socket.AF_UNIX) for _ in range(2)]
+            for client in clients:
+                client.connect(path)
+            first, second = [client.makefile('rwb') for client in clients]
+
+            responses = self._request(first, 'include', '-o', 'send')
+            assert responses == [{'end': True, 'ok': True, 'count': 2,
+                                  'bytes': 4196, 'messages': []}]
+            responses = self._request(second, 'exclude', '3')
+            assert responses[-1]['count'] == 1
+            responses = self._request(first, 'status')
+            assert responses[-1]['included'] == 2
+            assert responses[-1]['excluded_bytes'] == 1
+            assert responses[-1]['undecided'] == 0
+
+            responses = self._request(second, 'list', '-w', 'abc/*.file')
+            assert [(record['id'], record['sfilename'], record['included'])
+                    for record in responses[:-1]] == [
+                (2, 'abc/some.file', True)]
+            assert responses[-1]['count'] == 1
+            responses = self._request(first, 'select')
+            assert responses == [{'ids': [1, 2, 3]},
+                                 {'end': True, 'ok': True, 'count': 3,
+                                  'messages': []}]
+
+            responses = self._request(first, 'select', '--bad')
+            assert responses == [{'end': True, 'ok': False,
+                                  'messages': ['Bad command syntax']}]
+            responses = self._request(first, 'unknown')
+            assert responses[-1]['ok'] is False
+            # A failing command still ends its response
+            responses = self._request(first, 'status', 'extra')
+            assert responses[-1]['end'] and responses[-1]['ok'] is False
+            assert 'error' in responses[-1]
+            assert self._request(first, 'select', '1')[-1]['count'] == 1
+
+            assert os.stat(path).st_mode & 0o777 == 0o600
+            assert tmpdir.listdir() == [tmpdir.join('syncere.sock')]
+
+            self._request(second, 'shutdown')
+            thread.join(5)
+            assert not thread.is_alive()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert not tmpdir.join('syncere.sock').exists()
+
+
+class TestAncestors(Utils):
+    """
+    Test the check of the included changes inside excluded directories.
+    """
+    def test_hidden_changes(self):
+        changes = [
+            self.make_change(1, 'a/', ichange='cd+++++++++'),
+            self.make_change(2, 'a/b/', ichange='cd+++++++++'),
+            self.make_change(3, 'a/b/c/d.file'),
+            self.make_change(4, 'a/e.file'),
+            self.make_change(5, 'a-z.file'),
+            self.make_change(6, 'f/', ichange='cd+++++++++'),
+            self.make_change(7, 'f/g.file', ichange='*deleting  ',
+                             operation='del.'),
+            self.make_change(8, 'h.file'),
+        ]
+        for change, decision in zip(changes, (False, False, True, False,
+                                              True, True, True, True)):
+            change.included = decision
+        hidden = HiddenChanges(changes)
+        assert [change.id_ for change in hidden.changes] == [3]
+        assert [change.id_ for change in hidden.ancestors] == [1, 2]
+        assert hidden.closest_ancestor(changes[2]) == 'a/b/'
+
+        changes[5].included = False
+        hidden = HiddenChanges(changes)
+        assert [change.id_ for change in hidden.changes] == [3, 7]
+        assert [change.id_ for change in hidden.ancestors] == [1, 2, 6]
+
+        for change in changes:
+            change.included = True
+        assert not HiddenChanges(changes)
+
+    @pytest.mark.usefixtures('testdir')
+    @pytest.mark.parametrize('store', ('', '--change-store=changes.sqlite '))
+    def test_commands(self, capsys, store):
+        app = Syncere(store + './source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'a/', ichange='cd+++++++++'),
+            self.make_change(2, 'a/b.file'),
+            self.make_change(3, 'c.file'),
+        ])
+        app.mainmenu.run_line('include *')
+        app.mainmenu.run_line('exclude 1')
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --view-only')
+        assert capsys.readouterr().out == (
+            'Included changes inside excluded directories, see the '
+            'ancestors command: 1\n')
+        app.mainmenu.run_line('ancestors')
+        assert capsys.readouterr().out == '2 a/b.file < a/\n'
+
+        app.mainmenu.run_line('ancestors --exclude')
+        assert [change.included for change in app.pending_changes] == \
+            [False, False, True]
+        app.mainmenu.run_line('undo')
+        app.mainmenu.run_line('ancestors --fix')
+        assert [change.included for change in app.pending_changes] == \
+            [True, True, True]
+        capsys.readouterr()
+        app.mainmenu.run_line('ancestors')
+        assert capsys.readouterr().out == (
+            'No included changes are hidden by excluded directories\n')
+
+
+@pytest.mark.usefixtures('testdir')
+class TestSimulator(Utils):
+    """
+    Test the rsync simulator as the backend of the internal rsync commands.
+    """
+    SIMULATOR = os.path.join(os.path.dirname(__file__), 'syncere',
+                             'simulator.py')
+
+    def test_preview_and_transfer(self):
+        backend = '{} {} --sim-changes=250 --sim-files-per-dir=9 ' \
+            '--sim-record=transfers.jsonl'.format(sys.executable,
+                                                  self.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/ '
+                      '-a'.format(backend), test=True,
+                      commands=['config colors n', 'preview', 'quit'])
+        assert app.rsync[1:] == [self.SIMULATOR, '--sim-changes=250',
+                                 '--sim-files-per-dir=9',
+                                 '--sim-record=transfers.jsonl']
+        changes = app.pending_changes
+        assert len(changes) == 250
+        assert [change.sfilename for change in changes[:3]] == [
+            'd000000/', 'd000000/f00000.dat', 'd000000/f00001.dat']
+        assert changes[-1].sfilename == 'd000024/f00008.dat'
+        # The stream is deterministic
+        first = [(change.operation, change.length, change.tstamp,
+                  change.checksum) for change in changes]
+        app.mainmenu.run_line('preview')
+        assert [(change.operation, change.length, change.tstamp,
+                 change.checksum) for change in changes] == first
+
+        app.configuration['max-inline-filters'] = '3'
+        app.mainmenu.run_line('include *')
+        app.mainmenu.run_line('exclude -w d000001/*.dat')
+        app.mainmenu.run_line('transfer')
+        with open('transfers.jsonl') as record:
+            transfers = [json.loads(line) for line in record]
+        assert len(transfers) == 1
+        assert transfers[0]['args'][:2] == ['--exclude-from',
+                                            './exclude-from']
+        assert transfers[0]['lists']['--exclude-from'] == [
+            'd000001/f0000{}.dat'.format(number) for number in range(9)]
+        assert not app.pending_changes
+
+    def test_resume(self, capsys):
+        backend = '{} {} --sim-changes=250 --sim-files-per-dir=9 ' \
+            '--sim-fail-after=100 --sim-record=transfers.jsonl'.format(
+                sys.executable, self.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/ '
+                      '-a'.format(backend), test=True,
+                      commands=['config colors n', 'preview', 'quit'])
+        app.configuration['resume-overlap'] = '10'
+        app.mainmenu.run_line('include *')
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer -E')
+        assert capsys.readouterr().out.splitlines() == [
+            'rsync error: 23',
+            "Changes not transferred, retry them with 'transfer --resume': "
+            "160"]
+
+        # The journal is enough, also in a new session
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/ '
+                      '-a'.format(backend), test=True,
+                      commands=['config colors n', 'quit'])
+        app.configuration['resume-overlap'] = '10'
+        app.configuration['resume-backoff'] = '0'
+        app.configuration['resume-retries'] = '1'
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --resume --view-only')
+        targs = capsys.readouterr().out.split()
+        assert targs[6:9] == ['--delete-missing-args', '--files-from',
+                              './files-from']
+        # -a must not make rsync recurse into the listed directories
+        recursive = targs.index('--no-recursive')
+        assert targs[recursive:recursive + 2] == ['--no-recursive', '--dirs']
+        assert targs.index('-a') < recursive
+        assert '--partial' in targs
+
+        # A dry run leaves the journal as it is
+        app.mainmenu.run_line('transfer --resume --dry-run')
+        assert capsys.readouterr().out == 'rsync error: 23\n'
+        assert os.path.exists('transfer-journal')
+        app.mainmenu.run_line('transfer --resume')
+        assert capsys.readouterr().out == (
+            'Retrying the remaining changes in seconds: 0.0\n')
+        with open('transfers.jsonl') as record:
+            lists = [json.loads(line)['lists'].get('--files-from')
+                     for line in record]
+        assert [len(list_) for list_ in lists[1:]] == [160, 160, 70]
+        # The last changes reported by the failed attempt are retried
+        assert lists[2][0] == 'd000009/'
+        assert not os.path.exists('transfer-journal')
+        app.mainmenu.run_line('transfer --resume')
+        assert capsys.readouterr().out == (
+            'There is no interrupted transfer to resume\n')
+
+
+@pytest.mark.usefixtures('testdir')
+class TestScripts(Utils):
+    """
+    Test the coalesced execution of the decisions in scripts.
+    """
+    RULES = [
+        'include *',
+        'exclude -w *.log',
+        '! -o del.',
+        'reset 2-4',
+        'inc -e "size>100 and glob:a/*"',
+        'exclude --bad',
+        'include -x [',
+        'reset -f none.txt',
+        'exclude -f b.log',
+    ]
+
+    def _make_app(self):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'a/', ichange='cd+++++++++', length='4096'),
+            self.make_change(2, 'a/b.log', length='10'),
+            self.make_change(3, 'a/c.txt', length='1000'),
+            self.make_change(4, 'b.log', length='1000'),
+            self.make_change(5, 'd.txt', ichange='*deleting  ',
+                             operation='del.', length='1'),
+            self.make_change(6, 'e.log', length='1'),
+        ])
+        return app
+
+    def test_same_result(self, capsys):
+        sequential = self._make_app()
+        capsys.readouterr()
+        for rule in self.RULES:
+            sequential.mainmenu.run_line(rule)
+        out = capsys.readouterr().out
+        coalesced = self._make_app()
+        fetches = []
+        coalesced.details_fetcher.fetch = \
+            lambda changes, fields: fetches.append((len(changes), fields))
+        capsys.readouterr()
+        coalesced.main.run_script(self.RULES)
+        assert capsys.readouterr().out == out
+        assert fetches == [(6, {'length'})]
+        assert out.splitlines() == [
+            'Bad command syntax', 'Unrecognized selection',
+            'No changes selected']
+        assert [change.included for change in coalesced.pending_changes] == \
+            [change.included for change in sequential.pending_changes] == \
+            [True, None, True, False, False, False]
+        assert len(coalesced.history.undo_stack) == 1
+        assert coalesced.rollups.groups('op')['send'].decision_count == \
+            sequential.rollups.groups('op')['send'].decision_count
+
+        # The details needed by all the rules are retrieved at once
+        coalesced.main.run_script(['reset -s 1 2-3', 'reset -t x -s 1 3'])
+        assert fetches[1:] == [(2, {'length', 'tstamp'})]
+
+    def test_command_options(self, capsys):
+        # The lines are still executed by the loop, also in the submenus
+        Syncere('./source/ ./destination/ --command=config '
+                '"--command=colors n" --command=exit "--command=exclude 5" '
+                '"--command=include 1-3" --command=quit', test=True)
+        assert capsys.readouterr().out.splitlines()[-5:] == [
+            '(syncere>config) exit',
+            '(syncere) exclude 5',
+            '(syncere) include 1-3',
+            'The preview command must be executed first',
+            '(syncere) quit']
+
+    def test_consecutive_commands(self, capsys):
+        app = self._make_app()
+        app.main.menu.loop(cmdlines=['include 1-3', 'exclude 2', 'list 9',
+                                     'reset 3', 'quit'])
+        assert [change.included for change in app.pending_changes] == \
+            [True, False, None, None, None, None]
+        assert [entry.label for entry in app.history.undo_stack] == [
+            '2 rules (3 changes)', 'reset (1 changes)']
+
+    def test_import(self, capsys):
+        with open('script', 'w') as script:
+            script.write('include 1-3\nexclude 2\n\nlist\nreset 1\n'
+                         'exclude 6\n')
+        app = self._make_app()
+        capsys.readouterr()
+        app.mainmenu.run_line('import script')
+        # The list command sees the decisions of the preceding rules
+        assert len(capsys.readouterr().out.splitlines()) == 6
+        assert [change.included for change in app.pending_changes] == \
+            [None, False, True, None, None, False]
+        assert [entry.label for entry in app.history.undo_stack] == [
+            '2 rules (3 changes)', '2 rules (2 changes)']
+        app.mainmenu.run_line('import missing')
+        assert capsys.readouterr().out == (
+            'missing cannot be read: No such file or directory\n')
+
+
+class TestHistory(Utils):
+    """
+    Test the undo and redo of the decisions.
+    """
+    def test_runs(self):
+        assert encode_deltas([(0, None, True), (1, None, True),
+                              (2, False, True), (4, None, True)]) == (
+            (0, 2, None, True), (2, 3, False, True), (4, 5, None, True))
+
+    def test_undo_redo(self, capsys):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([self.make_change(id_, '{}.file'.format(id_))
+                          for id_ in range(1, 6)])
+
+        def decisions():
+            return [change.included for change in app.pending_changes]
+
+        app.mainmenu.run_line('include *')
+        app.mainmenu.run_line('exclude 2-3')
+        app.mainmenu.run_line('checkpoint first')
+        app.mainmenu.run_line('reset 3-5')
+        assert decisions() == [True, False, None, None, None]
+        assert len(app.history.undo_stack[-1].runs) == 2
+
+        capsys.readouterr()
+        app.mainmenu.run_line('undo')
+        assert decisions() == [True, False, False, True, True]
+        assert capsys.readouterr().out == 'Undone: reset (3 changes)\n'
+        app.mainmenu.run_line('undo 2')
+        assert decisions() == [None] * 5
+        app.mainmenu.run_line('undo')
+        assert capsys.readouterr().out.splitlines()[-1] == 'Nothing to undo'
+        app.mainmenu.run_line('redo')
+        assert decisions() == [True] * 5
+        assert app.rollups.groups('op')['send'].decision_count[True] == 5
+
+        # A new decision discards the undone ones
+        app.mainmenu.run_line('exclude 5')
+        app.mainmenu.run_line('redo')
+        assert capsys.readouterr().out.splitlines()[-1] == 'Nothing to redo'
+
+        app.mainmenu.run_line('checkpoint --restore first')
+        assert decisions() == [True, False, False, True, True]
+        app.mainmenu.run_line('undo')
+        assert decisions() == [True, True, True, True, False]
+        capsys.readouterr()
+        app.mainmenu.run_line('checkpoint')
+        assert capsys.readouterr().out == 'first\n'
+        app.mainmenu.run_line('checkpoint --restore missing')
+        assert capsys.readouterr().out == 'Unknown checkpoint: missing\n'
+
+        app.history.undo_stack.clear()
+        app.configuration['history-depth'] = '2'
+        for _ in range(3):
+            app.mainmenu.run_line('reset *')
+            app.mainmenu.run_line('include *')
+        assert len(app.history.undo_stack) == 2
+
+        app.load_preview([self.make_change(1, 'a.file')])
+        assert not app.history.undo_stack
+        assert not app.history.checkpoints
+
+
+@pytest.mark.usefixtures('testdir')
+class TestGovernor(Utils):
+    """
+    Test the resource limits of the internal rsync commands.
+    """
+    def test_limits(self, capsys):
+        backend = '{} {} --sim-changes=20 --sim-record=transfers.jsonl'.format(
+            sys.executable, TestSimulator.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/ '
+                      '-a'.format(backend), test=True,
+                      commands=['config colors n', 'quit'])
+        cpu = min(os.sched_getaffinity(0))
+        app.configuration['preview-nice'] = '5'
+        app.configuration['preview-cpus'] = str(cpu)
+        app.configuration['preview-ionice'] = 'idle'
+        app.configuration['preview-io-max'] = '8:0 wbps=1048576'
+        app.configuration['transfer-cgroup'] = 'syncere-missing'
+        app.configuration['transfer-nice'] = 'low'
+        capsys.readouterr()
+        app.mainmenu.run_line('preview')
+        assert capsys.readouterr().out.splitlines() == [
+            'Resource limits applied to rsync preview: nice={} ionice=idle:0 '
+            'cpus={} io-max=not applied (no cgroup)'.format(
+                min(os.nice(0) + 5, 19), cpu)]
+        # The same limits are not reported again
+        app.mainmenu.run_line('preview')
+        assert capsys.readouterr().out == (
+            'Pending changes kept, added, altered, vanished: 20 0 0 0\n')
+
+        app.mainmenu.run_line('include *')
+        app.mainmenu.run_line('transfer')
+        assert capsys.readouterr().out.splitlines() == [
+            'Resource limits applied to rsync transfer: cgroup=not applied '
+            '(not a cgroup v2 directory) nice=not applied (invalid value)']
+        assert os.path.exists('transfers.jsonl')
+        assert not app.pending_changes
+
+    def test_wrapper(self):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.configuration['preview-nice'] = '3'
+        # The limits are applied by a wrapper, also while other threads run
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            call, report = app.governor.popen(
+                    'preview', [sys.executable, '-c',
+                                'import os, sys; print(os.nice(0), sys.argv)',
+                                'arg'],
+                    stdout=subprocess.PIPE, universal_newlines=True)
+        finally:
+            stop.set()
+            thread.join()
+        expected = min(os.nice(0) + 3, 19)
+        assert report == 'nice={}'.format(expected)
+        assert call.communicate()[0] == "{} ['-c', 'arg']\n".format(expected)
+
+        # A quiet process, e.g. of the prefetcher, does not report the limits,
+        # which are then reported by the next process
+        app.configuration['preview-nice'] = '4'
+        args = [sys.executable, '-c', 'pass']
+        call, report = app.governor.popen('preview', args, quiet=True)
+        call.wait()
+        assert report is None
+        call, report = app.governor.popen('preview', args)
+        call.wait()
+        assert report == 'nice={}'.format(min(os.nice(0) + 4, 19))
+
+
+class TestItemizedChanges(Utils):
+    """
+    Test the integer codes of the itemized changes and their patterns.
+    """
+    ICHANGES = ['>f+++++++++', '>f.st......', '>f..t......', '.d..t......',
+                'cd+++++++++', '*deleting  ', '.f...p.....', '>f..T......',
+                'cL+++++++++', '.d          ']
+
+    def _match(self, pattern):
+        mask, value = compile_ichange_pattern(pattern)
+        return [ichange for ichange in self.ICHANGES
+                if encode_ichange(ichange) & mask == value]
+
+    def test_patterns(self):
+        # Without wildcards the patterns select the same itemized change
+        for ichange in (*self.ICHANGES[:2], *self.ICHANGES[3:7]):
+            assert self._match(ichange) == [ichange]
+        # Any letter means changed
+        assert self._match('>f..t......') == ['>f..t......', '>f..T......']
+        assert self._match('>f.st*') == ['>f.st......']
+        assert self._match('>f??t*') == ['>f.st......', '>f..t......',
+                                         '>f..T......']
+        # Only the time has changed
+        assert self._match('??..t') == ['>f..t......', '.d..t......',
+                                        '>f..T......']
+        assert self._match('?d*') == ['.d..t......', 'cd+++++++++',
+                                      '.d          ']
+        assert self._match('c?+*') == ['cd+++++++++', 'cL+++++++++']
+        assert self._match('*del*') == ['*deleting  ']
+        assert self._match('*') == self.ICHANGES
+        assert self._match('??') == ['.d          ']
+        for pattern in ('', '>x', '*moving', '>f.s*t', '>f..t......x', '>f-'):
+            with pytest.raises(ValueError):
+                compile_ichange_pattern(pattern)
+
+    def test_flags(self):
+        assert ichange_flags(encode_ichange('>f.st......')) == ('s', 't')
+        assert ichange_flags(encode_ichange('cd+++++++++')) == ('new', )
+        assert ichange_flags(encode_ichange('*deleting  ')) == ()
+
+    def test_commands(self, capsys):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([self.make_change(id_, 'file{}'.format(id_),
+                                           ichange=ichange, length=str(id_))
+                          for id_, ichange in enumerate(self.ICHANGES, 1)])
+        app.mainmenu.run_line('include -i ??..t -i *del*')
+        assert [change.id_ for change in app.pending_changes
+                if change.included] == [3, 4, 6, 8]
+        capsys.readouterr()
+        app.mainmenu.run_line('list -i >f.s?*')
+        assert capsys.readouterr().out.split()[-1] == 'file2'
+        app.mainmenu.run_line('list -i >f!')
+        assert capsys.readouterr().out == 'Unrecognized selection\n'
+        app.mainmenu.run_line('list --group-by flag --sort path')
+        assert [line.split() for line in
+                capsys.readouterr().out.splitlines()] == [
+            ['3', '15', '>', '0', '0', '!', '0', '0', '?', '3', '15', 'new'],
+            ['1', '7', '>', '0', '0', '!', '0', '0', '?', '1', '7', 'p'],
+            ['1', '2', '>', '0', '0', '!', '0', '0', '?', '1', '2', 's'],
+            ['4', '17', '>', '3', '15', '!', '0', '0', '?', '1', '2', 't'],
+        ]
+
+
+@pytest.mark.usefixtures('testdir')
+class TestRefresh(Utils):
+    """
+    Test the refresh of the preview that keeps the decisions.
+    """
+    @pytest.mark.parametrize('store', ('', '--change-store=changes.sqlite '))
+    def test_refresh(self, capsys, store):
+        app = Syncere(store + './source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'a.file'),
+            self.make_change(2, 'b.file'),
+            self.make_change(3, 'c.file'),
+            self.make_change(4, 'd.file'),
+        ])
+        app.mainmenu.run_line('include 1-2')
+        app.mainmenu.run_line('exclude 3-4')
+        kept = app.pending_changes[1]
+
+        counts = app.refresh_preview([
+            self.make_change(1, 'a.file'),
+            self.make_change(2, 'b.file'),
+            self.make_change(3, 'c.file', length='5'),
+            self.make_change(4, 'e.file'),
+        ])
+        assert counts == (2, 1, 1, 1)
+        assert [(change.id_, change.sfilename, change.included, change.mark)
+                for change in app.pending_changes] == [
+            (1, 'a.file', True, None),
+            (2, 'b.file', True, None),
+            (3, 'c.file', None, 'altered'),
+            (4, 'e.file', None, 'new'),
+        ]
+        # The unchanged changes are the same objects
+        assert app.pending_changes[1] is kept
+        assert app.path_index.complete('d', 10) == []
+        assert app.rollups.groups('op')['send'].decision_count[True] == 2
+
+        capsys.readouterr()
+        app.mainmenu.run_line('list -m new -m altered')
+        assert [line.split() for line in
+                capsys.readouterr().out.splitlines()] == [
+            ['[3]', '?', '>f+++++++++', 'altered', 'c.file'],
+            ['[4]', '?', '>f+++++++++', 'new', 'e.file'],
+        ]
+        app.mainmenu.run_line('list -m old')
+        assert capsys.readouterr().out == 'Unrecognized selection\n'
+
+
+@pytest.mark.usefixtures('testdir')
+class TestExport(Utils):
+    """
+    Test the export of the pending changes and the import of the decisions.
+    """
+    def _app(self, skip=0):
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        changes = [
+            ('a.file', '>f+++++++++', 'send'),
+            ('b\tc,"d".file', '>f+++++++++', 'send'),
+            ('new\nline.file', '>f+++++++++', 'send'),
+            ('old.file', '*deleting  ', 'del.'),
+        ][skip:]
+        app.load_preview([self.make_change(id_, name, ichange=ichange,
+                                           operation=operation)
+                          for id_, (name, ichange, operation)
+                          in enumerate(changes, start=1)])
+        return app
+
+    def test_jsonl(self, capsys):
+        app = self._app()
+        app.mainmenu.run_line('include 1')
+        capsys.readouterr()
+        app.mainmenu.run_line('export -o del.')
+        record = json.loads(capsys.readouterr().out)
+        assert record['id'] == 4
+        assert record['decision'] == 'undecided'
+        assert record['sfilename'] == 'old.file'
+        assert record['destinations'] == [1]
+        app.mainmenu.run_line('export --format xml')
+        assert capsys.readouterr().out == 'Bad command syntax\n'
+
+    @pytest.mark.parametrize('format_', ('jsonl', 'csv', 'nul', 'tsv'))
+    def test_round_trip(self, capsys, format_):
+        app = self._app()
+        app.mainmenu.run_line('include 1-2')
+        app.mainmenu.run_line('exclude 3')
+        capsys.readouterr()
+        app.mainmenu.run_line('export > changes.' + format_)
+        assert capsys.readouterr().out == 'Changes exported: 4\n'
+
+        app = self._app(skip=1)
+        app.decide(app.pending_changes, False)
+        capsys.readouterr()
+        app.mainmenu.run_line('import-decisions changes.' + format_)
+        assert capsys.readouterr().out == (
+            'Decisions imported, paths not found: 3 1\n')
+        assert [change.included for change in app.pending_changes] == \
+            [True, False, None]
+        # A single undoable step
+        app.mainmenu.run_line('undo')
+        assert [change.included for change in app.pending_changes] == \
+            [False, False, False]
+
+    def test_bad_file(self, capsys):
+        app = self._app()
+        with open('decisions.jsonl', 'w') as file_:
+            file_.write('{"sfilename": "a.file", "decision": "included"}\n'
+                        '{"sfilename": "b.file", "decision": "maybe"}\n')
+        capsys.readouterr()
+        app.mainmenu.run_line('import-decisions decisions.jsonl')
+        assert capsys.readouterr().out == (
+            'Bad record in the decisions file: 2\n')
+        assert app.pending_changes[0].included is None
+
+
+@pytest.mark.usefixtures('testdir')
+class TestPrefetch(Utils):
+    """
+    Test the preview prefetched in the background.
+    """
+    def test_swap(self, capsys):
+        backend = '{} {} --sim-changes=30'.format(sys.executable,
+                                                  TestSimulator.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/ '
+                      '-a'.format(backend), test=True,
+                      commands=['config colors n', 'quit'])
+        app.configuration['prefetch-delay'] = '0'
+        app.mainmenu.run_line('preview')
+        snapshot = app.pending_changes[:]
+        app.mainmenu.run_line('include 1-5')
+        capsys.readouterr()
+        app.mainmenu.run_line('preview')
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].startswith('Using the preview prefetched seconds ago:')
+        assert lines[1:] == [
+            'Pending changes kept, added, altered, vanished: 30 0 0 0']
+        assert app.pending_changes == snapshot
+        assert [change.included for change in app.pending_changes[:6]] == \
+            [True] * 5 + [None]
+
+        # A result is not used after the arguments have changed
+        app.configuration['preview-profile'] = 'lean'
+        app.mainmenu.run_line('preview')
+        assert not capsys.readouterr().out.startswith('Using')
+        # Nor after a transfer
+        app.clear_preview()
+        assert app.prefetcher.take(('lean', ())) is None
+
+
+class TestChangeStore(Utils):
+    """
+    Test the pending changes kept in a SQLite database.
+    """
+    COMMANDS = ('include -o send', 'exclude 3-10,20', 'list 5,2,7,3-4',
+                'list 301', 'list 290-400', 'list -s 100 -s 200 -x 0$',
+                'list -i ">f.st*" -o send', 'list -m bad', 'list 1-30 '
+                '--sort size', 'list --group-by op', 'undo', 'reset -t x',
+                'checkpoint a', 'include *', 'checkpoint --restore a',
+                'export -o del.', 'transfer --view-only', 'preview',
+                'list 1-5', 'include *', 'transfer --view-only --files-from')
+
+    def _run(self, capsys, store):
+        backend = '{} {} --sim-changes=300'.format(sys.executable,
+                                                   TestSimulator.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" {}./source/ ./destination/'
+                      .format(backend, '--change-store=changes.sqlite '
+                              if store else ''), test=True,
+                      commands=['config colors n', 'preview', 'quit'])
+        capsys.readouterr()
+        for line in self.COMMANDS:
+            app.mainmenu.run_line(line)
+        return (app, capsys.readouterr().out)
+
+    def test_same_results(self, capsys):
+        app, out = self._run(capsys, False)
+        sapp, sout = self._run(capsys, True)
+        assert isinstance(sapp.pending_changes, ChangeStore)
+        assert os.path.exists('changes.sqlite')
+        assert sout == out
+        assert '[3] !   >f+++++++++ d000000/f00001.dat' in out
+        assert 'Bad command syntax' not in out
+
+        # The checkpoints are restored on the changes read from the database
+        sapp.mainmenu.run_line('reset 1-5')
+        sapp.mainmenu.run_line('checkpoint a')
+        decisions = [change.included for change in sapp.pending_changes]
+        assert decisions.count(None) == 5
+        sapp.mainmenu.run_line('exclude *')
+        sapp.mainmenu.run_line('checkpoint --restore a')
+        assert [change.included for change in sapp.pending_changes] == \
+            decisions
+        assert len(sapp.pending_changes.where(('included = 1', ))) == \
+            decisions.count(True)
+
+        # The decisions are written back to the database, and the queries
+        # read them
+        sapp.mainmenu.run_line('exclude -o del.')
+        assert len(sapp.pending_changes.where(('included = 0', ))) == \
+            len([change for change in app.pending_changes
+                 if change.operation == 'del.'])
+        sapp.pending_changes.close()
+        assert not os.path.exists('changes.sqlite')
+
+    def test_prefetch(self, capsys):
+        backend = '{} {} --sim-changes=300'.format(sys.executable,
+                                                   TestSimulator.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" --change-store=changes.sqlite '
+                      './source/ ./destination/'.format(backend), test=True,
+                      commands=['config colors n', 'quit'])
+        app.configuration['prefetch-delay'] = '0'
+        app.mainmenu.run_line('preview')
+        # The decisions are written while the background preview fills its
+        # staging table through the same connection
+        app.mainmenu.run_line('include 1-5')
+        app.mainmenu.run_line('list -i ">f.st*"')
+        capsys.readouterr()
+        app.mainmenu.run_line('preview')
+        assert capsys.readouterr().out.startswith(
+                                'Using the preview prefetched seconds ago:')
+        changes = app.pending_changes
+        assert len(changes) == 300
+        assert all(change.store is changes for change in changes)
+        assert len(changes.where(('included = 1', ))) == 5
+
+        # A complete preview copies the prefetched rows, whose objects must
+        # write their decisions to the pending changes
+        app.preview_needed = True
+        staging = app.prefetcher.take(
+                            ('full', tuple(app.filter_rsync_args(groups=(
+                                'shared', 'checksum', 'experimental',
+                                'safe')))))
+        assert staging is not None
+        swapped = list(staging.changes)
+        app.load_preview(staging.changes)
+        assert all(change.store is changes for change in swapped)
+        swapped[0].included = False
+        assert len(changes.where(('included = 0', ))) == 1
+        assert changes[0].included is False
+
+
+class TestColumns(Utils):
+    """
+    Test the filters evaluated on the NumPy columns of the pending changes.
+    """
+    COMMANDS = ('include -o send', 'exclude 3-10,20', 'list 5,2,7,3-4',
+                'list 1-3,2-6', 'list 61', 'list -s 664210 -s 75364',
+                'list -s 0075364', 'list -t 2010/03/06-08:19:56 -u 1000',
+                'list -i ">f.st*" -o send 1-30', 'list -p x', 'list -m bad',
+                'list -i "<<"', 'undo', 'redo', 'reset 1-12',
+                'list --group-by op')
+
+    def _run(self, capsys):
+        backend = '{} {} --sim-changes=60'.format(sys.executable,
+                                                  TestSimulator.SIMULATOR)
+        app = Syncere('--rsync-executable="{}" ./source/ ./destination/'
+                      .format(backend), test=True,
+                      commands=['config colors n', 'preview', 'quit'])
+        capsys.readouterr()
+        for line in self.COMMANDS:
+            app.mainmenu.run_line(line)
+        return (app, capsys.readouterr().out)
+
+    def test_same_results(self, capsys, monkeypatch):
+        pytest.importorskip('numpy')
+        app, out = self._run(capsys)
+        assert app.columns.enabled
+        assert list(app.columns.decision[:12]) == [-1] * 12
+        monkeypatch.setattr(columns, '_m_numpy', None)
+        fapp, fout = self._run(capsys)
+        assert not fapp.columns.enabled
+        assert fout == out
+
+    def test_fallback(self, capsys, monkeypatch):
+        monkeypatch.setattr(columns, '_m_numpy', None)
+        app, out = self._run(capsys)
+        assert not app.columns.enabled
+        # -s, then -s with a non-canonical size, then -t and -u
+        assert '\n'.join((
+            '[3] !   >f+++++++++ d000000/f00001.dat',
+            '[5] !   >f+++++++++ d000000/f00003.dat',
+            'No changes selected',
+            '[4] !   >f+++++++++ d000000/f00002.dat')) in out
+
+
+@pytest.mark.usefixtures('testdir')
+class TestMoves(Utils):
+    """
+    Test the detection of the deletions that are moves of new files.
+    """
+    def test_moves(self, capsys):
+        self.populate("""
+            mkdir destination
+            printf 'abcd' > destination/old.file
+            printf 'abcd' > destination/twin1.file
+            printf 'abcd' > destination/twin2.file
+            printf 'abcdefgh' > destination/other.file
+            touch -d '2016-05-07 12:00:00' destination/*.file
+            """)
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'old.file', ichange='*deleting',
+                             operation='del.'),
+            self.make_change(2, 'other.file', ichange='*deleting',
+                             operation='del.'),
+            self.make_change(3, 'sub/', ichange='cd+++++++++'),
+            self.make_change(4, 'sub/new.file'),
+            self.make_change(5, 'sub/big.file', length='8',
+                             tstamp='2016/05/07-12:00:01'),
+        ])
+        detector = MoveDetector(app.destination, ['ssh'])
+        moves = detector.find(app.pending_changes)
+        assert [(move.deletion.id_, move.creation.id_, move.size)
+                for move in moves] == [(1, 4, 4)]
+
+        capsys.readouterr()
+        app.mainmenu.run_line('moves')
+        assert capsys.readouterr().out.splitlines() == [
+            '1 old.file -> 4 sub/new.file',
+            'Moves found, bytes not to be transferred: 1 4']
+
+        # An excluded change is never paired
+        app.mainmenu.run_line('exclude 4')
+        assert detector.find(app.pending_changes) == []
+        app.mainmenu.run_line('reset 4')
+
+        assert detector.apply(moves) == moves
+        assert not os.path.exists('destination/old.file')
+        assert os.path.getsize('destination/sub/new.file') == 4
+        # The target now exists, so the move is not applied again
+        assert detector.apply(moves) == []
+
+    def test_sources(self, capsys, monkeypatch):
+        self.populate("""
+            mkdir -p source1 source2/sub destination
+            printf 'abcd' > source2/sub/new.file
+            printf 'abcd' > destination/old.file
+            touch -d '2016-05-07 12:00:00' destination/old.file
+            """)
+        app = Syncere('./source1/ ./source2/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'old.file', ichange='*deleting',
+                             operation='del.'),
+            self.make_change(2, 'sub/', ichange='cd+++++++++'),
+            self.make_change(3, 'sub/new.file'),
+        ])
+        assert app.source_index('sub/new.file') == 1
+        assert app.source_index('old.file') == 0
+
+        # The paths are previewed again from the source of the new file
+        previews = []
+
+        def run_preview(args, profile, files=None, others=None,
+                        changes=None):
+            previews.append((args[-2], files))
+            return ([], 0)
+
+        monkeypatch.setattr(app.main, '_run_preview', run_preview)
+        app.mainmenu.run_line('moves --apply')
+        assert os.path.getsize('destination/sub/new.file') == 4
+        assert previews == [('./source1/', 'old.file\n'),
+                            ('./source2/', 'sub/\nsub/new.file\n')]
+
+    def test_ambiguous(self):
+        self.populate("""
+            mkdir destination
+            printf 'abcd' > destination/old1.file
+            printf 'abcd' > destination/old2.file
+            touch -d '2016-05-07 12:00:00' destination/*.file
+            """)
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        changes = [
+            self.make_change(1, 'new1.file', checksum='1' * 32),
+            self.make_change(2, 'new2.file', checksum='2' * 32),
+            self.make_change(3, 'old1.file', ichange='*deleting',
+                             operation='del.', checksum='2' * 32),
+            self.make_change(4, 'old2.file', ichange='*deleting',
+                             operation='del.'),
+        ]
+        detector = MoveDetector(app.destination, ['ssh'])
+        # Without all the checksums the files cannot be told apart
+        assert detector.find(changes) == []
+        changes[3].checksum = '1' * 32
+        assert [(move.deletion.id_, move.creation.id_)
+                for move in detector.find(changes)] == [(4, 1), (3, 2)]
+
+
+@pytest.mark.usefixtures('testdir')
+class TestDuplicates(Utils):
+    """
+    Test the duplicate new files that are only transferred once.
+    """
+    def test_duplicates(self, capsys):
+        self.populate("""
+            mkdir -p source/sub destination
+            printf 'abcd' > source/a.file
+            printf 'abcd' > source/sub/b.file
+            printf 'abcd' > source/c.file
+            printf 'wxyz' > source/d.file
+            """)
+        app = Syncere('./source/ ./destination/', test=True,
+                      commands=['config colors n', 'quit'])
+        app.load_preview([
+            self.make_change(1, 'a.file'),
+            self.make_change(2, 'c.file'),
+            self.make_change(3, 'd.file'),
+            self.make_change(4, 'sub/', ichange='cd+++++++++'),
+            self.make_change(5, 'sub/b.file'),
+        ])
+        # c.file has a different modification time
+        app.pending_changes[1].tstamp = '2016/05/07-12:00:01'
+        app.mainmenu.run_line('include *')
+
+        capsys.readouterr()
+        app.mainmenu.run_line('transfer --view-only --exclude')
+        assert capsys.readouterr().out.splitlines() == [
+            'rsync ./source/ ./destination/']
+
+        app.configuration['transfer-duplicates'] = 'link'
+        app.mainmenu.run_line('transfer --view-only --exclude')
+        assert capsys.readouterr().out.splitlines() == [
+            'Duplicates not transferred, bytes saved: 1 4',
+            'rsync --exclude sub/b.file ./source/ ./destination/']
+
+        # The checksums of the preview are used when all the files have one
+        for change, checksum in zip(app.pending_changes, 'AABAB'):
+            change.checksum = checksum * 32
+        finder = DuplicateFinder(app.sources[0], app.destination, ['ssh'],
+                                 'link')
+        groups = finder.find(app.pending_changes)
+        assert [(group.original.id_, [copy.id_ for copy in group.copies],
+                 group.size) for group in groups] == [(3, [5], 4)]
+
+        self.populate("""
+            printf 'wxyz' > destination/d.file
+            """)
+        assert finder.materialize(groups) == []
+        assert os.stat('destination/sub/b.file').st_ino == \
+            os.stat('destination/d.file').st_ino
+        # Existing files are never replaced
+        assert finder.materialize(groups) == [app.pending_changes[4]]
+
+        app.configuration['transfer-duplicates'] = 'hardlink'
+        app.mainmenu.run_line('transfer --view-only')
+        assert capsys.readouterr().out == \
+            'Unknown transfer-duplicates mode: hardlink\n'
+
+
 @pytest.mark.usefixtures('testdir')
 class TestInterface(Utils):
     """